@@ -0,0 +1 @@
+../observatoryControl/mod_astro_np.py
\ No newline at end of file
@@ -0,0 +1 @@
+../observatoryControl/mod_coincidence.py
\ No newline at end of file
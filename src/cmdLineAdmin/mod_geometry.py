@@ -0,0 +1 @@
+../observatoryControl/mod_geometry.py
\ No newline at end of file
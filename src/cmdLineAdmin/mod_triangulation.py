@@ -0,0 +1 @@
+../observatoryControl/mod_triangulation.py
\ No newline at end of file
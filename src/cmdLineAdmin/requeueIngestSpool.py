@@ -0,0 +1,48 @@
+#!../../virtual-env/bin/python
+# requeueIngestSpool.py
+# Meteor Pi, Cambridge Science Centre
+# Dominic Ford
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# When the import API runs in ingest mode, entities which still can't be written to the database after several
+# attempts are moved to the 'failed' directory of the ingest spool. Exporters have already been told they were
+# received, so won't send them again. Once the problem has been fixed, run this script to return them to the spool,
+# so that the server's ingest workers write them to the database.
+
+# Usage: requeueIngestSpool.py [spool path]
+# The spool path defaults to the one used by the web server, alongside the database file store.
+
+import sys
+
+from meteorpi_server import ingest_spool
+
+import mod_settings
+
+if len(sys.argv) > 1:
+    spool_path = sys.argv[1]
+else:
+    spool_path = ingest_spool.default_spool_path(mod_settings.settings['dbFilestore'])
+
+spool = ingest_spool.IngestSpool(spool_path=spool_path)
+[requeued, unreadable] = spool.requeue_failed()
+print "Returned %d files to the ingest spool at <%s>" % (requeued, spool_path)
+if unreadable:
+    print "%d files in the failed directory could not be read, and were left there" % unreadable
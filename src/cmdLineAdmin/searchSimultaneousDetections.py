@@ -29,14 +29,17 @@ import sys
 import time
 import json
 from math import tan, atan, pi
-import scipy.optimize
+import numpy as np
 
 import meteorpi_db
 import meteorpi_model as mp
 
 import mod_astro
+import mod_astro_np
+import mod_coincidence
 import mod_gnomonic
 import mod_settings
+import mod_triangulation
 from mod_log import log_txt
 
 
@@ -88,67 +91,23 @@ for trigger in triggers:
     trigger.duration = duration
     trigger.obs_time_end = trigger.obs_time + duration
 
-# Search for simultaneous object detections
+# Work out the distances between all of the observatories which saw anything
+obstory_positions = {}
+for obstory_id in set(trigger.obstory_id for trigger in triggers):
+    obstory_info = db.get_obstory_from_id(obstory_id)
+    obstory_positions[obstory_id] = [obstory_info['latitude'], obstory_info['longitude']]
+baselines = mod_coincidence.BaselineMatrix(obstory_positions)
+
+# Search for simultaneous object detections. We have found a coincident detection if multiple observatories, more
+# than 400 metres apart, saw an event at the same time
+detector = mod_coincidence.CoincidenceDetector(baselines=baselines, tolerance=1, minimum_baseline=400)
 groups = []
-triggers_used = [False for i in range(len(triggers))]
-for i in range(len(triggers)):
-    if triggers_used[i]:
-        continue
-    obstory_list = [triggers[i].obstory_id]
-    utc_min = triggers[i].obs_time
-    utc_max = triggers[i].obs_time_end
-    triggers_used[i] = True
-    prev_group_size = 0
-    group_members = [i]
-
-    while len(group_members) > prev_group_size:
-        prev_group_size = len(group_members)
-        for scan_direction in [-1, 1]:
-            scan = i
-            while ((scan >= 0) and (scan < len(triggers)) and (triggers[scan].obs_time_end > utc_min - 60) and
-                       (triggers[scan].obs_time < utc_max + 60)):
-                if not (triggers_used[scan] or (triggers[scan].obs_time > utc_max + 1)
-                        or (triggers[scan].obs_time_end < utc_min - 1)):
-                    group_members.append(scan)
-                    utc_min = min(utc_min, triggers[scan].obs_time)
-                    utc_max = max(utc_max, triggers[scan].obs_time_end)
-                    if triggers[scan].obstory_id not in obstory_list:
-                        obstory_list.append(triggers[scan].obstory_id)
-                    triggers_used[scan] = True
-                scan += scan_direction
-
-    # We have found a coincident detection if multiple observatories saw an event at the same time
-    if len(obstory_list) > 1:
-        maximum_obstory_spacing = 0
-
-        # Work out locations of all observatories which saw this event
-        obstory_locs = []
-        for obstory_id in obstory_list:
-            obstory_info = db.get_obstory_from_id(obstory_id)
-            obstory_loc = mod_astro.Point.from_lat_lng(lat=obstory_info['latitude'],
-                                                       lng=obstory_info['longitude'],
-                                                       alt=0,
-                                                       utc=(utc_min + utc_max) / 2
-                                                       )
-            obstory_locs.append(obstory_loc)
-
-        # Check the distances between all pairs of observatories
-        pairs = [[obstory_locs[i], obstory_locs[j]]
-                 for i in range(len(obstory_list))
-                 for j in range(i + 1, len(obstory_list))
-                 ]
-
-        for pair in pairs:
-            maximum_obstory_spacing = max(maximum_obstory_spacing,
-                                          abs(pair[0].displacement_vector_from(pair[1])))
-
-        # Reject event if it was not seen by any observatories more than 400 metres apart
-        if maximum_obstory_spacing > 400:
-            groups.append({'time': (utc_min + utc_max) / 2,
-                           'obstory_list': obstory_list,
-                           'time_spread': utc_max - utc_min,
-                           'triggers': [{'obs': triggers[x]} for x in group_members],
-                           'ids': [triggers[x].id for x in group_members]})
+for coincidence in detector.find_groups(triggers):
+    groups.append({'time': coincidence['time'],
+                   'obstory_list': coincidence['obstory_list'],
+                   'time_spread': coincidence['time_spread'],
+                   'triggers': [{'obs': x} for x in coincidence['triggers']],
+                   'ids': [x.id for x in coincidence['triggers']]})
 
 print "%6d existing observation groups within this time period (will be deleted)." % (len(existing_groups))
 print "%6d moving objects seen within this time period" % (len(triggers_raw['obs']))
@@ -181,7 +140,8 @@ o.obsTime>=%s AND o.obsTime<=%s;
 log_txt("Triangulating simultaneous object detections between <%s> and <%s>." % (mod_astro.time_print(utc_min),
                                                                                  mod_astro.time_print(utc_max)))
 
-# Loop over list of simultaneous event detections
+# Loop over list of simultaneous event detections, working out the sight lines to each object
+triangulation_groups = []
 for item in groups:
     # Create new observation group
     group = db.register_obsgroup(title="Multi-station detection", user_id="system", semantic_type=semantic_type,
@@ -225,9 +185,21 @@ for item in groups:
         scale_y = obstory_status['orientation_width_y_field'] * pi / 180
         # scale_y = 2 * atan(tan(scale_x / 2) * size_y / size_x)
 
+        # Calculate the celestial coordinates of the centre of the frame, and of the local zenith, at the time of
+        # every positional fix on the object at once
+        utc_list = [point[2] for point in path]
+        [ra0_list, dec0_list] = mod_astro_np.ra_dec(alt=obstory_status['orientation_altitude'],
+                                                    az=obstory_status['orientation_azimuth'],
+                                                    utc=utc_list,
+                                                    latitude=obstory_status['latitude'],
+                                                    longitude=obstory_status['longitude'])
+        ra_dec_zenith_list = mod_astro_np.get_zenith_position(lat=obstory_status['latitude'],
+                                                              lng=obstory_status['longitude'],
+                                                              utc=utc_list)
+
         # For each positional fix on object, convert pixel coordinates into celestial coordinates
         sight_line_list = []
-        for point in path:
+        for i, point in enumerate(path):
             utc = point[2]
 
             # Look up the physical position of the observatory
@@ -240,12 +212,9 @@ for item in groups:
                                                                 alt=altitude,
                                                                 utc=utc)
 
-            # Calculate the celestial coordinates of the centre of the frame
-            [ra0, dec0] = mod_astro.ra_dec(alt=obstory_status['orientation_altitude'],
-                                           az=obstory_status['orientation_azimuth'],
-                                           utc=utc,
-                                           latitude=obstory_status['latitude'],
-                                           longitude=obstory_status['longitude'])
+            # Celestial coordinates of the centre of the frame
+            ra0 = float(ra0_list[i])
+            dec0 = float(dec0_list[i])
             ra0_rad = ra0 * pi / 12  # Convert hours into radians
             dec0_rad = dec0 * pi / 180  # Convert degrees into radians
 
@@ -254,12 +223,9 @@ for item in groups:
             # If the camera is roughly upright, this ought to be close to zero!
             camera_tilt = obstory_status['orientation_pa']
 
-            # Get celestial coordinates of the local zenith
-            ra_dec_zenith = mod_astro.get_zenith_position(lat=obstory_status['latitude'],
-                                                          lng=obstory_status['longitude'],
-                                                          utc=utc)
-            ra_zenith = ra_dec_zenith['ra']
-            dec_zenith = ra_dec_zenith['dec']
+            # Celestial coordinates of the local zenith
+            ra_zenith = float(ra_dec_zenith_list['ra'][i])
+            dec_zenith = float(ra_dec_zenith_list['dec'][i])
 
             # Work out the position angle of the zenith, counterclockwise from north, as measured at centre of frame
             zenith_pa = mod_gnomonic.position_angle(ra0, dec0, ra_zenith, dec_zenith)
@@ -289,6 +255,7 @@ for item in groups:
                 'alt': alt_az[0],
                 'az': alt_az[1],
                 'utc': point[2],
+                'obstory_id': obstory_id,
                 'obs_position': observatory_position,
                 'line': sight_line
             }
@@ -314,64 +281,66 @@ for item in groups:
         log_txt("Giving up triangulation as we only have %d sight lines to object." % (len(all_sight_lines)))
         continue
 
+    item['all_sight_lines'] = all_sight_lines
+    triangulation_groups.append(item)
+
+# Triangulate all of the objects at once, in parallel
+log_txt("Triangulating %d objects." % len(triangulation_groups))
+triangulation_results = mod_triangulation.triangulate_many(
+    [{'obs_positions': [[s['obs_position'].x, s['obs_position'].y, s['obs_position'].z]
+                        for s in item['all_sight_lines']],
+      'directions': [[s['line'].direction.x, s['line'].direction.y, s['line'].direction.z]
+                     for s in item['all_sight_lines']],
+      'stations': [s['obstory_id'] for s in item['all_sight_lines']],
+      'utc': [s['utc'] for s in item['all_sight_lines']]}
+     for item in triangulation_groups])
+
+# Record the results of each triangulation
+for item, triangulation in zip(triangulation_groups, triangulation_results):
+    log_txt("Triangulating simultaneous detection at %s" % mod_astro.time_print(item['time']))
+    if triangulation is None:
+        log_txt("Giving up triangulation as the sight lines from different observatories don't intersect.")
+        continue
 
-    # Work out the sum of square angular mismatches of sightlines to a test trajectory
-    def line_from_parameters(p):
-        x0 = mod_astro.Point(p[0] * 1000, p[1] * 1000, 0)
-        d = mod_astro.Vector.from_ra_dec(p[2], p[3])
-        trajectory = mod_astro.Line(x0=x0, direction=d)
-        return trajectory
-
-
-    def angular_mismatch_slave(p):
-        trajectory = line_from_parameters(p)
-        mismatch = 0
-        for sight in all_sight_lines:
-            closest_point = trajectory.find_closest_approach(sight['line'])
-            mismatch += closest_point['angular_distance']
-        return mismatch
-
-
-    params_initial = [0, 0, 0, 0]
-    params_optimised = scipy.optimize.minimize(angular_mismatch_slave, params_initial, method='nelder-mead',
-                                               options={'xtol': 1e-7, 'disp': False, 'maxiter': 1e6, 'maxfev': 1e6}
-                                               ).x
-    best_triangulation = line_from_parameters(params_optimised)
+    best_triangulation = triangulation['trajectory']
     log_txt("Best fit path of object through space is %s." % best_triangulation)
 
-    log_txt("Mismatch of observed sight lines from trajectory are %s deg." %
-            (["%.1f" % best_triangulation.find_closest_approach(s['line'])['angular_distance']
-              for s in all_sight_lines]))
+    mismatch_list = np.abs(triangulation['residuals'])
+    log_txt("Mismatch of observed sight lines from trajectory are %s deg." % (["%.1f" % i for i in mismatch_list]))
 
-    maximum_mismatch = max([best_triangulation.find_closest_approach(s['line'])['angular_distance']
-                            for s in all_sight_lines])
+    maximum_mismatch = np.max(mismatch_list)
 
-    # Reject trajectory if it deviates by more than 3 degrees from any observation
+    # Reject trajectory if it deviates by more than 7 degrees from any observation
     if maximum_mismatch > 7:
         log_txt("Mismatch is too great. Trajectory fit is rejected.")
         continue
 
+    # Work out where the object was at the time of each sighting
+    object_positions = triangulation['closest_approach']['self_point']
+    object_lat_lngs = object_positions.to_lat_lng([s['utc'] for s in item['all_sight_lines']])
+    for index, detection in enumerate(item['all_sight_lines']):
+        detection['index'] = index
+
     # Add triangulation information to each observation
     for trigger in item['triggers']:
         if 'sight_line_list' in trigger:
             detected_position_info = []
             for detection in trigger['sight_line_list']:
-                sight_line = detection['line']
+                index = detection['index']
                 observatory_position = detection['obs_position']
-                object_position = best_triangulation.find_closest_approach(sight_line)
-                object_lat_lng = object_position['self_point'].to_lat_lng(detection['utc'])
-                object_distance = abs(object_position['self_point'].displacement_vector_from(observatory_position))
-                detection['object_position'] = observatory_position
+                object_position = object_positions[index]
+                object_distance = abs(object_position.displacement_vector_from(observatory_position))
+                detection['object_position'] = object_position
                 detected_position_info.append({'ra': detection['ra'],
                                                'dec': detection['dec'],
                                                'alt': detection['alt'],
                                                'az': detection['az'],
                                                'utc': detection['utc'],
-                                               'lat': object_lat_lng['lat'],
-                                               'lng': object_lat_lng['lng'],
-                                               'height': object_lat_lng['alt'],
+                                               'lat': float(object_lat_lngs['lat'][index]),
+                                               'lng': float(object_lat_lngs['lng'][index]),
+                                               'height': float(object_lat_lngs['alt'][index]),
                                                'dist': object_distance,
-                                               'ang_mismatch': object_position['angular_distance']
+                                               'ang_mismatch': float(mismatch_list[index])
                                                })
 
             # Make descriptor of triangulated information
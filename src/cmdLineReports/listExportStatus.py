@@ -24,6 +24,8 @@
 
 # Checks for missing files, duplicate publicIds, etc
 
+import time
+
 import meteorpi_db
 import mod_settings
 
@@ -40,21 +42,31 @@ for config in export_configs:
         print "  * Active"
     else:
         print "  * Disabled"
-    n_total = n_pending = -1
+    n_total = n_pending = n_claimed = -1
     if (config['exportType'] == "metadata"):
         sql.execute("SELECT COUNT(*) FROM archive_metadataExport;")
         n_total = sql.fetchall()[0]['COUNT(*)']
         sql.execute("SELECT COUNT(*) FROM archive_metadataExport WHERE exportState>0;")
         n_pending = sql.fetchall()[0]['COUNT(*)']
+        sql.execute("SELECT COUNT(*) FROM archive_metadataExport WHERE exportState>0 AND leaseExpiry>%s;",
+                    (time.time(),))
+        n_claimed = sql.fetchall()[0]['COUNT(*)']
     elif (config['exportType'] == "observation"):
         sql.execute("SELECT COUNT(*) FROM archive_observationExport;")
         n_total = sql.fetchall()[0]['COUNT(*)']
         sql.execute("SELECT COUNT(*) FROM archive_observationExport WHERE exportState>0;")
         n_pending = sql.fetchall()[0]['COUNT(*)']
+        sql.execute("SELECT COUNT(*) FROM archive_observationExport WHERE exportState>0 AND leaseExpiry>%s;",
+                    (time.time(),))
+        n_claimed = sql.fetchall()[0]['COUNT(*)']
     elif (config['exportType'] == "file"):
         sql.execute("SELECT COUNT(*) FROM archive_fileExport;")
         n_total = sql.fetchall()[0]['COUNT(*)']
         sql.execute("SELECT COUNT(*) FROM archive_fileExport WHERE exportState>0;")
         n_pending = sql.fetchall()[0]['COUNT(*)']
+        sql.execute("SELECT COUNT(*) FROM archive_fileExport WHERE exportState>0 AND leaseExpiry>%s;",
+                    (time.time(),))
+        n_claimed = sql.fetchall()[0]['COUNT(*)']
     print "  * %9d jobs in export table" % n_total
     print "  * %9d jobs still to be done" % n_pending
+    print "  * %9d jobs currently claimed by an exporter" % n_claimed
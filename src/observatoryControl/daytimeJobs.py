@@ -44,7 +44,10 @@ import dbImport
 import exportData
 import installation_info
 import mod_astro
+import mod_astro_np
 import mod_daytimejobs
+import mod_inputindex
+import mod_jobqueue
 import mod_log
 import mod_settings
 import orientationCalc
@@ -72,39 +75,28 @@ daytimeJobsClean.day_time_jobs_clean(db)
 cwd = os.getcwd()
 os.chdir(mod_settings.settings['dataPath'])
 
+# Open the index of the input files we've already found in the data directory
+input_index = mod_inputindex.InputIndex(mod_settings.settings['daytimeJobsIndex'])
 
-# Run a list of shell commands in parallel
-# Pass a list of job descriptor dictionaries, each having a cmd template, and a dictionary of params to substitute
-def run_job_group(job_group):
-    if len(job_group) < 1:
-        return
-
-    # Run shell commands associated with this group of jobs
-    shell_cmds = []
-    for job in job_group:
-        try:
-            shell_cmd = " ".join((job['cmd'] % job['params']).split())
-        except KeyError:
-            log_txt("Key Error prevented job from running: %s" % job)
-            shell_cmd = "true"
-        shell_cmds.append(shell_cmd)
-    for cmd in shell_cmds:
-        print "Running command: %s" % cmd
-    if len(shell_cmds) == 1:
-        cmd = shell_cmds[0]
-    else:
-        cmd = " & ".join(shell_cmds) + " & wait"
-    os.system(cmd)
-
-    # Cascade metadata from input files to output files
-    for job in job_group:
-        m = job['params']  # Dictionary of metadata
-        products = glob.glob("%(filename_out)s*%(outExt)s" % m)
-        for product in products:
-            stub = product[:-len(m['outExt'])]
-            metadata = m['metadata']  # Metadata that was associated with input file
-            metadata.update(mod_daytimejobs.file_to_dict(in_filename="%stxt" % stub))
-            mod_daytimejobs.dict_to_file(out_filename="%stxt" % stub, in_dict=metadata)
+
+# Substitute a job's parameters into its shell command template
+def job_shell_command(job):
+    try:
+        return " ".join((job['cmd'] % job['params']).split())
+    except KeyError:
+        log_txt("Key Error prevented job from running: %s" % job)
+        return "true"
+
+
+# Cascade metadata from a job's input file to its output files, once it has finished
+def cascade_metadata(job):
+    m = job['params']  # Dictionary of metadata
+    products = glob.glob("%(filename_out)s*%(outExt)s" % m)
+    for product in products:
+        stub = product[:-len(m['outExt'])]
+        metadata = m['metadata']  # Metadata that was associated with input file
+        metadata.update(mod_daytimejobs.file_to_dict(in_filename="%stxt" % stub))
+        mod_daytimejobs.dict_to_file(out_filename="%stxt" % stub, in_dict=metadata)
 
 
 # Create a custom exception which we raise if we pass the time when we've been told we need to hand execution back
@@ -129,7 +121,8 @@ for obstory_id in obstory_list:
 try:
     # Loop over task groups, e.g. PNG encoding timelapse images, or encoding trigger videos to MP4
     for task_group in mod_daytimejobs.dayTimeTasks:
-        [hwm_output, n_max, task_list] = task_group
+        [hwm_output, n_max, task_list] = task_group[:3]
+        task_options = task_group[3] if len(task_group) > 3 else {}
         log_txt("Working on task group <%s>" % hwm_output)
 
         # Look up old high-water marks for each observatory
@@ -145,119 +138,121 @@ try:
         hwm_margin = ((mod_settings.settings['videoMaxRecordTime'] - 5) if hwm_output == "rawvideo" else 0.1)
         job_list = []
 
+        # Files older than the high water marks of all of the observatories don't need processing
+        hwm_min = min([hwm_old[obstory_id][hwm_output] for obstory_id in obstory_list] or [0])
+
         # Loop over each of the input file search patterns that this task group is to be applied to
         for task in task_list:
             [in_dir, out_dirs, in_ext, out_ext, cmd] = task
 
-            # Loop recursively over all files in the input directory
-            for dir_name, subdir_list, file_list in os.walk(in_dir):
-                for f in file_list:
-                    if quit_time and (get_utc() > quit_time):
-                        raise TimeOut
-                    input_file = os.path.join(dir_name, f)
-
-                    # Input files must have correct extension and non-zero size to be processed
-                    if f.endswith(".%s" % in_ext) and (os.path.getsize(input_file) > 0):
-
-                        # Extract observation time from image filename. If this fails, reject the file.
-                        utc = mod_log.filename_to_utc(f)
-                        if utc < 0:
-                            continue
-
-                        # Add this job to our list of things to do
-                        job_counter += 1
-                        mask_file = "/tmp/triggermask_%d_%d.txt" % (os.getpid(), job_counter)
-
-                        # Fix to stop floating point jitter creating lots of files with timestamps like 23:59:59
-                        utc += 0.1
-
-                        # Job will be run as a shell command taken from mod_daytimejobs. Each shell command
-                        # template has variables substituted into it. These are some default values, many of which
-                        # will be overwritten with metadata associated with the input file.
-                        params = {'binary_path': mod_settings.settings['binaryPath'],
-                                  'input': input_file,
-                                  'outdir': out_dirs[0],
-                                  'filename': f[:-(len(in_ext) + 1)],
-                                  'inExt': in_ext,
-                                  'outExt': out_ext,
-                                  'date': mod_log.fetch_day_name_from_filename(f),
-                                  'tstamp': utc,
-                                  'obstoryId': installation_info.local_conf['observatoryId'],
-                                  'pid': pid,
-                                  'triggermask': mask_file,
-                                  'opm': ('_openmax' if mod_settings.settings['i_am_a_rpi'] else ''),
-
-                                  # Produce non-lens-corrected images once every 2 mins
-                                  'produceFilesWithoutLC': int(math.floor(utc % 120) < 24),
-                                  }
-                        params['filename_out'] = "%(outdir)s/%(date)s/%(filename)s" % params
-
-                        # Overwrite the default parameters above with those output from the videoAnalysis C code
-                        # Store a copy of the input file's metadata as params['params']
-                        params['metadata'] = mod_daytimejobs.file_to_dict(
-                            in_filename="%s.txt" % os.path.join(dir_name, params['filename']))
-                        params.update(params['metadata'])
-
-                        # Fetch the status of the observatory which made this observation
-                        obstory_id = params['obstoryId']
-                        if obstory_id not in obstory_infos:
-                            print "Error: No observatory status set for id <%s>" % obstory_id
-                            continue
-                        obstory_info = obstory_infos[obstory_id]
-                        obstory_name = obstory_info['name']
-                        obstory_status = db.get_obstory_status(obstory_name=obstory_name, time=utc)
-
-                        if 'latitude' not in obstory_status:
-                            obstory_status['latitude'] = installation_info.local_conf['latitude']
-                        if 'longitude' not in obstory_status:
-                            obstory_status['longitude'] = installation_info.local_conf['longitude']
-
-                        if 'fps' not in params:
-                            params['fps'] = obstory_status["sensor_fps"]
-
-                        # Only operate on input files which are newer than HWM
-                        if utc < hwm_old[obstory_id][hwm_output]:
-                            continue
-
-                        # Read barrel-correction parameters
-                        params['barrel_a'] = obstory_status["lens_barrel_a"]
-                        params['barrel_b'] = obstory_status["lens_barrel_b"]
-                        params['barrel_c'] = obstory_status["lens_barrel_c"]
-
-                        # Create clipping region mask file
-                        open(mask_file, "w").write(
-                            "\n\n".join(
-                                ["\n".join([("%d %d" % p) for p in pointList])
-                                 for pointList in json.loads(obstory_status['clippingRegion'])]
-                            )
-                        )
-
-                        # Calculate metadata about the position of Sun at the time of observation
-                        sunPos = mod_astro.sun_pos(utc)
-                        sunAltAz = mod_astro.alt_az(sunPos[0], sunPos[1], utc,
-                                                    obstory_status['latitude'], obstory_status['longitude'])
-                        params['metadata']['sunRA'] = sunPos[0]
-                        params['metadata']['sunDecl'] = sunPos[1]
-                        params['metadata']['sunAlt'] = sunAltAz[0]
-                        params['metadata']['sunAz'] = sunAltAz[1]
-
-                        # Apply a metadata tag 'highlight' to a few images, which will get shown by the
-                        # 'show fewer results' option in the web interface. Select roughly one image every
-                        # ten minutes
-                        params['metadata']['highlight'] = int((math.floor(utc % 600) < 24) or ('outExt' == 'mp4'))
-
-                        # Make sure that output directory exists
-                        for out_dir in out_dirs:
-                            os.system("mkdir -p %s" % (os.path.join(out_dir, params['date'])))
-
-                        # Add job to list, but don't do it yet as we want to do jobs in time order
-                        # Do jobs in time order means we can stop part way and be able to record where we
-                        # got up to.
-                        job_list.append({'utc': utc, 'cmd': cmd, 'params': params})
+            # Find any files which have been added to the input directory since we last looked, and loop over those
+            # which are no older than the earliest high water mark. Only files with the right extension, non-zero size,
+            # and a filename which tells us when they were made, are returned.
+            input_index.scan(in_dir)
+            for [input_file, utc] in input_index.files_since(root=in_dir, ext=in_ext, utc_min=hwm_min - 0.1):
+                if quit_time and (get_utc() > quit_time):
+                    raise TimeOut
+                [dir_name, f] = os.path.split(input_file)
+
+                # Add this job to our list of things to do
+                job_counter += 1
+                mask_file = "/tmp/triggermask_%d_%d.txt" % (os.getpid(), job_counter)
+
+                # Fix to stop floating point jitter creating lots of files with timestamps like 23:59:59
+                utc += 0.1
+
+                # Job will be run as a shell command taken from mod_daytimejobs. Each shell command
+                # template has variables substituted into it. These are some default values, many of which
+                # will be overwritten with metadata associated with the input file.
+                params = {'binary_path': mod_settings.settings['binaryPath'],
+                          'input': input_file,
+                          'outdir': out_dirs[0],
+                          'filename': f[:-(len(in_ext) + 1)],
+                          'inExt': in_ext,
+                          'outExt': out_ext,
+                          'date': mod_log.fetch_day_name_from_filename(f),
+                          'tstamp': utc,
+                          'obstoryId': installation_info.local_conf['observatoryId'],
+                          'pid': pid,
+                          'triggermask': mask_file,
+                          'opm': ('_openmax' if mod_settings.settings['i_am_a_rpi'] else ''),
+
+                          # Produce non-lens-corrected images once every 2 mins
+                          'produceFilesWithoutLC': int(math.floor(utc % 120) < 24),
+                          }
+                params['filename_out'] = "%(outdir)s/%(date)s/%(filename)s" % params
+
+                # Overwrite the default parameters above with those output from the videoAnalysis C code
+                # Store a copy of the input file's metadata as params['params']
+                params['metadata'] = mod_daytimejobs.file_to_dict(
+                    in_filename="%s.txt" % os.path.join(dir_name, params['filename']))
+                params.update(params['metadata'])
+
+                # Fetch the status of the observatory which made this observation
+                obstory_id = params['obstoryId']
+                if obstory_id not in obstory_infos:
+                    print "Error: No observatory status set for id <%s>" % obstory_id
+                    continue
+                obstory_info = obstory_infos[obstory_id]
+                obstory_name = obstory_info['name']
+                obstory_status = db.get_obstory_status(obstory_name=obstory_name, time=utc)
+
+                if 'latitude' not in obstory_status:
+                    obstory_status['latitude'] = installation_info.local_conf['latitude']
+                if 'longitude' not in obstory_status:
+                    obstory_status['longitude'] = installation_info.local_conf['longitude']
+
+                if 'fps' not in params:
+                    params['fps'] = obstory_status["sensor_fps"]
+
+                # Only operate on input files which are newer than HWM
+                if utc < hwm_old[obstory_id][hwm_output]:
+                    continue
+
+                # Read barrel-correction parameters
+                params['barrel_a'] = obstory_status["lens_barrel_a"]
+                params['barrel_b'] = obstory_status["lens_barrel_b"]
+                params['barrel_c'] = obstory_status["lens_barrel_c"]
+
+                # Create clipping region mask file
+                open(mask_file, "w").write(
+                    "\n\n".join(
+                        ["\n".join([("%d %d" % p) for p in pointList])
+                         for pointList in json.loads(obstory_status['clippingRegion'])]
+                    )
+                )
+
+                # Apply a metadata tag 'highlight' to a few images, which will get shown by the
+                # 'show fewer results' option in the web interface. Select roughly one image every
+                # ten minutes
+                params['metadata']['highlight'] = int((math.floor(utc % 600) < 24) or ('outExt' == 'mp4'))
+
+                # Make sure that output directory exists
+                for out_dir in out_dirs:
+                    os.system("mkdir -p %s" % (os.path.join(out_dir, params['date'])))
+
+                # Add job to list, but don't do it yet as we want to do jobs in time order
+                # Do jobs in time order means we can stop part way and be able to record where we
+                # got up to.
+                job_list.append({'utc': utc, 'cmd': cmd, 'params': params,
+                                 'latitude': obstory_status['latitude'], 'longitude': obstory_status['longitude']})
 
         # Sort jobs in order of timestamp
         job_list.sort(key=operator.itemgetter('utc'))
 
+        # Calculate metadata about the position of Sun at the time of each observation, for all jobs at once
+        if job_list:
+            utc_list = [job['utc'] for job in job_list]
+            sun_pos = mod_astro_np.sun_pos(utc_list)
+            sun_alt_az = mod_astro_np.alt_az(sun_pos[0], sun_pos[1], utc_list,
+                                             [job['latitude'] for job in job_list],
+                                             [job['longitude'] for job in job_list])
+            for i, job in enumerate(job_list):
+                job['params']['metadata']['sunRA'] = float(sun_pos[0][i])
+                job['params']['metadata']['sunDecl'] = float(sun_pos[1][i])
+                job['params']['metadata']['sunAlt'] = float(sun_alt_az[0][i])
+                job['params']['metadata']['sunAz'] = float(sun_alt_az[1][i])
+
         # Reset high water marks in the database to just before the first job we need to do for each observatory
         # Delete any output products that are newer than that time
         obstories_seen = []
@@ -279,32 +274,39 @@ try:
                 db.clear_database(obstory_names=[obstory_name], tmin=job['utc'] - 0.1, tmax=job['utc'] + 3600 * 12)
                 obstories_seen.append(obstory_id)
 
-        # Now do jobs in order, raising local high level water mark as we do each job
-        job_group = []
-        job_list_len = len(job_list)
-        if job_list_len:
-            for i in range(job_list_len):
-                job = job_list[i]
-                if quit_time and (get_utc() > quit_time):
-                    raise TimeOut
-                job_group.append(job)
-                if len(job_group) >= n_max:
-                    run_job_group(job_group)
-                    job_group = []
-
-                    # Set HWM so that next job is marked as not yet done (it may have the same timestamp as present job)
-                    for job_done in job_group:
-                        obstory_id = job_done['params']['obstoryId']
-                        hwm_new[obstory_id][hwm_output] = job_list[i]['utc'] - 0.1
-
-            run_job_group(job_group)
+        # Now do jobs, starting them in time order, with up to n_max running at once
+        if job_list:
+            for job in job_list:
+                job['shell_cmd'] = job_shell_command(job)
+            max_processes = mod_settings.settings['daytimeJobsMaxProcesses'] or mod_jobqueue.cpu_count()
+            queue = mod_jobqueue.JobQueue(name=hwm_output,
+                                          jobs=[{'cmd': job['shell_cmd'], 'utc': job['utc'], 'job': job,
+                                                 'resources': task_options.get('resources', [])}
+                                                for job in job_list],
+                                          max_processes=min(n_max, max_processes),
+                                          timeout=task_options.get('timeout',
+                                                                   mod_settings.settings['daytimeJobTimeout']))
+            all_done = queue.run(quit_time=quit_time, on_finish=lambda item: cascade_metadata(item['job']))
+
+            # Jobs finish out of order, so we can only raise the high water mark of each observatory to just before its
+            # earliest job which hasn't finished (it may have the same timestamp as a job which has)
             for obstory_id in obstories_seen:
-                hwm_new[obstory_id][hwm_output] = job_list[job_list_len - 1]['utc'] + hwm_margin
-            log_txt("Completed %d jobs" % len(job_list))
+                unfinished = [item['utc'] for index, item in enumerate(queue.jobs)
+                              if (item['job']['params']['obstoryId'] == obstory_id) and not queue.finished[index]]
+                if unfinished:
+                    hwm_new[obstory_id][hwm_output] = min(unfinished) - 0.1
+                else:
+                    hwm_new[obstory_id][hwm_output] = max(item['utc'] for item in queue.jobs
+                                                          if item['job']['params']['obstoryId'] == obstory_id
+                                                          ) + hwm_margin
+            log_txt("Completed %d of %d jobs" % (sum(queue.finished), len(job_list)))
 
             # Delete trigger masks that we've finished with
             os.system("rm -f /tmp/triggermask_%d_*" % (os.getpid()))
 
+            if not all_done:
+                raise TimeOut
+
 except TimeOut:
     log_txt("Interrupting processing as we've run out of time")
 
@@ -320,6 +322,7 @@ for obstory_id in all_obstories_seen:
 
 # Commit changes to database
 db.commit()
+input_index.close()
 
 # Import events into database (unless we need to start observing again within next five minutes)
 os.chdir(cwd)
@@ -27,6 +27,7 @@ import uuid
 import glob
 import time
 import meteorpi_db
+from meteorpi_db import derivatives
 import meteorpi_model as mp
 import mod_log
 from mod_log import log_txt, get_utc
@@ -116,6 +117,12 @@ def database_import(db):
     # A list of the still image observation IDs we've created
     still_img_obs_list = {}
 
+    # If requested, we produce thumbnails of images as we import them, in the cache used by the web server
+    derivative_cache = None
+    if mod_settings.settings['pregenerateDerivatives']:
+        derivative_cache = derivatives.DerivativeCache(
+            cache_path=derivatives.default_cache_path(mod_settings.settings['dbFilestore']))
+
     # Loop over all of the video files and images we've created locally. For each one, we create a new observation
     # object if there are no other files from the same observatory with the same time stamp.
 
@@ -183,10 +190,18 @@ def database_import(db):
 
             # Import the file itself into the database
             semantic_type = local_filename_to_semantic_type(file_name)
-            db.register_file(file_path=file_name, user_id=user, mime_type=mime_type,
-                             semantic_type=semantic_type,
-                             file_time=utc, file_meta=metadata_objs,
-                             observation_id=obs_id)
+            file_record = db.register_file(file_path=file_name, user_id=user, mime_type=mime_type,
+                                           semantic_type=semantic_type,
+                                           file_time=utc, file_meta=metadata_objs,
+                                           observation_id=obs_id)
+
+            # Produce thumbnails of images
+            if derivative_cache is not None and mime_type in derivatives.SOURCE_MIME_TYPES:
+                try:
+                    derivative_cache.generate_all(file_record=file_record,
+                                                  source_path=db.file_path_for_id(file_record.id))
+                except ValueError as e:
+                    log_txt("Could not produce thumbnails of <%s>: %s" % (file_name, e))
 
             # Update this observatory's "import" high water mark to the time of the file just imported
             hwm_new[obstory_id] = max(hwm_new[obstory_id], utc)
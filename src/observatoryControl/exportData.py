@@ -28,38 +28,93 @@ import sys
 import time
 
 import meteorpi_db
-from meteorpi_db.exporter import MeteorExporter
+from meteorpi_db.exporter import MeteorExporter, ConcurrentExporter
+from meteorpi_db.export_queue import ExportQueue
+from meteorpi_db.export_scheduler import ExportScheduler, ExportWindow
 
 import mod_log
 from mod_log import log_txt, get_utc
 import mod_settings
 
 
-def export_data(db, utc_now, utc_must_stop=0):
+def export_data(db, utc_now, utc_must_stop=0, workers=None):
+    """
+    Send any entities which need exporting to the remote servers they are configured to be exported to
+
+    :param db:
+        The MeteorDatabase to export from
+    :param utc_now:
+        The current time, which may be simulated
+    :param utc_must_stop:
+        The time by which we must stop exporting, or zero to export until there is nothing left to send
+    :param workers:
+        The number of export batches which may be in progress at once, defaulting to the exportWorkers setting
+    """
     log_txt("Starting export of images and events")
 
     # Work out how long we can do exporting for
     utc_stop = get_utc() + (utc_must_stop - utc_now)
 
     # Search for items which need exporting
-    for export_config in db.get_export_configurations():
-        if export_config.enabled:
-            db.mark_entities_to_export(export_config)
+    export_configs = [x for x in db.get_export_configurations() if x.enabled]
+    for export_config in export_configs:
+        db.mark_entities_to_export(export_config)
     db.commit()
 
-    # Create an exporter instance
-    exporter = MeteorExporter(db=db)
+    # Create an exporter instance, taking tasks from the export queue in the proportions given in our settings, and
+    # sending them no faster than our bandwidth limits allow. If we must stop by a certain time, files which we don't
+    # expect to finish sending by then aren't started.
+    scheduler = ExportScheduler(bytes_per_second=mod_settings.settings['exportBytesPerSecond'],
+                                windows=[ExportWindow.from_dict(x) for x in mod_settings.settings['exportWindows']],
+                                size_classes=mod_settings.settings['exportSizeClasses'],
+                                link_bytes_per_second=mod_settings.settings['exportLinkBytesPerSecond'],
+                                deadline=utc_stop if utc_must_stop else None)
+    db.export_queue = ExportQueue(db=db, lease_seconds=mod_settings.settings['exportLeaseSeconds'],
+                                  priorities=mod_settings.settings['exportPriorities'])
+    scheduler.apply(db)
+    exporter = MeteorExporter(db=db, bandwidth=scheduler.bandwidth)
+
+    # Ask each server which of these items it already holds, so that we don't send them again
+    for export_config in export_configs:
+        already_held = exporter.reconcile_inventory(export_config)
+        db.commit()
+        if already_held:
+            log_txt("%d items for export <%s> are already held by the server" % (already_held, export_config.name))
+
+    # Estimate how much we'll manage to send before we have to stop
+    if utc_must_stop:
+        for name, count, byte_count, fraction in scheduler.estimate_backlog(db=db, utc_now=time.time(),
+                                                                            utc_deadline=utc_stop):
+            if not count:
+                continue
+            if fraction is None:
+                log_txt("Export backlog: %d %s items (%d bytes)" % (count, name, byte_count))
+            else:
+                log_txt("Export backlog: %d %s items (%d bytes), %.0f%% expected to be sent before we must stop" %
+                        (count, name, byte_count, fraction * 100))
+
+    if workers is None:
+        workers = mod_settings.settings['exportWorkers']
+    if workers > 1:
+        exporter.sessions.close()
+        export_data_concurrently(db=db, utc_stop=utc_stop, utc_must_stop=utc_must_stop, workers=workers,
+                                 scheduler=scheduler)
+        return
 
     # Loop until either we run out of time, or we run out of files to export
     max_failures = 4
     fail_count = 0
     while ((not utc_must_stop) or (time.time() < utc_stop)) and (fail_count < max_failures):
-        state = exporter.handle_next_export()
+        scheduler.apply(db)
+        state = exporter.handle_next_export_batch(batch_size=mod_settings.settings['exportBatchSize'])
         db.commit()
         if not state:
             log_txt("Finished export of images and events")
             break
-        print "Export status: %s" % state.state
+        print "Export status: %s (%s)" % (state.state, state)
+        if state.state == "deferred":
+            log_txt("Stopping export, because there isn't time to send any more before we must stop")
+            break
         if state.state == "failed":
             log_txt("Backing off, because an export failed")
             time.sleep([30, 300, 600, 1200, 2400][fail_count])
@@ -68,10 +123,37 @@ def export_data(db, utc_now, utc_must_stop=0):
             fail_count = 0
 
     # Exit
+    exporter.release_tasks()
+    exporter.sessions.close()
     if fail_count >= max_failures:
         log_txt("Exceeded maximum allowed number of failures: giving up.")
 
 
+def export_data_concurrently(db, utc_stop, utc_must_stop, workers, scheduler):
+    # Export using a pool of worker threads. Servers which fail are backed off individually, without holding up
+    # exports to other servers.
+    exporter = ConcurrentExporter(db=db, workers=workers,
+                                  max_per_target=mod_settings.settings['exportConnectionsPerTarget'],
+                                  batch_size=mod_settings.settings['exportBatchSize'],
+                                  bandwidth=scheduler.bandwidth)
+
+    def should_continue():
+        scheduler.apply(db)
+        return (not utc_must_stop) or (time.time() < utc_stop)
+
+    def report(target_url, state):
+        if state is None:
+            log_txt("Export to %s raised an exception, backing off" % target_url)
+        else:
+            print "Export status for %s: %s (%s)" % (target_url, state.state, state)
+            if state.state == "failed":
+                log_txt("Backing off from %s, because an export failed" % target_url)
+
+    summary = exporter.run(should_continue=should_continue, report=report)
+    exporter.sessions.close()
+    log_txt("Finished export of images and events: %s" % summary)
+
+
 # If we're called as a script, run the method exportData()
 if __name__ == "__main__":
     _utc_now = time.time()
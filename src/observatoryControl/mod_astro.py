@@ -548,7 +548,7 @@ class Line:
         r = self.direction
         d = other.direction
 
-        p1_minus_p2 = p2.displacement_vector_from(p1)
+        p1_minus_p2 = p1.displacement_vector_from(p2)
 
         d_dot_r = d.dot_product(r)
 
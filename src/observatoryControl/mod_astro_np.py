@@ -0,0 +1,251 @@
+# mod_astro_np.py
+# Meteor Pi, Cambridge Science Centre
+# Dominic Ford
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# This module contains versions of the functions in mod_astro which work on NumPy arrays, so that they can be applied
+# to many times or positions at once, for example to every job in a batch of daytime jobs, or every point along the
+# path of a meteor. Each function takes the same arguments as the function of the same name in mod_astro, but any of
+# them may be arrays, which are broadcast against each other, and it returns arrays.
+#
+# Run this module as a script to check that it agrees with mod_astro, and to compare their speeds.
+
+import sys
+import time
+
+import numpy as np
+
+from mod_astro import deg
+
+
+# Return the [RA, Dec] of the Sun at given Unix times. See Jean Meeus, Astronomical Algorithms, pp 163-4
+def sun_pos(utc):
+    jd = np.asarray(utc, dtype=float) / 86400.0 + 2440587.5
+
+    t = (jd - 2451545.0) / 36525.
+    l0 = 280.46646 + 36000.76983 * t + 0.0003032 * t * t
+    m = 357.52911 + 35999.05029 * t + 0.0001537 * t * t
+
+    c = ((1.914602 - 0.004817 * t - 0.000014 * t * t) * np.sin(m * deg) +
+         (0.019993 - 0.000101 * t) * np.sin(2 * m * deg) +
+         0.000289 * np.sin(3 * m * deg))
+
+    tl = l0 + c  # true longitude
+
+    epsilon = 23 + 26. / 60 + 21.448 / 3600 + 46.8150 / 3600 * t + 0.00059 / 3600 * t * t + 0.001813 / 3600 * t * t * t
+
+    ra = 12 / np.pi * np.arctan2(np.cos(epsilon * deg) * np.sin(tl * deg), np.cos(tl * deg))  # hours
+    dec = 180 / np.pi * np.arcsin(np.sin(epsilon * deg) * np.sin(tl * deg))  # degrees
+
+    return [ra, dec]
+
+
+# Turns unix times into sidereal times (in hours, at Greenwich)
+def sidereal_time(utc):
+    j = 40587.5 + np.asarray(utc, dtype=float) / 86400.0  # Julian date - 2400000
+    t = (j - 51545.0) / 36525.0  # Julian century (no centuries since 2000.0)
+    st = np.mod(280.46061837 +
+                360.98564736629 * (j - 51545.0) +  # See pages 87-88 of Astronomical Algorithms, by Jean Meeus
+                0.000387933 * t * t +
+                t * t * t / 38710000.0, 360) * 12 / 180
+    return st  # sidereal time, in hours. RA at zenith in Greenwich.
+
+
+# Converts RAs and Decs into altitudes and azimuths
+# RA should be in hours; all other angles should be in degrees.
+def alt_az(ra, dec, utc, latitude, longitude):
+    ra = np.asarray(ra, dtype=float) * np.pi / 12
+    dec = np.asarray(dec, dtype=float) * np.pi / 180
+    st = sidereal_time(utc) * np.pi / 12 + np.asarray(longitude, dtype=float) * np.pi / 180
+    x = np.sin(ra) * np.cos(dec)
+    y = -np.sin(dec)  # y-axis = towards south pole
+    z = np.cos(ra) * np.cos(dec)  # z-axis = vernal equinox; RA=0
+
+    # Rotate by hour angle around y-axis
+    x2 = x * np.cos(st) - z * np.sin(st)
+    y2 = y
+    z2 = x * np.sin(st) + z * np.cos(st)
+
+    # Rotate by latitude around x-axis
+    t = np.pi / 2 - np.asarray(latitude, dtype=float) * np.pi / 180
+    x3 = x2
+    y3 = y2 * np.cos(t) - z2 * np.sin(t)
+    z3 = y2 * np.sin(t) + z2 * np.cos(t)
+
+    alt = -np.arcsin(y3)
+    az = np.arctan2(x3, -z3)
+    return [alt * 180 / np.pi, az * 180 / np.pi]  # [altitude, azimuth] of objects in degrees
+
+
+# Converts altitudes and azimuths into RAs and Decs
+# RA is returned in hours. All other angles should be in degrees.
+def ra_dec(alt, az, utc, latitude, longitude):
+    alt = np.asarray(alt, dtype=float) * np.pi / 180
+    az = np.asarray(az, dtype=float) * np.pi / 180
+    st = sidereal_time(utc) * np.pi / 12 + np.asarray(longitude, dtype=float) * np.pi / 180
+    x3 = np.sin(az) * np.cos(alt)
+    y3 = np.sin(-alt)
+    z3 = -np.cos(az) * np.cos(alt)
+
+    # Rotate by latitude around x-axis
+    t = np.pi / 2 - np.asarray(latitude, dtype=float) * np.pi / 180
+    x2 = x3
+    y2 = y3 * np.cos(t) + z3 * np.sin(t)
+    z2 = -y3 * np.sin(t) + z3 * np.cos(t)
+
+    # Rotate by hour angle around y-axis
+    x = x2 * np.cos(st) + z2 * np.sin(st)
+    y = y2
+    z = -x2 * np.sin(st) + z2 * np.cos(st)
+
+    dec = -np.arcsin(y)
+    ra = np.arctan2(x, z)
+    ra = np.where(ra < 0, ra + 2 * np.pi, ra)
+    return [ra * 12 / np.pi, dec * 180 / np.pi]
+
+
+# Returns the Julian Day numbers of calendar dates (British calendar). Years, months and days should be integers.
+def julian_day(year, month, day, hour, minute, sec):
+    year = np.asarray(year)
+    month = np.asarray(month)
+    day = np.asarray(day)
+    last_julian_day = 17520902.0
+    first_gregorian_day = 17520914.0
+    requested_date = 10000.0 * year + 100 * month + day
+
+    january_or_february = month <= 2
+    month = np.where(january_or_february, month + 12, month)
+    year = np.where(january_or_february, year - 1, year)
+
+    julian = requested_date <= last_julian_day
+    if np.any(~julian & (requested_date < first_gregorian_day)):
+        raise KeyError("The requested date never happened")
+    b = np.where(julian,
+                 -2 + ((year + 4716) // 4) - 1179,  # Julian calendar
+                 (year // 400) - (year // 100) + (year // 4))  # Gregorian calendar
+
+    jd = 365.0 * year - 679004.0 + 2400000.5 + b + np.floor(30.6001 * (month + 1)) + day
+    day_fraction = (np.fabs(hour) + np.fabs(minute) / 60.0 + np.fabs(sec) / 3600.0) / 24.0
+    return jd + day_fraction
+
+
+# Returns [year, month, day, hour, minute, sec] arrays for Julian Day numbers
+def inv_julian_day(jd):
+    jd = np.asarray(jd, dtype=float)
+    day_fraction = (jd + 0.5) - np.floor(jd + 0.5)
+    hour = np.floor(24 * day_fraction).astype(int)
+    minute = np.floor(np.fmod(1440 * day_fraction, 60)).astype(int)
+    sec = np.fmod(86400 * day_fraction, 60)
+
+    # Number of whole Julian days. b = Number of centuries since the Council of Nicaea.
+    # c = Julian Day number as if century leap years happened.
+    a = np.trunc(jd + 0.5).astype(int)
+    b = np.trunc((a - 1867216.25) / 36524.25).astype(int)
+    c = np.where(a < 2361222.0,
+                 a + 1524,  # Julian calendar
+                 a + b - (b // 4) + 1525)  # Gregorian calendar
+    # Number of 365.25 periods, starting the year at the end of February
+    d = np.trunc((c - 122.1) / 365.25).astype(int)
+    e_ = 365 * d + d // 4  # Number of days accounted for by these
+    f = np.trunc((c - e_) / 30.6001).astype(int)  # Number of 30.6001 days periods (a.k.a. months) in remainder
+    day = c - e_ - np.trunc(30.6001 * f).astype(int)
+    month = f - 1 - 12 * (f >= 14)
+    year = d - 4715 - (month >= 3)
+    return [year, month, day, hour, minute, sec]
+
+
+# Returns UTC timestamps from Julian Day numbers
+def utc_from_jd(jd):
+    return 86400.0 * (np.asarray(jd, dtype=float) - 2440587.5)
+
+
+def jd_from_utc(utc):
+    return (np.asarray(utc, dtype=float) / 86400.0) + 2440587.5
+
+
+# Return the right ascension and declination of the zenith, as a dictionary of arrays
+def get_zenith_position(lat, lng, utc):
+    st = sidereal_time(utc) * np.pi / 12
+    lat = np.asarray(lat, dtype=float) * np.pi / 180
+    lng = np.asarray(lng, dtype=float) * np.pi / 180
+    x = np.cos(lng + st) * np.cos(lat)
+    y = np.sin(lng + st) * np.cos(lat)
+    z = np.sin(lat)
+    ra = np.mod(np.arctan2(y, x) * 12 / np.pi, 24)
+    dec = np.arcsin(z / np.sqrt(x * x + y * y + z * z)) * 180 / np.pi
+    return {'ra': ra, 'dec': dec}
+
+
+# Check that these functions agree with those in mod_astro, and time them both
+def benchmark(count=1000000):
+    import mod_astro
+
+    rng = np.random.RandomState(0)
+    utc = rng.uniform(0, 2e9, count)
+    ra = rng.uniform(0, 24, count)
+    dec = rng.uniform(-90, 90, count)
+    lat = rng.uniform(-89, 89, count)
+    lng = rng.uniform(-180, 180, count)
+    jd = jd_from_utc(utc)
+    [year, month, day, hour, minute, sec] = inv_julian_day(jd)
+
+    tests = [
+        ['sun_pos', lambda i: mod_astro.sun_pos(utc[i]), lambda: sun_pos(utc)],
+        ['sidereal_time', lambda i: mod_astro.sidereal_time(utc[i]), lambda: sidereal_time(utc)],
+        ['alt_az', lambda i: mod_astro.alt_az(ra[i], dec[i], utc[i], lat[i], lng[i]),
+         lambda: alt_az(ra, dec, utc, lat, lng)],
+        ['ra_dec', lambda i: mod_astro.ra_dec(dec[i], ra[i] * 15, utc[i], lat[i], lng[i]),
+         lambda: ra_dec(dec, ra * 15, utc, lat, lng)],
+        ['julian_day', lambda i: mod_astro.julian_day(int(year[i]), int(month[i]), int(day[i]), int(hour[i]),
+                                                      int(minute[i]), sec[i]),
+         lambda: julian_day(year, month, day, hour, minute, sec)],
+        ['inv_julian_day', lambda i: mod_astro.inv_julian_day(jd[i]), lambda: inv_julian_day(jd)],
+        ['get_zenith_position', lambda i: mod_astro.get_zenith_position(lat[i], lng[i], utc[i]),
+         lambda: get_zenith_position(lat, lng, utc)],
+    ]
+
+    print "Comparing mod_astro and mod_astro_np over %d random inputs" % count
+    for [name, scalar, vector] in tests:
+        start = time.time()
+        scalar_results = [scalar(i) for i in xrange(count)]
+        scalar_time = time.time() - start
+        start = time.time()
+        vector_results = vector()
+        vector_time = time.time() - start
+
+        # Compare each of the values returned, allowing for RAs and azimuths which wrap around
+        if isinstance(vector_results, dict):
+            keys = sorted(vector_results.keys())
+            scalar_results = [[r[k] for k in keys] for r in scalar_results]
+            vector_results = [vector_results[k] for k in keys]
+        elif not isinstance(vector_results, list):
+            scalar_results = [[r] for r in scalar_results]
+            vector_results = [vector_results]
+        error = 0
+        for j, values in enumerate(vector_results):
+            diff = np.abs(np.array([r[j] for r in scalar_results]) - values)
+            error = max(error, np.max(np.minimum(diff, np.minimum(np.abs(diff - 24), np.abs(diff - 360)))))
+        print "%20s: scalar %8.3f s; vector %7.3f s; %7.1f times faster. Largest difference %.2e" % (
+            name, scalar_time, vector_time, scalar_time / max(vector_time, 1e-9), error)
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,181 @@
+# mod_coincidence.py
+# Meteor Pi, Cambridge Science Centre
+# Dominic Ford
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# This module finds moving objects which were seen at the same time by more than one observatory.
+#
+# Each trigger is an observation which lasted from obs_time until obs_time_end. Triggers whose time spans overlap, or
+# are separated by no more than a tolerance, are put in the same group, as are any triggers which overlap with those,
+# and so on. A group is a coincident detection if it includes triggers from observatories which are further apart than
+# a minimum baseline, so that the object can be triangulated.
+#
+# Triggers can either be grouped all at once, with CoincidenceDetector.find_groups(), or one at a time as they arrive,
+# with CoincidenceDetector.add() and CoincidenceDetector.close_before().
+
+import numpy as np
+
+import mod_geometry
+
+# Triggers separated by no more than this number of seconds are grouped together
+DEFAULT_TOLERANCE = 1
+
+# Groups are only returned if they include observatories more than this number of metres apart
+DEFAULT_MINIMUM_BASELINE = 400
+
+
+class BaselineMatrix:
+    def __init__(self, obstory_positions):
+        """
+        The distances between every pair of a set of observatories.
+
+        :param obstory_positions: Dictionary of [latitude, longitude] of each observatory, by observatory ID
+        """
+        self.obstory_ids = sorted(obstory_positions.keys())
+        self.index = dict((obstory_id, i) for i, obstory_id in enumerate(self.obstory_ids))
+
+        # The distances between points on the Earth's surface don't depend on the time we work them out for
+        positions = mod_geometry.PointArray.from_lat_lng(lat=[obstory_positions[i][0] for i in self.obstory_ids],
+                                                         lng=[obstory_positions[i][1] for i in self.obstory_ids],
+                                                         alt=0, utc=0).xyz
+        displacements = positions[:, np.newaxis, :] - positions[np.newaxis, :, :]
+        self.distances = np.sqrt(np.sum(displacements * displacements, axis=2))
+
+    def _indices(self, obstory_ids):
+        try:
+            return [self.index[obstory_id] for obstory_id in obstory_ids]
+        except KeyError as e:
+            raise ValueError("No position known for observatory %s" % e)
+
+    def distance(self, obstory_id_1, obstory_id_2):
+        """
+        Return the distance between two observatories, in metres.
+        """
+        [i, j] = self._indices([obstory_id_1, obstory_id_2])
+        return float(self.distances[i, j])
+
+    def maximum_baseline(self, obstory_ids):
+        """
+        Return the greatest distance between any pair of a list of observatories, in metres.
+
+        :param obstory_ids: List of observatory IDs
+        :return: The distance, which is zero if there are fewer than two observatories
+        :raises ValueError: If any of the observatories is not in this matrix
+        """
+        indices = self._indices(obstory_ids)
+        return float(np.max(self.distances[np.ix_(indices, indices)]))
+
+
+class CoincidenceDetector:
+    def __init__(self, baselines, tolerance=DEFAULT_TOLERANCE, minimum_baseline=DEFAULT_MINIMUM_BASELINE):
+        """
+        Group triggers which were seen at the same time by several observatories.
+
+        :param BaselineMatrix baselines: The distances between the observatories which saw the triggers
+        :param tolerance: Triggers separated by no more than this number of seconds are grouped together
+        :param minimum_baseline: Groups are only returned if they include observatories more than this number of
+            metres apart
+        """
+        self.baselines = baselines
+        self.tolerance = tolerance
+        self.minimum_baseline = minimum_baseline
+        self.open_groups = []
+
+    def add(self, trigger):
+        """
+        Add a trigger to the group it overlaps with, if any, or start a new group. If it overlaps with several groups,
+        they are merged.
+
+        :param trigger: An object with attributes obs_time, obs_time_end and obstory_id, such as a
+            meteorpi_model.Observation whose obs_time_end has been set
+        :return: None
+        """
+        start = trigger.obs_time
+        end = trigger.obs_time_end
+        group = {'start': start, 'end': end, 'triggers': [trigger]}
+        still_open = []
+        for other in self.open_groups:
+            if (start <= other['end'] + self.tolerance) and (end >= other['start'] - self.tolerance):
+                group['start'] = min(group['start'], other['start'])
+                group['end'] = max(group['end'], other['end'])
+                group['triggers'].extend(other['triggers'])
+            else:
+                still_open.append(other)
+        still_open.append(group)
+        self.open_groups = still_open
+
+    def close_before(self, utc):
+        """
+        Finish all of the groups which no trigger starting at or after a given time could join, and return those
+        which are coincident detections. When adding triggers as they arrive, call this with a time before which no
+        more triggers will start.
+
+        :param utc: The earliest time at which any trigger yet to be added could start
+        :return: List of the coincident detections, as returned by find_groups()
+        """
+        finished = [group for group in self.open_groups if group['end'] + self.tolerance < utc]
+        self.open_groups = [group for group in self.open_groups if group['end'] + self.tolerance >= utc]
+        return self._coincidences(finished)
+
+    def flush(self):
+        """
+        Finish all of the groups, and return those which are coincident detections.
+
+        :return: List of the coincident detections, as returned by find_groups()
+        """
+        finished = self.open_groups
+        self.open_groups = []
+        return self._coincidences(finished)
+
+    def _coincidences(self, finished):
+        output = []
+        for group in sorted(finished, key=lambda g: g['start']):
+            triggers = sorted(group['triggers'], key=lambda t: t.obs_time)
+            obstory_list = []
+            for trigger in triggers:
+                if trigger.obstory_id not in obstory_list:
+                    obstory_list.append(trigger.obstory_id)
+            if len(obstory_list) < 2:
+                continue
+            if self.baselines.maximum_baseline(obstory_list) <= self.minimum_baseline:
+                continue
+            output.append({'time': (group['start'] + group['end']) / 2,
+                           'time_spread': group['end'] - group['start'],
+                           'obstory_list': obstory_list,
+                           'triggers': triggers})
+        return output
+
+    def find_groups(self, triggers):
+        """
+        Find all of the coincident detections among a list of triggers, in time order. Any groups which are open
+        from previous calls to add() are finished first.
+
+        :param triggers: List of objects with attributes obs_time, obs_time_end and obstory_id
+        :return: List of dictionaries of the 'time' at the middle of each coincident detection, its 'time_spread', the
+            'obstory_list' of observatories which saw it, and the 'triggers' which make it up, in time order
+        :raises ValueError: If any of the observatories is not in the BaselineMatrix
+        """
+        output = self.flush()
+        for trigger in sorted(triggers, key=lambda t: t.obs_time):
+            output.extend(self.close_before(trigger.obs_time))
+            self.add(trigger)
+        output.extend(self.flush())
+        return output
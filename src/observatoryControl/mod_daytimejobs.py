@@ -46,26 +46,33 @@ if mod_settings.settings['i_am_a_rpi']:
     rawVidToMp4 = "timeout 2m %(binary_path)s/rawvid2mp4_openmax       %(input)s /tmp/pivid_%(pid)s.h264 ; " \
                   "avconv -i \"/tmp/pivid_%(pid)s.h264\" -c:v copy -f mp4 %(filename_out)s.mp4 ; " \
                   "rm /tmp/pivid_%(pid)s.h264"
+    rawVidToMp4Resources = ['openmax']
 else:
     rawVidToMp4 = "%(binary_path)s/rawvid2mp4_libav %(input)s %(filename_out)s.mp4"
+    rawVidToMp4Resources = []
 
 # The list dayTimeTasks is a list of all of the jobs that need to be done in the day time.
 # Each task is defined as a list of properties
 
 # 0. Name. This is the name of the task. It will have an associated high water mark in the database.
 # 1. Nmax. Maximum number of copies of this job which can run in parallel.
-#          NB: OpenMAX can only be used by one process at a time
-# 2. Folder of input files which need processing
-# 3. Folder to put output files into
-# 4. The file extension we should look for to identify the files we need to process
-# 5. The file extension which gets given to output files (so we can identify jobs already done)
-# 6. The shell command we use to do this job
+# 2. A list of the kinds of file this task is applied to, each of which is a list of:
+#    a. Folder of input files which need processing
+#    b. Folders to put output files into
+#    c. The file extension we should look for to identify the files we need to process
+#    d. The file extension which gets given to output files (so we can identify jobs already done)
+#    e. The shell command we use to do this job
+# 3. Optionally, a dictionary of further options:
+#    resources -- a list of resources which each job needs exclusive use of.
+#                 NB: OpenMAX can only be used by one process at a time
+#    timeout -- the number of seconds after which a job is killed, if not the default in mod_settings
 
 dayTimeTasks = [
     [
         'rawvideo',
         1,
-        [['rawvideo', ['triggers_raw_nonlive', 'timelapse_raw_nonlive'], 'h264', '???', rawH264ToTriggers]]
+        [['rawvideo', ['triggers_raw_nonlive', 'timelapse_raw_nonlive'], 'h264', '???', rawH264ToTriggers]],
+        {'timeout': 6 * 3600}
     ], [
         'triggers_rawimg',
         3,
@@ -76,10 +83,11 @@ dayTimeTasks = [
          ]
     ], [
         'triggers_rawvid',
-        1,
+        3,
         [['triggers_raw_nonlive', ['triggers_vid_processed'], 'vid', 'mp4', rawVidToMp4],
          ['triggers_raw_live', ['triggers_vid_processed'], 'vid', 'mp4', rawVidToMp4]
-         ]
+         ],
+        {'resources': rawVidToMp4Resources}
     ], [
         'timelapse_rawimg',
         3,
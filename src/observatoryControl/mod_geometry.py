@@ -0,0 +1,432 @@
+# mod_geometry.py
+# Meteor Pi, Cambridge Science Centre
+# Dominic Ford
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# This module contains versions of the Point, Vector, Line and Plane classes in mod_astro which hold many points,
+# vectors, lines or planes at once, stored as Nx3 NumPy arrays. Their methods have the same names and arguments as
+# those in mod_astro, and operate on every row at once. An array with a single row is broadcast against one with many
+# rows, so that, for example, the closest approach of one trajectory to many sight lines can be found in one call.
+#
+# Each class can be made from a list of the corresponding mod_astro objects, and indexing it returns a mod_astro object
+# holding the values in that row.
+#
+# Run this module as a script to check that it agrees with mod_astro, and to compare their speeds.
+
+import sys
+import time
+
+import numpy as np
+
+import mod_astro
+import mod_astro_np
+
+r_earth = 6371e3
+
+
+# Return the row-by-row dot product of two Nx3 arrays
+def _dot(a, b):
+    return np.sum(a * b, axis=1)
+
+
+# Return the length of each row of an Nx3 array
+def _mag(a):
+    return np.sqrt(np.sum(a * a, axis=1))
+
+
+# Return the angle, in degrees, between each pair of rows of two Nx3 arrays
+def _angle(a, b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        angle_cosine = _dot(a, b) / _mag(a) / _mag(b)
+    # Avoid domain errors in inverse cosine
+    return np.arccos(np.clip(angle_cosine, -1, 1)) * 180 / np.pi
+
+
+# Turn x, y and z, each of which may be a number or an array, into an Nx3 array
+def _stack(x, y, z):
+    x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+                                  np.asarray(z, dtype=float))
+    return np.column_stack([x.ravel(), y.ravel(), z.ravel()])
+
+
+class PointArray:
+    def __init__(self, xyz):
+        """
+        An array of points.
+        :param xyz: Nx3 array of the positions of the points
+        :return:
+        """
+        self.xyz = np.atleast_2d(np.asarray(xyz, dtype=float))
+
+    def __len__(self):
+        return self.xyz.shape[0]
+
+    def __getitem__(self, i):
+        return mod_astro.Point(*[float(k) for k in self.xyz[i]])
+
+    def __str__(self):
+        return "PointArray(%s)" % self.xyz.tolist()
+
+    @staticmethod
+    def from_points(points):
+        """
+        Make an array from a list of Points
+        :param list[Point] points:
+        :return PointArray:
+        """
+        return PointArray([[p.x, p.y, p.z] for p in points])
+
+    def to_vector(self):
+        return VectorArray(self.xyz)
+
+    def add_vector(self, other):
+        """
+        Add Vectors to these points
+        :param VectorArray other:
+        :return PointArray:
+        """
+        return PointArray(self.xyz + other.xyz)
+
+    def displacement_vector_from(self, other):
+        """
+        Returns the Vector displacements of these points from others.
+        :param PointArray other:
+        :return VectorArray:
+        """
+        return VectorArray(self.xyz - other.xyz)
+
+    def displacement_from_origin(self):
+        """
+        Returns the vector displacements of these points from the origin.
+        :return VectorArray:
+        """
+        return VectorArray(self.xyz)
+
+    def __abs__(self):
+        """
+        Returns the distances of these points from the origin
+        :return array:
+        """
+        return _mag(self.xyz)
+
+    @staticmethod
+    def from_lat_lng(lat, lng, alt, utc):
+        """
+        Returns the positions of points on the Earth's surface, in the frame of the Earth's geocentre, as
+        Point.from_lat_lng(). Any of the arguments may be arrays.
+        :return PointArray:
+        """
+        lat = np.asarray(lat, dtype=float) * np.pi / 180
+        lng = np.asarray(lng, dtype=float) * np.pi / 180
+        st = np.asarray(mod_astro_np.sidereal_time(utc)) * np.pi / 12
+        r = r_earth + np.asarray(alt, dtype=float)
+        x = r * np.cos(lng + st) * np.cos(lat)
+        y = r * np.sin(lng + st) * np.cos(lat)
+        z = r * np.sin(lat)
+        return PointArray(_stack(x, y, z))
+
+    def to_lat_lng(self, utc):
+        """
+        Returns the latitudes, longitudes and altitudes of these points, as Point.to_lat_lng().
+        :param utc: Unix time, or array of times, for each point
+        :return Dict: Dictionary of arrays
+        """
+        mag = abs(self)
+        st = np.asarray(mod_astro_np.sidereal_time(utc)) * np.pi / 12
+        lat = np.arcsin(self.xyz[:, 2] / mag) * 180 / np.pi
+        lng = np.mod((np.arctan2(self.xyz[:, 1], self.xyz[:, 0]) - st) * 180 / np.pi, 360)
+        return {'lat': lat, 'lng': lng, 'alt': mag - r_earth}
+
+
+class VectorArray:
+    def __init__(self, xyz):
+        """
+        An array of vectors.
+        :param xyz: Nx3 array of the components of the vectors
+        :return:
+        """
+        self.xyz = np.atleast_2d(np.asarray(xyz, dtype=float))
+
+    def __len__(self):
+        return self.xyz.shape[0]
+
+    def __getitem__(self, i):
+        return mod_astro.Vector(*[float(k) for k in self.xyz[i]])
+
+    def __str__(self):
+        return "VectorArray(%s)" % self.xyz.tolist()
+
+    @staticmethod
+    def from_vectors(vectors):
+        """
+        Make an array from a list of Vectors
+        :param list[Vector] vectors:
+        :return VectorArray:
+        """
+        return VectorArray([[v.x, v.y, v.z] for v in vectors])
+
+    def __add__(self, other):
+        return VectorArray(self.xyz + other.xyz)
+
+    def __sub__(self, other):
+        return VectorArray(self.xyz - other.xyz)
+
+    def __mul__(self, other):
+        """
+        Multiply these Vectors by a scalar, or by an array of scalars, one for each Vector
+        :param other:
+        :return VectorArray:
+        """
+        return VectorArray(self.xyz * np.reshape(np.asarray(other, dtype=float), (-1, 1)))
+
+    def __div__(self, other):
+        """
+        Divide these Vectors by a scalar, or by an array of scalars, one for each Vector
+        :param other:
+        :return VectorArray:
+        """
+        return VectorArray(self.xyz / np.reshape(np.asarray(other, dtype=float), (-1, 1)))
+
+    __truediv__ = __div__
+
+    def __abs__(self):
+        """
+        Returns the magnitudes (i.e. lengths) of these Vectors.
+        :return array:
+        """
+        return _mag(self.xyz)
+
+    @staticmethod
+    def from_ra_dec(ra, dec):
+        """
+        Converts (RA, Dec) pairs into unit vectors.
+        :param ra: Right ascensions / hours
+        :param dec: Declinations / degrees
+        :return VectorArray:
+        """
+        ra = np.asarray(ra, dtype=float) * np.pi / 12
+        dec = np.asarray(dec, dtype=float) * np.pi / 180
+        return VectorArray(_stack(np.cos(ra) * np.cos(dec), np.sin(ra) * np.cos(dec), np.sin(dec)))
+
+    def to_ra_dec(self):
+        """
+        Converts vectors into (RA, Dec) directions. Vectors of zero length have direction (0, 0).
+        :return Dict: Dictionary of arrays
+        """
+        mag = abs(self)
+        defined = mag > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dec = np.where(defined, np.arcsin(self.xyz[:, 2] / mag) * 180 / np.pi, 0)
+        ra = np.where(defined, np.mod(np.arctan2(self.xyz[:, 1], self.xyz[:, 0]) * 12 / np.pi, 24), 0)
+        return {'ra': ra, 'dec': dec}
+
+    def cross_product(self, other):
+        """
+        Returns the cross products of these vectors with others.
+        :param VectorArray other:
+        :return VectorArray:
+        """
+        return VectorArray(np.cross(self.xyz, other.xyz))
+
+    def dot_product(self, other):
+        """
+        Returns the dot products of these Vectors with others.
+        :param VectorArray other:
+        :return array:
+        """
+        return _dot(self.xyz, other.xyz)
+
+    def angle_with(self, other):
+        """
+        Returns the angles between these Vectors and others
+        :param VectorArray other:
+        :return array: Angles between direction vectors (degrees)
+        """
+        return _angle(self.xyz, other.xyz)
+
+    def normalise(self):
+        """
+        Return the unit vectors in the same directions as these vectors
+        :return VectorArray:
+        """
+        return VectorArray(self.xyz / _mag(self.xyz)[:, np.newaxis])
+
+
+class LineArray:
+    def __init__(self, x0, direction):
+        """
+        Equations of lines, in the form x = x0 + i*direction
+        :param PointArray x0:
+        :param VectorArray direction:
+        :return:
+        """
+        self.x0 = x0
+        self.direction = direction
+
+    def __len__(self):
+        return max(len(self.x0), len(self.direction))
+
+    def __getitem__(self, i):
+        return mod_astro.Line(x0=self.x0[i if len(self.x0) > 1 else 0],
+                              direction=self.direction[i if len(self.direction) > 1 else 0])
+
+    def __str__(self):
+        return "LineArray( x0=%s, direction=%s)" % (self.x0, self.direction)
+
+    @staticmethod
+    def from_lines(lines):
+        """
+        Make an array from a list of Lines
+        :param list[Line] lines:
+        :return LineArray:
+        """
+        return LineArray(x0=PointArray.from_points([line.x0 for line in lines]),
+                         direction=VectorArray.from_vectors([line.direction for line in lines]))
+
+    def point(self, i):
+        """
+        Returns a point on each line.
+        :param i: Position along the lines, or an array of positions, one for each line
+        :return PointArray:
+        """
+        return self.x0.add_vector(self.direction * i)
+
+    def to_plane(self, other):
+        """
+        Returns the planes containing these lines and other direction vectors.
+        :param VectorArray other:
+        :return PlaneArray:
+        """
+        normal = self.direction.cross_product(other)
+        p = -normal.dot_product(self.x0.displacement_from_origin())
+        return PlaneArray(normal=normal, p=p)
+
+    def find_closest_approach(self, other):
+        """
+        Find the points of closest approach between these lines and others, as Line.find_closest_approach(). The
+        direction vectors of the lines should be unit vectors. Parallel lines give NaNs.
+        :param LineArray other:
+        :return Dict: Dictionary of PointArrays 'self_point' and 'other_point', and arrays 'distance' and
+        'angular_distance'
+        """
+
+        # https://books.google.co.uk/books?id=NKONAgAAQBAJ&pg=PA20#v=onepage&q&f=false
+
+        p1 = self.x0.xyz
+        p2 = other.x0.xyz
+        r = self.direction.xyz
+        d = other.direction.xyz
+
+        p1_minus_p2 = p1 - p2
+        d_dot_r = _dot(d, r)
+        p1_minus_p2_dot_r = _dot(p1_minus_p2, r)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mu = (_dot(p1_minus_p2, d) - p1_minus_p2_dot_r * d_dot_r) / (1 - d_dot_r * d_dot_r)
+        lambda_ = mu * d_dot_r - p1_minus_p2_dot_r
+
+        self_point = p1 + r * lambda_[:, np.newaxis]
+        other_point = p2 + d * mu[:, np.newaxis]
+
+        return {'self_point': PointArray(self_point), 'other_point': PointArray(other_point),
+                'distance': _mag(self_point - other_point), 'angular_distance': _angle(self_point, other_point)}
+
+
+class PlaneArray:
+    def __init__(self, normal, p):
+        """
+        Equations of planes, in the form n.x+p = 0
+        :param VectorArray normal:
+        :param p: Array of the constant p for each plane
+        :return:
+        """
+        self.normal = normal
+        self.p = np.atleast_1d(np.asarray(p, dtype=float))
+
+    def __len__(self):
+        return max(len(self.normal), len(self.p))
+
+    def __getitem__(self, i):
+        return mod_astro.Plane(normal=self.normal[i if len(self.normal) > 1 else 0],
+                               p=float(self.p[i if len(self.p) > 1 else 0]))
+
+    def __str__(self):
+        return "PlaneArray( normal=%s, p=%s)" % (self.normal, self.p.tolist())
+
+    def perpendicular_distance_to_point(self, other):
+        """
+        Calculate the perpendicular distances of points from these planes
+        :param PointArray other:
+        :return array:
+        """
+        return self.normal.dot_product(other.displacement_from_origin()) + self.p
+
+    def line_of_intersection(self, other):
+        """
+        Find the lines of intersection between these planes and others. Where Plane.line_of_intersection() would
+        return None, because no sample point can be found, the line's x0 is NaN.
+        :param PlaneArray other:
+        :return LineArray:
+        """
+        direction = self.normal.cross_product(other.normal).xyz
+        mag = _mag(direction)
+
+        # Normalise direction vectors
+        direction = np.where(mag[:, np.newaxis] > 0, direction / np.where(mag > 0, mag, 1)[:, np.newaxis], direction)
+
+        n = self.normal.xyz
+        n2 = other.normal.xyz
+        p = self.p
+        p2 = other.p
+
+        # Now find a sample point which is in both planes
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denominator = n2[:, 0] * n[:, 1] - n[:, 0] * n2[:, 1]
+            denominator = np.where(denominator == 0, np.nan, denominator)
+            y = (n[:, 0] * p2 - n2[:, 0] * p) / denominator
+            x = (n[:, 1] * p2 - n2[:, 1] * p) / -denominator
+
+        return LineArray(x0=PointArray(_stack(x, y, 0)), direction=VectorArray(direction))
+
+
+# Check that the closest approach of one line to many agrees with mod_astro, and time them both
+def benchmark(count=100000):
+    rng = np.random.RandomState(0)
+    trajectory = mod_astro.Line(x0=mod_astro.Point(1e5, 2e5, 0), direction=mod_astro.Vector.from_ra_dec(3.5, 20))
+    lines = LineArray(x0=PointArray.from_lat_lng(lat=rng.uniform(50, 55, count), lng=rng.uniform(-5, 2, count),
+                                                 alt=0, utc=1.4e9),
+                      direction=VectorArray.from_ra_dec(rng.uniform(0, 24, count), rng.uniform(-90, 90, count)))
+    line_list = [lines[i] for i in xrange(count)]
+
+    start = time.time()
+    scalar_results = [trajectory.find_closest_approach(line)['angular_distance'] for line in line_list]
+    scalar_time = time.time() - start
+    start = time.time()
+    vector_results = LineArray.from_lines([trajectory]).find_closest_approach(lines)['angular_distance']
+    vector_time = time.time() - start
+
+    error = np.max(np.abs(np.array(scalar_results) - vector_results))
+    print "Closest approach of one line to %d lines: scalar %8.3f s; vector %7.3f s; %7.1f times faster. " \
+          "Largest difference %.2e" % (count, scalar_time, vector_time, scalar_time / max(vector_time, 1e-9), error)
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,161 @@
+# mod_inputindex.py
+# Meteor Pi, Cambridge Science Centre
+# Dominic Ford
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# This module keeps an index, in an SQLite database, of the input files which daytimeJobs.py might need to process,
+# together with the time each was made. This means that daytimeJobs.py can find the files which are newer than a high
+# water mark without listing every file in the data directory and parsing its name.
+#
+# The index is brought up to date by looking at the modification time of each directory, which changes whenever a file
+# is added to or removed from it; only directories which have changed since we last looked are listed again. A
+# directory which changed very recently, or which holds an empty file which may still be being written, is listed again
+# next time regardless.
+
+import os
+import time
+import sqlite3
+
+import mod_log
+
+# Directories modified less than this number of seconds before we list them are listed again next time, as files may
+# be added within the resolution of the filesystem's modification times
+MTIME_SETTLE_SECONDS = 5
+
+schema = """
+CREATE TABLE IF NOT EXISTS directories (
+  path   TEXT PRIMARY KEY,
+  parent TEXT,
+  mtime  REAL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+CREATE TABLE IF NOT EXISTS files (
+  path TEXT PRIMARY KEY,
+  dir  TEXT NOT NULL,
+  root TEXT NOT NULL,
+  ext  TEXT NOT NULL,
+  utc  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_root_ext_utc ON files (root, ext, utc);
+"""
+
+
+def filename_to_utc(f):
+    # Returns -1 for files whose names don't tell us when they were made, as mod_log.filename_to_utc() does
+    try:
+        return mod_log.filename_to_utc(f)
+    except ValueError:
+        return -1
+
+
+class InputIndex:
+    def __init__(self, index_path):
+        self.con = sqlite3.connect(index_path)
+        # Return paths as byte strings, like os.listdir() does, rather than unicode
+        self.con.text_factory = str
+        self.con.executescript(schema)
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def _forget(self, dir_name):
+        # Remove a directory which no longer exists from the index, along with everything in it
+        prefix = dir_name + os.sep
+        self.con.execute("DELETE FROM directories WHERE path=? OR substr(path, 1, ?)=?",
+                         (dir_name, len(prefix), prefix))
+        self.con.execute("DELETE FROM files WHERE dir=? OR substr(dir, 1, ?)=?", (dir_name, len(prefix), prefix))
+
+    def _list(self, root, dir_name, mtime):
+        # List a directory which has changed, recording any new files and forgetting those which have gone.
+        # Returns the list of its subdirectories
+        settled = mtime < time.time() - MTIME_SETTLE_SECONDS
+        known = set(row[0] for row in self.con.execute("SELECT path FROM files WHERE dir=?", (dir_name,)))
+        present = set()
+        subdirs = []
+        for f in os.listdir(dir_name):
+            path = os.path.join(dir_name, f)
+            if os.path.isdir(path):
+                subdirs.append(path)
+                continue
+            present.add(path)
+            if path in known:
+                continue
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            if size == 0:
+                # Files must have non-zero size to be processed. It may still be being written, and its size
+                # changing won't change the directory's modification time, so we need to look again next time.
+                present.discard(path)
+                settled = False
+                continue
+            ext = f.rsplit(".", 1)[1] if "." in f else ""
+            self.con.execute("INSERT INTO files (path, dir, root, ext, utc) VALUES (?, ?, ?, ?, ?)",
+                             (path, dir_name, root, ext, filename_to_utc(f)))
+        for path in known - present:
+            self.con.execute("DELETE FROM files WHERE path=?", (path,))
+        for row in self.con.execute("SELECT path FROM directories WHERE parent=?", (dir_name,)).fetchall():
+            if row[0] not in subdirs:
+                self._forget(row[0])
+        self.con.execute("INSERT OR REPLACE INTO directories (path, parent, mtime) VALUES (?, ?, ?)",
+                         (dir_name, os.path.dirname(dir_name), mtime if settled else None))
+        return subdirs
+
+    def scan(self, root):
+        """
+        Bring the index of the files within a directory, and its subdirectories, up to date.
+
+        :param root: The directory to scan, relative to the current working directory if it is a relative path
+        :return: None
+        """
+        stack = [root]
+        while stack:
+            dir_name = stack.pop()
+            try:
+                mtime = os.stat(dir_name).st_mtime
+            except OSError:
+                self._forget(dir_name)
+                continue
+            row = self.con.execute("SELECT mtime FROM directories WHERE path=?", (dir_name,)).fetchone()
+            if (row is not None) and (row[0] == mtime):
+                # Unchanged since we last listed it, but its subdirectories may have changed
+                stack.extend(r[0] for r in self.con.execute("SELECT path FROM directories WHERE parent=?",
+                                                            (dir_name,)))
+            else:
+                stack.extend(self._list(root=root, dir_name=dir_name, mtime=mtime))
+        self.con.commit()
+
+    def files_since(self, root, ext, utc_min):
+        """
+        List the files within a directory with a particular extension which were made at or after a given time. Call
+        scan() first to make sure that the index is up to date.
+
+        :param root: The directory, as passed to scan()
+        :param ext: The file extension, without the leading dot
+        :param utc_min: The earliest time of the files to return
+        :return: A list of [path, utc] for each file, in time order
+        """
+        return [list(row) for row in
+                self.con.execute("SELECT path, utc FROM files WHERE root=? AND ext=? AND utc>=? ORDER BY utc",
+                                 (root, ext, max(utc_min, 0)))]
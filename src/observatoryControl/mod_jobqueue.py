@@ -0,0 +1,179 @@
+# mod_jobqueue.py
+# Meteor Pi, Cambridge Science Centre
+# Dominic Ford
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# This module runs the shell commands which daytimeJobs.py uses to process files, several at once. A new job is started
+# as soon as another finishes, rather than waiting for a whole batch to finish, so that one slow job doesn't leave the
+# other cores idle. Jobs may need exclusive use of a resource, such as the OpenMAX hardware encoder, and jobs which run
+# for too long are killed.
+
+import os
+import time
+import signal
+import subprocess
+import multiprocessing
+
+from mod_log import log_txt, get_utc
+
+# Seconds between checks on whether running jobs have finished
+POLL_INTERVAL = 0.2
+
+# Seconds between reports on the progress of the queue
+REPORT_INTERVAL = 60
+
+# Seconds we wait for a job to exit after asking it to, before killing it outright
+KILL_GRACE_PERIOD = 10
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def cpu_time_of_children():
+    times = os.times()
+    return times[2] + times[3]
+
+
+class JobQueue:
+    """
+    Runs a list of jobs, each of which is a dictionary with a shell command 'cmd' and a unix time 'utc'. Jobs are
+    started in the order given, which should be time order, but a job which needs a resource that is in use may be
+    overtaken by later jobs. Each job may have a list of 'resources' which it needs exclusive use of.
+
+    When the queue has run, each job which finished has 'returncode' set, which is None if it was killed because it
+    ran for longer than the timeout.
+    """
+
+    def __init__(self, name, jobs, max_processes, timeout=None):
+        self.name = name
+        self.jobs = jobs
+        self.max_processes = max(1, max_processes)
+        self.timeout = timeout
+        self.queued = list(range(len(jobs)))
+        self.running = {}  # Popen objects by job index
+        self.finished = [False] * len(jobs)
+        self.resources_in_use = set()
+        self.failures = 0
+        self.timeouts = 0
+        self.start_time = time.time()
+        self.start_cpu = cpu_time_of_children()
+        self.busy_seconds = 0
+        self.last_report = self.start_time
+
+    def _start(self, index):
+        job = self.jobs[index]
+        print "Running command: %s" % job['cmd']
+        # Run each job in its own process group, so that it can be killed along with any processes it starts
+        process = subprocess.Popen(job['cmd'], shell=True, preexec_fn=os.setsid)
+        process.start_time = time.time()
+        process.kill_time = None
+        self.running[index] = process
+        self.resources_in_use.update(job.get('resources', []))
+
+    def _dispatch(self):
+        # Start the earliest queued jobs whose resources are free, until all our processes are busy
+        for index in list(self.queued):
+            if len(self.running) >= self.max_processes:
+                return
+            if self.resources_in_use.intersection(self.jobs[index].get('resources', [])):
+                continue
+            self.queued.remove(index)
+            self._start(index)
+
+    def _kill(self, process, sig):
+        try:
+            os.killpg(process.pid, sig)
+        except OSError:
+            pass
+
+    def _reap(self, on_finish):
+        # Collect jobs which have finished, and kill those which have run for too long
+        now = time.time()
+        for index, process in self.running.items():
+            returncode = process.poll()
+            if returncode is None:
+                if process.kill_time is None:
+                    if self.timeout and (now - process.start_time > self.timeout):
+                        log_txt("Killing job which has run for more than %d seconds: %s" %
+                                (self.timeout, self.jobs[index]['cmd']))
+                        self._kill(process, signal.SIGTERM)
+                        process.kill_time = now
+                elif now - process.kill_time > KILL_GRACE_PERIOD:
+                    self._kill(process, signal.SIGKILL)
+                continue
+            job = self.jobs[index]
+            del self.running[index]
+            self.resources_in_use.difference_update(job.get('resources', []))
+            self.busy_seconds += now - process.start_time
+            if process.kill_time is not None:
+                job['returncode'] = None
+                self.timeouts += 1
+            else:
+                job['returncode'] = returncode
+                if returncode != 0:
+                    self.failures += 1
+            self.finished[index] = True
+            if on_finish is not None:
+                on_finish(job)
+
+    def utilisation(self):
+        """
+        Return the fraction of the time for which our processes have been busy, and the fraction of the CPU time
+        available on this computer which our jobs have used.
+        """
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        busy = self.busy_seconds + sum(time.time() - p.start_time for p in self.running.values())
+        cpu = cpu_time_of_children() - self.start_cpu
+        return busy / (elapsed * self.max_processes), cpu / (elapsed * cpu_count())
+
+    def report(self):
+        slots, cores = self.utilisation()
+        log_txt("Task group <%s>: %d jobs queued, %d running, %d finished (%d failed, %d timed out). "
+                "Processes %.0f%% busy; cores %.0f%% busy." %
+                (self.name, len(self.queued), len(self.running), sum(self.finished), self.failures, self.timeouts,
+                 slots * 100, cores * 100))
+        self.last_report = time.time()
+
+    def run(self, quit_time=None, on_finish=None):
+        """
+        Run the jobs. If quit_time passes, we stop starting new jobs, and wait for those running to finish.
+
+        :param quit_time: The unix time, as returned by mod_log.get_utc(), at which we must stop starting jobs
+        :param on_finish: A function called with each job when it finishes
+        :return: True if all of the jobs were run, or False if we ran out of time
+        """
+        while self.queued or self.running:
+            out_of_time = quit_time and (get_utc() > quit_time)
+            if out_of_time:
+                self.queued = []
+            self._reap(on_finish)
+            self._dispatch()
+            if time.time() - self.last_report > REPORT_INTERVAL:
+                self.report()
+            if self.running:
+                time.sleep(POLL_INTERVAL)
+        self.report()
+        return all(self.finished)
+
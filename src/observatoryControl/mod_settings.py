@@ -51,6 +51,48 @@ settings = {
     # The directory where meteorpi_db stores its files
     'dbFilestore': os.path.join(data_path, "db_filestore"),
 
+    # Flag telling us whether to produce thumbnails and other resized images when importing images into the database,
+    # rather than waiting for them to be requested by the web interface
+    'pregenerateDerivatives': False,
+
+    # The number of entities sent to each remote server in a single export request. Servers which don't support batched
+    # imports are sent entities one at a time regardless.
+    'exportBatchSize': 50,
+
+    # The number of export batches which may be in progress at once, and the maximum number in progress to any one
+    # remote server. With one worker, exports are sent one batch at a time.
+    'exportWorkers': 1,
+    'exportConnectionsPerTarget': 2,
+
+    # Relative share of each batch of exports given to each type of entity, and the number of seconds for which an
+    # exporter's claim on a batch lasts before other exporters may take it over
+    'exportPriorities': {'metadata': 4, 'observation': 2, 'file': 1},
+    'exportLeaseSeconds': 900,
+
+    # The maximum rate, in bytes per second, at which to send exports, or None for no limit. Different limits may be
+    # set for times of day when the connection is needed for other things, with a list of windows such as
+    # {'start_hour': 8, 'end_hour': 18, 'bytes_per_second': 20000, 'max_file_size': 1048576}, in local time.
+    'exportBytesPerSecond': None,
+    'exportWindows': [],
+
+    # Files are exported smallest first, in classes with these upper bounds in bytes, so images go before videos
+    'exportSizeClasses': [512 * 1024, 8 * 1024 * 1024],
+
+    # The speed of our internet connection in bytes per second, if known, used to estimate how long exports will take
+    'exportLinkBytesPerSecond': None,
+
+    # The maximum number of daytime jobs, such as encoding videos, which may run at once, or None for one per CPU core.
+    # Each task group in mod_daytimejobs may set a lower limit.
+    'daytimeJobsMaxProcesses': None,
+
+    # The SQLite database in which daytimeJobs.py keeps an index of the files in the data directory which it may need
+    # to process
+    'daytimeJobsIndex': os.path.join(data_path, "daytimeJobsIndex.sqlite"),
+
+    # The number of seconds after which a daytime job which hasn't finished is killed, unless its task group sets a
+    # different limit
+    'daytimeJobTimeout': 1800,
+
     # Flag telling us whether to hunt for meteors in real time, or record H264 video for subsequent analysis
     'realTime': True,
 
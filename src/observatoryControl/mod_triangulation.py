@@ -0,0 +1,223 @@
+# mod_triangulation.py
+# Meteor Pi, Cambridge Science Centre
+# Dominic Ford
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# This module fits a straight-line trajectory through space to the sight lines along which several observatories saw a
+# moving object. All positions are in metres, in the frame of the Earth's geocentre, as used by mod_astro.Point.
+#
+# The residual of each sight line is the angle, as seen by the observatory, between the sight line and the plane which
+# contains the observatory and the trajectory; that is, how far the object appears to be from where the trajectory
+# says it should have been seen. The sum of the squares of these is minimised by scipy.optimize.least_squares, with an
+# analytic Jacobian, starting from a trajectory fitted through the points where pairs of sight lines from different
+# observatories pass closest to one another.
+
+import multiprocessing
+
+import numpy as np
+import scipy.optimize
+
+import mod_geometry
+
+# Pairs of sight lines closer to parallel than this angle (degrees) are not used to make the initial guess
+MINIMUM_PAIR_ANGLE = 1
+
+
+# Return the row-by-row dot product of two Nx3 arrays
+def _dot(a, b):
+    return np.sum(a * b, axis=1)
+
+
+# Return two unit vectors which are perpendicular to a unit vector and to each other
+def _perpendicular_basis(u):
+    trial = np.array([1., 0, 0]) if abs(u[0]) < 0.9 else np.array([0, 1., 0])
+    e1 = np.cross(u, trial)
+    e1 /= np.linalg.norm(e1)
+    e2 = np.cross(u, e1)
+    return e1, e2
+
+
+def initial_guess(obs_positions, directions, stations):
+    """
+    Make a first guess at the trajectory of an object, without iteration. For every pair of sight lines seen by
+    different observatories, we find the midpoint of their closest approach, and fit a line through these points.
+
+    :param obs_positions: Nx3 array of the positions of the observatories at the time of each sighting
+    :param directions: Nx3 array of unit vectors along each sight line
+    :param stations: Array of N labels of which observatory made each sighting
+    :return: [x0, direction], a point on the trajectory and a unit vector along it, as arrays
+    :raises ValueError: If the sight lines don't include a usable pair from different observatories
+    """
+    stations = np.asarray(stations)
+    [i, j] = np.triu_indices(len(stations), 1)
+    use = stations[i] != stations[j]
+    [i, j] = [i[use], j[use]]
+
+    # Closest approach between each pair of lines, in terms of the distances lambda_ and mu along each of them
+    p1_minus_p2 = obs_positions[i] - obs_positions[j]
+    r = directions[i]
+    d = directions[j]
+    d_dot_r = _dot(d, r)
+    p1_minus_p2_dot_r = _dot(p1_minus_p2, r)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu = (_dot(p1_minus_p2, d) - p1_minus_p2_dot_r * d_dot_r) / (1 - d_dot_r * d_dot_r)
+    lambda_ = mu * d_dot_r - p1_minus_p2_dot_r
+
+    # Only use pairs which aren't close to parallel, and which meet in front of both observatories
+    use = (np.abs(d_dot_r) < np.cos(MINIMUM_PAIR_ANGLE * np.pi / 180)) & (lambda_ > 0) & (mu > 0)
+    if np.count_nonzero(use) < 2:
+        raise ValueError("Need at least two pairs of sight lines from different observatories which intersect")
+    midpoints = (obs_positions[i[use]] + r[use] * lambda_[use, np.newaxis] +
+                 obs_positions[j[use]] + d[use] * mu[use, np.newaxis]) / 2
+
+    # The best-fit line through the midpoints passes through their centroid, along their principal axis
+    x0 = np.mean(midpoints, axis=0)
+    direction = np.linalg.svd(midpoints - x0)[2][0]
+    return [x0, direction]
+
+
+def _trajectory(p, x0, e1, e2, u0):
+    # Parameters p are the displacement of the trajectory from x0 in the directions e1 and e2 (in km), and the
+    # tangent of the angle between its direction and u0 in the same two directions
+    a = x0 + 1000 * (p[0] * e1 + p[1] * e2)
+    v = u0 + p[2] * e1 + p[3] * e2
+    v_mag = np.linalg.norm(v)
+    return [a, v / v_mag, v_mag]
+
+
+def sight_line_residuals(x0, direction, obs_positions, directions):
+    """
+    Return the angle between each sight line and the plane containing its observatory and a trajectory.
+
+    :param x0: A point on the trajectory
+    :param direction: A unit vector along the trajectory
+    :param obs_positions: Nx3 array of the positions of the observatories at the time of each sighting
+    :param directions: Nx3 array of unit vectors along each sight line
+    :return: Array of the signed angles (radians)
+    """
+    normal = np.cross(x0 - obs_positions, direction)
+    normal_mag = np.sqrt(_dot(normal, normal))
+    return np.arcsin(np.clip(_dot(directions, normal) / normal_mag, -1, 1))
+
+
+def _residuals(p, x0, e1, e2, u0, obs_positions, directions):
+    [a, u, v_mag] = _trajectory(p, x0, e1, e2, u0)
+    return sight_line_residuals(a, u, obs_positions, directions)
+
+
+def _jacobian(p, x0, e1, e2, u0, obs_positions, directions):
+    [a, u, v_mag] = _trajectory(p, x0, e1, e2, u0)
+    a_minus_o = a - obs_positions
+    normal = np.cross(a_minus_o, u)
+    normal_mag = np.sqrt(_dot(normal, normal))
+    s = _dot(directions, normal) / normal_mag
+
+    # The derivative of s with respect to the normal vector, and thence with respect to a and u, since
+    # d(normal) = da x u + (a - o) x du
+    g = (directions - s[:, np.newaxis] * normal / normal_mag[:, np.newaxis]) / normal_mag[:, np.newaxis]
+    ds_da = np.cross(u, g)
+    ds_du = np.cross(g, a_minus_o)
+
+    # The derivatives of u = v / |v| with respect to the components of v along e1 and e2
+    du_dp2 = (e1 - u * np.dot(u, e1)) / v_mag
+    du_dp3 = (e2 - u * np.dot(u, e2)) / v_mag
+
+    jacobian = np.column_stack([1000 * np.dot(ds_da, e1), 1000 * np.dot(ds_da, e2),
+                                np.dot(ds_du, du_dp2), np.dot(ds_du, du_dp3)])
+
+    # Chain rule for the arcsin in the residual
+    return jacobian / np.sqrt(np.clip(1 - s * s, 1e-12, 1))[:, np.newaxis]
+
+
+def triangulate(obs_positions, directions, stations, utc=None):
+    """
+    Fit a straight-line trajectory to the sight lines along which several observatories saw an object.
+
+    :param obs_positions: Nx3 array of the positions of the observatories at the time of each sighting
+    :param directions: Nx3 array of unit vectors along each sight line
+    :param stations: Array of N labels of which observatory made each sighting
+    :param utc: Optional array of the times of each sighting. If given, the direction of the trajectory is chosen to
+        be the direction in which the object moved.
+    :return: Dictionary of the 'trajectory', as a mod_astro.Line; the 'residuals' of each sight line, as defined in
+        sight_line_residuals(), in degrees; 'closest_approach', the closest approach of the trajectory to each sight
+        line, as returned by mod_geometry.LineArray.find_closest_approach(); and 'success', False if the fit did not
+        converge
+    :raises ValueError: If the sight lines don't include a usable pair from different observatories
+    """
+    obs_positions = np.asarray(obs_positions, dtype=float)
+    directions = np.asarray(directions, dtype=float)
+    [x0, u0] = initial_guess(obs_positions, directions, stations)
+    [e1, e2] = _perpendicular_basis(u0)
+    args = (x0, e1, e2, u0, obs_positions, directions)
+
+    fit = scipy.optimize.least_squares(_residuals, np.zeros(4), jac=_jacobian, args=args, method='lm')
+    [a, u, v_mag] = _trajectory(fit.x, *args[:4])
+
+    trajectory = mod_geometry.LineArray(x0=mod_geometry.PointArray(a), direction=mod_geometry.VectorArray(u))
+    sight_lines = mod_geometry.LineArray(x0=mod_geometry.PointArray(obs_positions),
+                                         direction=mod_geometry.VectorArray(directions))
+    closest_approach = trajectory.find_closest_approach(sight_lines)
+
+    # Point the trajectory in the direction in which the object moved
+    if utc is not None:
+        utc = np.asarray(utc, dtype=float)
+        progress = np.dot(closest_approach['self_point'].xyz - a, u)
+        if np.sum((utc - np.mean(utc)) * (progress - np.mean(progress))) < 0:
+            u = -u
+            trajectory = mod_geometry.LineArray(x0=trajectory.x0, direction=mod_geometry.VectorArray(u))
+
+    return {'trajectory': trajectory[0],
+            'residuals': fit.fun * 180 / np.pi,
+            'closest_approach': closest_approach,
+            'success': fit.success}
+
+
+# Triangulate one problem, for triangulate_many(), returning None if it can't be done
+def _triangulate_worker(problem):
+    try:
+        return triangulate(**problem)
+    except ValueError:
+        return None
+
+
+def triangulate_many(problems, processes=None):
+    """
+    Triangulate many objects, in parallel across several processes.
+
+    :param problems: List of dictionaries of the arguments to pass to triangulate() for each object
+    :param processes: The number of processes to use. Defaults to the number of CPUs.
+    :return: List of the dictionaries returned by triangulate() for each object, or None for objects which could not
+        be triangulated
+    """
+    if processes is None:
+        try:
+            processes = multiprocessing.cpu_count()
+        except NotImplementedError:
+            processes = 1
+    processes = min(processes, len(problems))
+    if processes <= 1:
+        return [_triangulate_worker(problem) for problem in problems]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_triangulate_worker, problems)
+    finally:
+        pool.close()
+        pool.join()
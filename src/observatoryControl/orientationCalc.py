@@ -35,6 +35,7 @@ import meteorpi_db
 import meteorpi_model as mp
 
 import mod_astro
+import mod_astro_np
 import mod_gnomonic
 import mod_log
 from mod_log import log_txt
@@ -248,39 +249,43 @@ def orientation_calc(obstory_id, utc_to_study, utc_now, utc_must_stop=0):
         scale_x = 2 * math.atan(math.tan(float(test.group(1)) / 2 * deg) * (1 / fraction_x)) * rad
         scale_y = 2 * math.atan(math.tan(float(test.group(2)) / 2 * deg) * (1 / fraction_y)) * rad
 
-        # Work out alt-az of reported (RA,Dec) using known location of camera. Fits returned in degrees.
-        alt_az = mod_astro.alt_az(ra, dec, fit['f'].file_time,
-                                  obstory_status['latitude'], obstory_status['longitude'])
+        log_txt("%s PASS     : %s" % (log_prefix, log_msg))
+
+        # Store information about fit
+        fit.update({'fit': True, 'ra': ra, 'dec': dec, 'pa': celestial_pa, 'sx': scale_x, 'sy': scale_y})
+        fit_list.append(fit)
 
-        # Get celestial coordinates of the local zenith
-        ra_dec_zenith = mod_astro.get_zenith_position(obstory_status['latitude'],
-                                                      obstory_status['longitude'],
-                                                      fit['f'].file_time)
-        ra_zenith = ra_dec_zenith['ra']
-        dec_zenith = ra_dec_zenith['dec']
+    # Work out alt-az of the reported (RA,Dec) of every fit, using known location of camera, and the celestial
+    # coordinates of the local zenith at the time of each image, all at once. Fits returned in degrees.
+    utc_list = [fit['f'].file_time for fit in fit_list]
+    alt_az_array = mod_astro_np.alt_az([fit['ra'] for fit in fit_list], [fit['dec'] for fit in fit_list], utc_list,
+                                       obstory_status['latitude'], obstory_status['longitude'])
+    ra_dec_zenith = mod_astro_np.get_zenith_position(obstory_status['latitude'], obstory_status['longitude'],
+                                                     utc_list)
+
+    for i, fit in enumerate(fit_list):
+        alt_az = [float(alt_az_array[0][i]), float(alt_az_array[1][i])]
+        ra_zenith = float(ra_dec_zenith['ra'][i])
+        dec_zenith = float(ra_dec_zenith['dec'][i])
 
         # Work out the position angle of the zenith, counterclockwise from north, as measured at centre of frame
-        zenith_pa = mod_gnomonic.position_angle(ra, dec, ra_zenith, dec_zenith)
+        zenith_pa = mod_gnomonic.position_angle(fit['ra'], fit['dec'], ra_zenith, dec_zenith)
 
         # Calculate the position angle of the zenith, clockwise from vertical, at the centre of the frame
         # If the camera is roughly upright, this ought to be close to zero!
-        camera_tilt = zenith_pa - celestial_pa
+        camera_tilt = zenith_pa - fit['pa']
         while camera_tilt < -180:
             camera_tilt += 360
         while camera_tilt > 180:
             camera_tilt -= 360
 
-        log_txt("%s PASS     : %s" % (log_prefix, log_msg))
         log_txt("%s FIT      : RA: %7.2fh. Dec %7.2f deg. PA %6.1f deg. ScaleX %6.1f. ScaleY %6.1f. "
                 "Zenith at (%.2f h,%.2f deg). PA Zenith %.2f deg. "
                 "Alt: %7.2f deg. Az: %7.2f deg. Tilt: %7.2f deg." %
-                (log_prefix, ra, dec, celestial_pa, scale_x, scale_y, ra_zenith, dec_zenith, zenith_pa,
+                (log_prefix, fit['ra'], fit['dec'], fit['pa'], fit['sx'], fit['sy'], ra_zenith, dec_zenith, zenith_pa,
                  alt_az[0], alt_az[1], camera_tilt))
 
-        # Store information about fit
-        fit.update({'fit': True, 'ra': ra, 'dec': dec, 'pa': celestial_pa, 'sx': scale_x, 'sy': scale_y,
-                    'camera_tilt': camera_tilt})
-        fit_list.append(fit)
+        fit['camera_tilt'] = camera_tilt
         alt_az_list.append(alt_az)
 
     # Average the resulting fits
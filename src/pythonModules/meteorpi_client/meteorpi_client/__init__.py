@@ -23,15 +23,46 @@
 
 # Classes which interact with a remote Meteor Pi server
 
-import json
-
+import os
+import time
+import Queue
 import urllib
-
-from yaml import safe_load
+import hashlib
+import threading
 
 import types
 import requests
+import requests.adapters
 import meteorpi_model as model
+from meteorpi_model import serialisation
+
+# Size, in bytes, of the chunks in which file downloads are read and written
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Number of files downloaded at once by download_files(), by default
+DEFAULT_DOWNLOAD_WORKERS = 4
+
+# Number of times to retry a download which fails, resuming from where it stopped
+DOWNLOAD_RETRIES = 3
+
+# Seconds to wait for the server to respond, or to send more data, before retrying a download
+DOWNLOAD_TIMEOUT = 60
+
+# Minimum interval, in seconds, between progress reports while data is arriving
+PROGRESS_INTERVAL = 1.
+
+# Number of results fetched in each request by iter_observations() and iter_files(), by default
+DEFAULT_PAGE_SIZE = 500
+
+# HTTP statuses which indicate that the server is busy or restarting, so that a request should be retried
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# Seconds to wait before the first retry of a failed request; each further retry waits twice as long as the last
+DEFAULT_RETRY_BACKOFF = 0.5
+
+# Number of requests AsyncMeteorClient makes at once, and the number of times it retries each, by default
+DEFAULT_CONCURRENCY = 8
+DEFAULT_ASYNC_RETRIES = 3
 
 
 def _to_encoded_string(o):
@@ -47,13 +78,95 @@ def _to_encoded_string(o):
     _dict = o.__dict__
     if o.as_dict:
         _dict = o.as_dict()
-    return urllib.quote_plus(urllib.quote_plus(json.dumps(obj=_dict, separators=(',', ':'))))
+    return urllib.quote_plus(urllib.quote_plus(serialisation.dumps(_dict)))
+
+
+def _pooled_session(max_connections):
+    """
+    :param int max_connections:
+        The number of connections to each host to keep open
+    :return:
+        A requests Session which reuses connections, and can be shared between this many threads
+    :internal:
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _file_matches(record, file_path):
+    """
+    :return:
+        True if a file on disk is a complete copy of a FileRecord, judged by its MD5 sum if we know it, otherwise by its
+        size
+    :internal:
+    """
+    if not os.path.isfile(file_path):
+        return False
+    if record.file_md5:
+        return model.get_md5_hash(file_path) == record.file_md5.lower()
+    return os.path.getsize(file_path) == record.file_size
+
+
+class DownloadProgress(object):
+    """
+    Running totals describing the progress of :meth:`meteorpi_client.MeteorClient.download_files`, which passes an
+    instance to its progress callback and returns it when finished.
+
+    :ivar int files_total:
+        The number of files to download
+    :ivar int files_downloaded:
+        The number of files downloaded so far
+    :ivar int files_skipped:
+        The number of files which were already present, with the right MD5 sum, so weren't downloaded
+    :ivar int files_failed:
+        The number of files which couldn't be downloaded
+    :ivar int bytes_downloaded:
+        The number of bytes received so far
+    :ivar dict paths:
+        The path of each file downloaded or skipped, by file ID
+    :ivar dict errors:
+        A message describing why each failed file couldn't be downloaded, by file ID
+    """
+
+    def __init__(self, files_total):
+        self.files_total = files_total
+        self.files_downloaded = 0
+        self.files_skipped = 0
+        self.files_failed = 0
+        self.bytes_downloaded = 0
+        self.paths = {}
+        self.errors = {}
+        self.start_time = time.time()
+        self._last_report = 0
+        self._lock = threading.Lock()
+
+    @property
+    def files_done(self):
+        return self.files_downloaded + self.files_skipped + self.files_failed
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    @property
+    def bytes_per_second(self):
+        elapsed = self.elapsed
+        return self.bytes_downloaded / elapsed if elapsed > 0 else 0.
+
+    def __str__(self):
+        return '{0}/{1} files ({2} skipped, {3} failed), {4:.1f} MB at {5:.2f} MB/s'.format(
+            self.files_done, self.files_total, self.files_skipped, self.files_failed,
+            self.bytes_downloaded / 1048576., self.bytes_per_second / 1048576.)
 
 
 class MeteorClient(object):
     """Client for the Meteor Pi HTTP API. Use this to access a camera or central server."""
 
-    def __init__(self, base_url="https://meteorpi.cambridgesciencecentre.org/api"):
+    def __init__(self, base_url="https://meteorpi.cambridgesciencecentre.org/api", retries=0,
+                 retry_backoff=DEFAULT_RETRY_BACKOFF):
         """
         Create a new Meteor Pi client. Use this to access the data in your Meteor Pi server.
 
@@ -62,9 +175,43 @@ class MeteorClient(object):
             if your camera website is at 'https://myhost.com/camera' you'd use 'https://myhost.com/camera/api/' here.
             You might see a '#' symbol in your web browser address bar, ignore it and just use the bits of the URL
             before that point.
+        :param int retries:
+            the number of times to retry a request which fails because the server can't be reached or is busy
+        :param float retry_backoff:
+            the number of seconds to wait before the first retry, doubling with each further retry
         :return: a configured instance of the Meteor Pi client
         """
         self.base_url = base_url
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        # Reuses connections to the server between requests
+        self.session = _pooled_session(DEFAULT_DOWNLOAD_WORKERS)
+
+    def _request(self, method, url, **kwargs):
+        """
+        Make a request to the server, retrying with exponential backoff if it can't be reached or is busy
+
+        :param string method:
+            the HTTP method, e.g. 'get'
+        :param string url:
+            the URL to request
+        :param kwargs:
+            passed on to :meth:`requests.Session.request`
+        :return:
+            the response
+        :internal:
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.retries:
+                    return response
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt >= self.retries:
+                    raise
+            time.sleep(self.retry_backoff * (2 ** attempt))
+            attempt += 1
 
     def list_observatories(self):
         """
@@ -72,8 +219,8 @@ class MeteorClient(object):
 
         :return: a sequence of strings containing observatories IDs
         """
-        response = requests.get(self.base_url + '/obstories').text
-        return safe_load(response)
+        response = self._request('get', self.base_url + '/obstories').content
+        return serialisation.loads(response)
 
     def get_observatory_status(self, observatory_id, status_time=None):
         """
@@ -89,13 +236,12 @@ class MeteorClient(object):
             a dictionary, or None if there was either no observatory found.
         """
         if status_time is None:
-            response = requests.get(
-                self.base_url + '/obstory/{0}/statusdict'.format(observatory_id))
+            response = self._request('get', self.base_url + '/obstory/{0}/statusdict'.format(observatory_id))
         else:
-            response = requests.get(
-                self.base_url + '/obstory/{0}/statusdict/{1}'.format(observatory_id, str(status_time)))
+            response = self._request(
+                'get', self.base_url + '/obstory/{0}/statusdict/{1}'.format(observatory_id, str(status_time)))
         if response.status_code == 200:
-            d = safe_load(response.text)
+            d = serialisation.loads(response.content)
             if 'status' in d:
                 return d['status']
         return None
@@ -119,14 +265,13 @@ class MeteorClient(object):
         search_string = _to_encoded_string(search)
         url = self.base_url + '/obs/{0}'.format(search_string)
         # print url
-        response = requests.get(url)
-        response_object = safe_load(response.text)
+        response = self._request('get', url)
+        response_object = serialisation.loads(response.content)
         obs_dicts = response_object['obs']
         obs_count = response_object['count']
         return {'count': obs_count,
                 'events': [self._augment_observation_files(e)
-                           for e in (model.Observation.from_dict(d)
-                                     for d in obs_dicts)
+                           for e in serialisation.observation.from_dicts(obs_dicts)
                            ]
                 }
 
@@ -150,12 +295,411 @@ class MeteorClient(object):
         search_string = _to_encoded_string(search)
         url = self.base_url + '/files/{0}'.format(search_string)
         # print url
-        response = requests.get(url)
-        response_object = safe_load(response.text)
+        response = self._request('get', url)
+        response_object = serialisation.loads(response.content)
         file_dicts = response_object['files']
         file_count = response_object['count']
         return {'count': file_count,
-                'files': list((self._augment_file(f) for f in (model.FileRecord.from_dict(d) for d in file_dicts)))}
+                'files': [self._augment_file(f) for f in serialisation.file_record.from_dicts(file_dicts)]}
+
+    def iter_observations(self, search=None, page_size=DEFAULT_PAGE_SIZE, prefetch=True):
+        """
+        Iterate over every observation matching a search, newest first, fetching them from the server a page at a time.
+        Only a couple of pages are held in memory at once, so this can be used to work through the whole archive.
+        Observations are augmented in the same way as by search_observations().
+
+        :param search:
+            an instance of ObservationSearch. Its skip and limit are ignored; all matching observations are returned.
+        :param int page_size:
+            the number of observations to fetch in each request
+        :param Boolean prefetch:
+            if True, the next page is fetched in a background thread while the current one is being processed
+        :return:
+            a generator of :class:`meteorpi_model.Observation`
+        """
+        if search is None:
+            search = model.ObservationSearch()
+        for observation in self._iter_search(search=search, path='obs', results_key='obs',
+                                             codec=serialisation.observation, page_size=page_size, prefetch=prefetch):
+            yield self._augment_observation_files(observation)
+
+    def iter_files(self, search=None, page_size=DEFAULT_PAGE_SIZE, prefetch=True):
+        """
+        Iterate over every file record matching a search, newest first, fetching them from the server a page at a time.
+        Only a couple of pages are held in memory at once, so this can be used to work through the whole archive.
+        Files are augmented in the same way as by search_files().
+
+        :param search:
+            an instance of :class:`meteorpi_model.FileRecordSearch`. Its skip and limit are ignored; all matching files
+            are returned.
+        :param int page_size:
+            the number of files to fetch in each request
+        :param Boolean prefetch:
+            if True, the next page is fetched in a background thread while the current one is being processed
+        :return:
+            a generator of :class:`meteorpi_model.FileRecord`
+        """
+        if search is None:
+            search = model.FileRecordSearch()
+        for file_record in self._iter_search(search=search, path='files', results_key='files',
+                                             codec=serialisation.file_record, page_size=page_size, prefetch=prefetch):
+            yield self._augment_file(file_record)
+
+    def _iter_search(self, search, path, results_key, codec, page_size, prefetch):
+        """
+        Generate the results of a search one at a time, optionally fetching the next page in a background thread while
+        the caller works through the current one.
+
+        :internal:
+        """
+        pages = self._search_pages(search=search, path=path, results_key=results_key, codec=codec,
+                                   page_size=page_size)
+        if not prefetch:
+            for page in pages:
+                for item in page:
+                    yield item
+            return
+
+        # The fetching thread stays at most one page ahead, so that memory use doesn't depend on the size of the results
+        fetched = Queue.Queue(maxsize=1)
+        stopping = threading.Event()
+
+        def fetch():
+            try:
+                for page in pages:
+                    while not stopping.is_set():
+                        try:
+                            fetched.put(('page', page), timeout=1)
+                            break
+                        except Queue.Full:
+                            pass
+                    if stopping.is_set():
+                        return
+                item = ('end', None)
+            except Exception as e:
+                item = ('error', e)
+            while not stopping.is_set():
+                try:
+                    fetched.put(item, timeout=1)
+                    return
+                except Queue.Full:
+                    pass
+
+        thread = threading.Thread(target=fetch)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                kind, value = fetched.get()
+                if kind == 'error':
+                    raise value
+                if kind == 'end':
+                    return
+                for item in value:
+                    yield item
+        finally:
+            # Stop the fetching thread if the caller gives up before the end of the results
+            stopping.set()
+
+    def _search_pages(self, search, path, results_key, codec, page_size):
+        """
+        Generate successive pages of the results of a search, as lists of model objects. Servers which support it are
+        asked for each page following on from the last result of the previous one, which is fast however far through
+        the results we are; older servers are asked for each page by its offset.
+
+        :internal:
+        """
+        search = search.__class__.from_dict(search.as_dict())
+        search.limit = page_size
+        search.skip = 0
+        search_string = _to_encoded_string(search)
+        after = None
+        keyset = True
+        while True:
+            if keyset:
+                params = {'after': after} if after is not None else {}
+                response = self._request('get', self.base_url + '/{0}/{1}/page'.format(path, search_string),
+                                         params=params)
+                if response.status_code == 404 and after is None:
+                    # The server doesn't support this, so fall back to skip and limit
+                    keyset = False
+                    continue
+            else:
+                response = self._request('get', self.base_url + '/{0}/{1}'.format(path, _to_encoded_string(search)))
+            if response.status_code != 200:
+                raise ValueError("Server responded with status {0}".format(response.status_code))
+            response_object = serialisation.loads(response.content)
+            if 'error' in response_object:
+                raise ValueError(response_object['error'])
+            page = codec.from_dicts(response_object[results_key])
+            yield page
+            if keyset:
+                after = response_object.get('next')
+                if after is None:
+                    return
+            else:
+                if len(page) < page_size:
+                    return
+                search.skip += page_size
+
+    def batch_search(self, searches):
+        """
+        Run several searches in a single request to the server. This is considerably faster than calling
+        search_observations() or search_files() repeatedly, as the server runs all of the searches over one database
+        connection.
+
+        :param list searches:
+            a list of searches, each of which may be an instance of :class:`meteorpi_model.ObservationSearch`,
+            :class:`meteorpi_model.FileRecordSearch`, :class:`meteorpi_model.ObservationGroupSearch` or
+            :class:`meteorpi_model.ObservatoryMetadataSearch`
+        :return:
+            a list with one entry per search, in the same order. Each entry is a dictionary containing 'count', and a
+            list of results under the same key as is used by the corresponding single search method: 'events' for
+            observation searches, 'files' for file searches, 'obsgroups' for observation group searches and 'items'
+            for observatory metadata searches.
+        """
+        search_types = [(model.ObservationSearch, 'observation_search'),
+                        (model.FileRecordSearch, 'file_search'),
+                        (model.ObservationGroupSearch, 'obsgroup_search'),
+                        (model.ObservatoryMetadataSearch, 'metadata_search')]
+        items = []
+        for search in searches:
+            search_type = None
+            for search_class, name in search_types:
+                if isinstance(search, search_class):
+                    search_type = name
+            if search_type is None:
+                raise ValueError("Cannot run a batch search on a {0}".format(search.__class__.__name__))
+            items.append({'type': search_type, 'search': search.as_dict()})
+        response = self._request('post', self.base_url + '/search/batch', data=serialisation.dumps(items),
+                                 headers={'Content-Type': 'application/json'})
+        response_object = serialisation.loads(response.content)
+        if 'error' in response_object:
+            raise ValueError(response_object['error'])
+        output = []
+        for result in response_object['results']:
+            search_type = result['type']
+            if search_type == 'observation_search':
+                output.append({'count': result['count'],
+                               'events': [self._augment_observation_files(e)
+                                          for e in serialisation.observation.from_dicts(result['obs'])]})
+            elif search_type == 'file_search':
+                output.append({'count': result['count'],
+                               'files': [self._augment_file(f)
+                                         for f in serialisation.file_record.from_dicts(result['files'])]})
+            elif search_type == 'obsgroup_search':
+                output.append({'count': result['count'],
+                               'obsgroups': serialisation.obsgroup.from_dicts(result['obsgroups'])})
+            else:
+                output.append({'count': result['count'],
+                               'items': serialisation.obstory_metadata.from_dicts(result['items'])})
+        return output
+
+    def download_files(self, records, dest, workers=DEFAULT_DOWNLOAD_WORKERS, progress=None):
+        """
+        Download the content of many files at once, such as all the images from a night's observing. Files are
+        downloaded in parallel over a shared pool of connections. Each is written to a '.part' file which is renamed
+        once its MD5 sum has been checked, and if a download fails it is resumed from where it stopped, so calling this
+        method again after an interruption only fetches what is missing.
+
+        :param list records:
+            The :class:`meteorpi_model.FileRecord` objects whose content should be downloaded
+        :param string dest:
+            The directory to save files in, which is created if necessary. Each file is named by its ID, followed by its
+            file name if it has one.
+        :param int workers:
+            The number of files to download at once
+        :param progress:
+            Optionally, a function which is called with a :class:`meteorpi_client.DownloadProgress` as each file
+            finishes, and periodically while data is arriving. It is called from the download threads.
+        :return:
+            A :class:`meteorpi_client.DownloadProgress` describing what was downloaded, including the path of each file
+            and the reason any could not be downloaded
+        """
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+
+        def path_for(record):
+            return os.path.join(dest, record.id if record.file_name is None else
+                                '{0}_{1}'.format(record.id, os.path.basename(record.file_name)))
+
+        return self._download_many(records=records, path_for=path_for, workers=workers, progress=progress)
+
+    def _download_many(self, records, path_for, workers, progress):
+        """
+        Download the content of many files at once, as download_files() does
+
+        :param list records:
+            The :class:`meteorpi_model.FileRecord` objects whose content should be downloaded
+        :param path_for:
+            A function which is given each record and returns the path to save its content to
+        :param int workers:
+            The number of files to download at once
+        :param progress:
+            Optionally, a function which is called with a :class:`meteorpi_client.DownloadProgress` as each file
+            finishes, and periodically while data is arriving
+        :return:
+            A :class:`meteorpi_client.DownloadProgress`
+        :internal:
+        """
+        records = list(records)
+        totals = DownloadProgress(files_total=len(records))
+        jobs = Queue.Queue()
+        for record in records:
+            jobs.put(record)
+        session = _pooled_session(workers)
+
+        def report(force):
+            if progress is None:
+                return
+            with totals._lock:
+                if not force and time.time() - totals._last_report < PROGRESS_INTERVAL:
+                    return
+                totals._last_report = time.time()
+            progress(totals)
+
+        def received(byte_count):
+            with totals._lock:
+                totals.bytes_downloaded += byte_count
+            report(force=False)
+
+        def worker():
+            while True:
+                try:
+                    record = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                file_path = path_for(record)
+                try:
+                    downloaded = self._download_file(session=session, record=record, file_path=file_path,
+                                                     received=received)
+                except ValueError as e:
+                    with totals._lock:
+                        totals.files_failed += 1
+                        totals.errors[record.id] = str(e)
+                else:
+                    with totals._lock:
+                        if downloaded:
+                            totals.files_downloaded += 1
+                        else:
+                            totals.files_skipped += 1
+                        totals.paths[record.id] = file_path
+                report(force=True)
+
+        threads = [threading.Thread(target=worker) for i in range(max(1, min(workers, len(records))))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for thread in threads:
+                # Join with a timeout, so that the main thread still receives KeyboardInterrupt
+                while thread.is_alive():
+                    thread.join(1)
+        finally:
+            session.close()
+        return totals
+
+    def _file_url(self, record):
+        """
+        :return:
+            The URL of the content of a FileRecord, or None if the server doesn't have it
+        :internal:
+        """
+        if record.file_size is None:
+            return None
+        if record.file_name is not None:
+            return self.base_url + '/files/content/{0}/{1}'.format(record.id, record.file_name)
+        else:
+            return self.base_url + '/files/content/{0}'.format(record.id)
+
+    def _download_file(self, session, record, file_path, received=None):
+        """
+        Download the content of a FileRecord, resuming any partial download, unless it is already present
+
+        :param session:
+            The requests Session to use
+        :param FileRecord record:
+            The file to download
+        :param string file_path:
+            The path to save the file to
+        :param received:
+            Optionally, a function called with the number of bytes in each chunk received
+        :return:
+            True if the file was downloaded, or False if it was already present
+        :raises:
+            ValueError if the file couldn't be downloaded, or its MD5 sum was wrong, after several attempts
+        :internal:
+        """
+        if _file_matches(record, file_path):
+            return False
+        url = self._file_url(record)
+        if url is None:
+            raise ValueError("The server does not hold the content of file {0}".format(record.id))
+        part_path = file_path + '.part'
+        error = None
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            try:
+                md5 = self._fetch(session=session, url=url, record=record, part_path=part_path, received=received)
+            except (ValueError, IOError, requests.exceptions.RequestException) as e:
+                # Keep whatever we received, and resume from there
+                error = e
+                continue
+            if record.file_md5 and md5 != record.file_md5.lower():
+                os.remove(part_path)
+                error = "MD5 sum of downloaded file did not match"
+                continue
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            os.rename(part_path, file_path)
+            return True
+        raise ValueError("Could not download file {0}: {1}".format(record.id, error))
+
+    @staticmethod
+    def _fetch(session, url, record, part_path, received):
+        """
+        Make one attempt to download a file, appending to a partial download if there is one
+
+        :return:
+            The MD5 sum of the whole file
+        :internal:
+        """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        digest = hashlib.md5()
+        headers = {}
+        if offset > 0:
+            with open(part_path, 'rb') as part_file:
+                for block in iter(lambda: part_file.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    digest.update(block)
+            headers['Range'] = 'bytes={0}-'.format(offset)
+            # If the file has changed, the server ignores our Range header and sends all of it
+            if record.file_md5:
+                headers['If-Range'] = '"{0}"'.format(record.file_md5)
+        response = session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        try:
+            if response.status_code == 416:
+                # Our partial download is longer than the file, so start again
+                os.remove(part_path)
+                raise ValueError("Partial download was longer than the file")
+            if response.status_code == 206:
+                content_range = response.headers.get('Content-Range', '')
+                if not content_range.startswith('bytes {0}-'.format(offset)):
+                    raise ValueError("Server sent an unexpected range: {0}".format(content_range))
+                mode = 'ab'
+            elif response.status_code == 200:
+                digest = hashlib.md5()
+                mode = 'wb'
+            else:
+                raise ValueError("Server responded with status {0}".format(response.status_code))
+            with open(part_path, mode, DOWNLOAD_CHUNK_SIZE) as part_file:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if chunk:  # filter out keep-alive new chunks
+                        part_file.write(chunk)
+                        digest.update(chunk)
+                        if received is not None:
+                            received(len(chunk))
+        finally:
+            response.close()
+        return digest.hexdigest()
 
     def _augment_file(self, f):
         """
@@ -165,23 +709,12 @@ class MeteorClient(object):
         """
 
         def get_url(target):
-            if target.file_size is None:
-                return None
-            if target.file_name is not None:
-                return self.base_url + '/files/content/{0}/{1}'.format(target.file_id.hex, target.file_name)
-            else:
-                return self.base_url + '/files/content/{0}'.format(target.file_id.hex, )
+            return self._file_url(target)
 
         f.get_url = types.MethodType(get_url, f)
 
         def download_to(target, file_name):
-            url = target.get_url()
-            r = requests.get(url, stream=True)
-            with open(file_name, 'wb') as file_to_write:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        file_to_write.write(chunk)
-                        file_to_write.flush()
+            self._download_file(session=self.session, record=target, file_path=file_name)
             return file_name
 
         f.download_to = types.MethodType(download_to, f)
@@ -194,3 +727,112 @@ class MeteorClient(object):
         """
         e.file_records = [self._augment_file(f) for f in e.file_records]
         return e
+
+
+class AsyncMeteorClient(MeteorClient):
+    """
+    A version of :class:`meteorpi_client.MeteorClient` for making many requests at once, for example looking up the
+    status of an observatory at the time of each of thousands of observations. Each method takes the same arguments as
+    the corresponding method of MeteorClient, but returns a :class:`concurrent.futures.Future` of its result at once.
+    Requests are run by a pool of threads sharing a pool of connections to the server, so at most max_concurrency are
+    in progress at any time, and requests which fail because the server can't be reached or is busy are retried.
+    Results are decoded exactly as they are by MeteorClient.
+
+    The search iterators, iter_observations() and iter_files(), are inherited unchanged, and already fetch pages in the
+    background.
+    """
+
+    def __init__(self, base_url="https://meteorpi.cambridgesciencecentre.org/api", max_concurrency=DEFAULT_CONCURRENCY,
+                 retries=DEFAULT_ASYNC_RETRIES, retry_backoff=DEFAULT_RETRY_BACKOFF):
+        """
+        Create a new asynchronous Meteor Pi client
+
+        :param base_url:
+            the URL for the API, as for :class:`meteorpi_client.MeteorClient`
+        :param int max_concurrency:
+            the largest number of requests to make at once
+        :param int retries:
+            the number of times to retry a request which fails because the server can't be reached or is busy
+        :param float retry_backoff:
+            the number of seconds to wait before the first retry, doubling with each further retry
+        :raises:
+            ValueError if the concurrent.futures module isn't available; under Python 2 it is in the 'futures' package
+        """
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            raise ValueError("The 'futures' package is required to use AsyncMeteorClient")
+        MeteorClient.__init__(self, base_url=base_url, retries=retries, retry_backoff=retry_backoff)
+        self.session = _pooled_session(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def _submit(self, method, *args, **kwargs):
+        return self.executor.submit(method, self, *args, **kwargs)
+
+    def list_observatories(self):
+        """
+        :return: a Future of the result of :meth:`meteorpi_client.MeteorClient.list_observatories`
+        """
+        return self._submit(MeteorClient.list_observatories)
+
+    def get_observatory_status(self, observatory_id, status_time=None):
+        """
+        :return: a Future of the result of :meth:`meteorpi_client.MeteorClient.get_observatory_status`
+        """
+        return self._submit(MeteorClient.get_observatory_status, observatory_id, status_time)
+
+    def search_observations(self, search=None):
+        """
+        :return: a Future of the result of :meth:`meteorpi_client.MeteorClient.search_observations`
+        """
+        return self._submit(MeteorClient.search_observations, search)
+
+    def search_files(self, search=None):
+        """
+        :return: a Future of the result of :meth:`meteorpi_client.MeteorClient.search_files`
+        """
+        return self._submit(MeteorClient.search_files, search)
+
+    def batch_search(self, searches):
+        """
+        :return: a Future of the result of :meth:`meteorpi_client.MeteorClient.batch_search`
+        """
+        return self._submit(MeteorClient.batch_search, searches)
+
+    def download_files(self, records, dest, workers=DEFAULT_DOWNLOAD_WORKERS, progress=None):
+        """
+        :return: a Future of the result of :meth:`meteorpi_client.MeteorClient.download_files`
+        """
+        return self._submit(MeteorClient.download_files, records, dest, workers, progress)
+
+    def download_to(self, record, file_name):
+        """
+        Download the content of a single file, resuming a partial download and checking its MD5 sum, as
+        FileRecord.download_to does
+
+        :param FileRecord record:
+            the file to download
+        :param string file_name:
+            the path to save it to
+        :return:
+            a Future of the path, whose result() raises ValueError if the file couldn't be downloaded
+        """
+
+        def download():
+            self._download_file(session=self.session, record=record, file_path=file_name)
+            return file_name
+
+        return self.executor.submit(download)
+
+    def close(self):
+        """
+        Wait for any requests in progress to finish, then close the connections to the server
+        """
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
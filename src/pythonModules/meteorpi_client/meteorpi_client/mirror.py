@@ -0,0 +1,475 @@
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# Keeps a local copy of some or all of the archive held by a Meteor Pi server, in a MeteorDatabase and its file store.
+#
+# Each observatory is synced in slices of time, oldest first. For each slice we fetch the observatory's metadata and
+# observations from the server, download the content of any files we don't hold, several at once, and then write the
+# entities to the database in a single transaction, together with a high water mark recording that the slice is done.
+# The next run starts from the high water mark, less a look-back period to pick up data which reached the server late.
+# Entities we already hold are skipped and files already in the file store aren't downloaded again, so a run which is
+# interrupted can simply be started again.
+#
+# A file whose content can't be downloaded doesn't hold up the rest of the observatory. Its record is kept in a retry
+# list, a JSON file alongside the file store, and each run tries it again before syncing any new slices, until it has
+# failed a number of times, after which it is dropped from the list and a warning is logged.
+#
+# Run this module with --help to see how to use it from the command line.
+
+import os
+import sys
+import time
+import argparse
+from logging import getLogger, basicConfig, INFO
+
+import meteorpi_model as model
+from meteorpi_model import serialisation
+from meteorpi_client import MeteorClient, DEFAULT_DOWNLOAD_WORKERS, DEFAULT_PAGE_SIZE
+
+# The type of high water mark under which the progress of the mirror is recorded for each observatory
+DEFAULT_MARK_TYPE = 'mirror'
+
+# The user recorded as having created the entities written to the local database
+DEFAULT_USER_ID = 'mirror'
+
+# Length, in seconds, of the slices of time synced at once. The high water mark advances after each.
+DEFAULT_SLICE_SECONDS = 86400
+
+# Seconds before the high water mark at which each run starts, to pick up data which reached the server late
+DEFAULT_LOOKBACK_SECONDS = 2 * 86400
+
+# Number of items of observatory metadata fetched in each request
+METADATA_PAGE_SIZE = 1000
+
+# Number of runs on which we try to download a file before giving up on it
+DEFAULT_MAX_FILE_ATTEMPTS = 5
+
+logger = getLogger("meteorpi.client.mirror")
+
+
+class MirrorProgress(object):
+    """
+    Running totals describing what :meth:`meteorpi_client.mirror.MeteorMirror.sync_obstory` has done for one
+    observatory.
+
+    :ivar string obstory_id:
+        The ID of the observatory
+    :ivar int slices:
+        The number of slices of time synced
+    :ivar int metadata:
+        The number of items of observatory metadata written to the local database
+    :ivar int observations:
+        The number of observations written to the local database
+    :ivar int files:
+        The number of file records written to the local database
+    :ivar int files_failed:
+        The number of files whose content couldn't be downloaded, each of which is put on the retry list
+    :ivar int bytes_downloaded:
+        The number of bytes of file content downloaded
+    :ivar float high_water_mark:
+        The time up to which the observatory has been synced
+    """
+
+    def __init__(self, obstory_id):
+        self.obstory_id = obstory_id
+        self.slices = 0
+        self.metadata = 0
+        self.observations = 0
+        self.files = 0
+        self.files_failed = 0
+        self.bytes_downloaded = 0
+        self.high_water_mark = None
+        self.start_time = time.time()
+
+    def __str__(self):
+        return '{0}: {1} slices, {2} metadata, {3} observations, {4} files ({5} failed), {6:.1f} MB in {7:.0f}s'.format(
+            self.obstory_id, self.slices, self.metadata, self.observations, self.files, self.files_failed,
+            self.bytes_downloaded / 1048576., time.time() - self.start_time)
+
+
+class MirrorRetries(object):
+    """
+    The files, for each observatory, whose content couldn't be downloaded, held in a JSON file so that later runs can
+    try them again. Each entry holds the file record and the number of attempts made so far.
+
+    :ivar string path:
+        The path of the JSON file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                self._entries = serialisation.loads(f.read())
+
+    def get(self, obstory_id):
+        """
+        :return:
+            A list of (file record, attempts) tuples for the files of an observatory waiting to be retried
+        """
+        return [(model.FileRecord.from_dict(entry['file']), entry['attempts'])
+                for file_id, entry in sorted(self._entries.get(obstory_id, {}).items())]
+
+    def failed(self, obstory_id, file_record):
+        """
+        Record a failed attempt to download a file
+
+        :return:
+            The number of attempts made so far
+        """
+        entries = self._entries.setdefault(obstory_id, {})
+        attempts = entries.get(file_record.id, {}).get('attempts', 0) + 1
+        entries[file_record.id] = {'file': file_record.as_dict(), 'attempts': attempts}
+        return attempts
+
+    def remove(self, obstory_id, file_id):
+        entries = self._entries.get(obstory_id, {})
+        entries.pop(file_id, None)
+        if not entries:
+            self._entries.pop(obstory_id, None)
+
+    def save(self):
+        """
+        Write the list to disk, replacing the previous copy in one step
+        """
+        temp_path = self.path + '.tmp'
+        text = serialisation.dumps(self._entries)
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        with open(temp_path, 'wb') as f:
+            f.write(text)
+        os.rename(temp_path, self.path)
+
+
+class MeteorMirror(object):
+    """
+    Copies observatories' metadata, observations and files from a Meteor Pi server into a local database and file
+    store, fetching only what is new since the last sync.
+
+    :ivar MeteorClient client:
+        The client used to fetch data from the server
+    :ivar MeteorDatabase db:
+        The local database to write to
+    :ivar MirrorRetries retries:
+        The files whose content couldn't be downloaded, to be tried again
+    """
+
+    def __init__(self, client, db, obstory_ids=None, observation_types=None, semantic_types=None,
+                 user_id=DEFAULT_USER_ID, mark_type=DEFAULT_MARK_TYPE, workers=DEFAULT_DOWNLOAD_WORKERS,
+                 slice_seconds=DEFAULT_SLICE_SECONDS, lookback_seconds=DEFAULT_LOOKBACK_SECONDS, retry_path=None,
+                 max_file_attempts=DEFAULT_MAX_FILE_ATTEMPTS):
+        """
+        :param MeteorClient client:
+            The client used to fetch data from the server
+        :param MeteorDatabase db:
+            The local database to write to
+        :param list obstory_ids:
+            The IDs of the observatories to sync, or None to sync all of those on the server
+        :param list observation_types:
+            The types of observation to sync, or None to sync all of them
+        :param list semantic_types:
+            The semantic types of the files to sync, or None to sync all of them. Observations are synced whether or
+            not they have any files of these types.
+        :param string user_id:
+            The user recorded as having created the entities written to the local database
+        :param string mark_type:
+            The type of high water mark used to record progress. If you sync different selections of data into the same
+            database, give each its own type.
+        :param int workers:
+            The number of files to download at once
+        :param float slice_seconds:
+            The length of the slices of time synced at once
+        :param float lookback_seconds:
+            The number of seconds before the high water mark at which each sync starts
+        :param string retry_path:
+            The path of the JSON file listing files to download again. Defaults to one alongside the file store, named
+            after the mark type.
+        :param int max_file_attempts:
+            The number of runs on which we try to download a file before giving up on it
+        """
+        if slice_seconds <= 0:
+            raise ValueError("slice_seconds must be positive")
+        self.client = client
+        self.db = db
+        self.obstory_ids = obstory_ids
+        self.observation_types = observation_types
+        self.semantic_types = semantic_types
+        self.user_id = user_id
+        self.mark_type = mark_type
+        self.workers = workers
+        self.slice_seconds = slice_seconds
+        self.lookback_seconds = lookback_seconds
+        if retry_path is None:
+            retry_path = os.path.join(db.file_store_path, "../{0}_retries.json".format(mark_type))
+        self.retries = MirrorRetries(path=retry_path)
+        self.max_file_attempts = max_file_attempts
+
+    def sync(self, since=None, until=None):
+        """
+        Sync each selected observatory in turn. An observatory which fails is logged and skipped, and will be picked up
+        from its high water mark on the next run.
+
+        :param float since:
+            Optionally, the time from which to sync, overriding the high water marks
+        :param float until:
+            Optionally, the time up to which to sync. Defaults to now.
+        :return:
+            A dict of :class:`meteorpi_client.mirror.MirrorProgress` by observatory ID, holding None for each
+            observatory which couldn't be synced completely
+        """
+        obstories = self.client.list_observatories()
+        obstory_ids = self.obstory_ids if self.obstory_ids is not None else sorted(obstories.keys())
+        output = {}
+        for obstory_id in obstory_ids:
+            output[obstory_id] = None
+            if obstory_id not in obstories:
+                logger.warning("Observatory {0} is not on the server".format(obstory_id))
+                continue
+            try:
+                output[obstory_id] = self.sync_obstory(obstory_id=obstory_id, obstory_info=obstories[obstory_id],
+                                                       since=since, until=until)
+            except (ValueError, IOError):
+                logger.exception("Failed to sync observatory {0}".format(obstory_id))
+        return output
+
+    def sync_obstory(self, obstory_id, obstory_info, since=None, until=None):
+        """
+        Sync one observatory, a slice of time at a time, advancing its high water mark as each slice is committed
+
+        :param string obstory_id:
+            The ID of the observatory
+        :param dict obstory_info:
+            The observatory's entry in the dict returned by :meth:`meteorpi_client.MeteorClient.list_observatories`
+        :param float since:
+            Optionally, the time from which to sync, overriding the high water mark
+        :param float until:
+            Optionally, the time up to which to sync. Defaults to now.
+        :return:
+            A :class:`meteorpi_client.mirror.MirrorProgress`
+        :raises:
+            IOError if the server couldn't be reached. Files which couldn't be downloaded are added to the retry list.
+        """
+        progress = MirrorProgress(obstory_id=obstory_id)
+        obstory_name = self._register_obstory(obstory_id=obstory_id, obstory_info=obstory_info)
+        self._retry_files(obstory_id=obstory_id, progress=progress)
+        mark = self.db.get_high_water_mark(mark_type=self.mark_type, obstory_name=obstory_name)
+        progress.high_water_mark = mark
+        if since is None:
+            if mark is not None:
+                since = max(0, mark - self.lookback_seconds)
+            else:
+                # Nothing has been synced yet, so start from the first metadata the server holds for the observatory
+                since = max(0, obstory_info.get('firstSeen', 0) - self.slice_seconds)
+        if until is None:
+            until = time.time()
+        slice_start = since
+        while slice_start < until:
+            slice_end = min(slice_start + self.slice_seconds, until)
+            self._sync_slice(obstory_id=obstory_id, obstory_name=obstory_name, time_min=slice_start,
+                             time_max=slice_end, progress=progress)
+            # Don't move the mark backwards when re-syncing an old period
+            if mark is None or slice_end > mark:
+                mark = slice_end
+                self.db.set_high_water_mark(mark_type=self.mark_type, time=mark, obstory_name=obstory_name)
+            self.db.commit()
+            self.retries.save()
+            progress.slices += 1
+            progress.high_water_mark = mark
+            slice_start = slice_end
+        logger.info(str(progress))
+        return progress
+
+    def _download_files(self, obstory_id, files, progress):
+        """
+        Download the content of files and write their records to the database, without committing. Files which
+        couldn't be downloaded are added to the retry list, and dropped from it once they have failed too many times.
+        Files which were downloaded are removed from it.
+
+        :internal:
+        """
+        db = self.db
+        downloads = self.client._download_many(records=files, path_for=lambda record: db.file_path_for_id(record.id),
+                                                workers=self.workers, progress=None)
+        progress.bytes_downloaded += downloads.bytes_downloaded
+        for file_record in files:
+            if file_record.id in downloads.paths:
+                db.import_file(file_item=file_record, user_id=self.user_id)
+                self.retries.remove(obstory_id=obstory_id, file_id=file_record.id)
+                progress.files += 1
+                continue
+            progress.files_failed += 1
+            attempts = self.retries.failed(obstory_id=obstory_id, file_record=file_record)
+            error = downloads.errors.get(file_record.id)
+            if attempts >= self.max_file_attempts:
+                self.retries.remove(obstory_id=obstory_id, file_id=file_record.id)
+                logger.warning("Giving up on file {0} from {1} after {2} attempts: {3}".format(
+                    file_record.id, obstory_id, attempts, error))
+            else:
+                logger.warning("Could not download file {0} from {1}, will try again: {2}".format(
+                    file_record.id, obstory_id, error))
+
+    def _retry_files(self, obstory_id, progress):
+        """
+        Try again to download the files of an observatory in the retry list, committing those which arrive
+
+        :internal:
+        """
+        files = []
+        for file_record, attempts in self.retries.get(obstory_id):
+            # Files may have arrived by some other route since they were listed
+            if self.db.has_file_id(file_record.id):
+                self.retries.remove(obstory_id=obstory_id, file_id=file_record.id)
+            else:
+                files.append(file_record)
+        if files:
+            logger.info("Retrying {0} files from {1}".format(len(files), obstory_id))
+            self._download_files(obstory_id=obstory_id, files=files, progress=progress)
+        self.db.commit()
+        self.retries.save()
+
+    def _register_obstory(self, obstory_id, obstory_info):
+        """
+        Register an observatory in the local database if it isn't there already
+
+        :return:
+            The local name of the observatory
+        :internal:
+        """
+        if self.db.has_obstory_id(obstory_id):
+            return self.db.get_obstory_from_id(obstory_id)['name']
+        self.db.register_obstory(obstory_id=obstory_id, obstory_name=obstory_info['name'],
+                                 latitude=obstory_info['latitude'], longitude=obstory_info['longitude'])
+        self.db.commit()
+        return obstory_info['name']
+
+    def _fetch_metadata(self, obstory_id, time_min, time_max):
+        """
+        :return:
+            A list of all the observatory metadata items the server holds for an observatory in a period
+        :internal:
+        """
+        items = []
+        while True:
+            search = model.ObservatoryMetadataSearch(obstory_ids=[obstory_id], time_min=time_min, time_max=time_max,
+                                                     limit=METADATA_PAGE_SIZE, skip=len(items))
+            result = self.client.batch_search([search])[0]
+            items.extend(result['items'])
+            if not result['items'] or len(items) >= result['count']:
+                return items
+
+    def _fetch_observations(self, obstory_id, time_min, time_max):
+        """
+        :return:
+            A list of all the selected observations the server holds for an observatory in a period, each including its
+            file records
+        :internal:
+        """
+        observations = []
+        for observation_type in self.observation_types or [None]:
+            search = model.ObservationSearch(obstory_ids=[obstory_id], time_min=time_min, time_max=time_max,
+                                             observation_type=observation_type)
+            observations.extend(self.client.iter_observations(search=search, page_size=DEFAULT_PAGE_SIZE))
+        return observations
+
+    def _sync_slice(self, obstory_id, obstory_name, time_min, time_max, progress):
+        """
+        Copy everything we don't already hold for an observatory in a period of time into the local database. The
+        entities are written but not committed. Files which couldn't be downloaded are added to the retry list.
+
+        :internal:
+        """
+        db = self.db
+        # Searches exclude entities at exactly their minimum and maximum times, so overlap the previous slice slightly
+        metadata = self._fetch_metadata(obstory_id=obstory_id, time_min=time_min - 1, time_max=time_max)
+        observations = self._fetch_observations(obstory_id=obstory_id, time_min=time_min - 1, time_max=time_max)
+
+        # Observations may have gained files since we last saw them, so check the files of all of them
+        files = [f for observation in observations for f in observation.file_records
+                 if (self.semantic_types is None or f.semantic_type in self.semantic_types) and
+                 f.file_size is not None and not db.has_file_id(f.id)]
+
+        # Metadata first, so that the observatory's status is known before its observations are written, and
+        # observations before their files
+        for item in metadata:
+            if not db.has_obstory_metadata(item.id):
+                db.import_obstory_metadata(obstory_name=obstory_name, key=item.key, value=item.value,
+                                           metadata_time=item.time, time_created=item.time_created,
+                                           user_created=self.user_id, item_id=item.id)
+                progress.metadata += 1
+        for observation in observations:
+            if not db.has_observation_id(observation.id):
+                db.import_observation(observation=observation, user_id=self.user_id)
+                progress.observations += 1
+        self._download_files(obstory_id=obstory_id, files=files, progress=progress)
+
+
+def main(argv=None):
+    """
+    Sync a local database with a Meteor Pi server, as described by the command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Copy new data from a Meteor Pi server into a local database")
+    parser.add_argument('--url', default="https://meteorpi.cambridgesciencecentre.org/api",
+                        help="the URL of the server's API")
+    parser.add_argument('--file-store', required=True, help="the path of the local database's file store")
+    parser.add_argument('--db-host', default='localhost')
+    parser.add_argument('--db-user', default='meteorpi')
+    parser.add_argument('--db-password', default='meteorpi')
+    parser.add_argument('--db-name', default='meteorpi')
+    parser.add_argument('--obstory', action='append', dest='obstory_ids',
+                        help="the ID of an observatory to sync; may be given several times. Defaults to all.")
+    parser.add_argument('--obs-type', action='append', dest='observation_types',
+                        help="a type of observation to sync; may be given several times. Defaults to all.")
+    parser.add_argument('--semantic-type', action='append', dest='semantic_types',
+                        help="a semantic type of file to sync; may be given several times. Defaults to all.")
+    parser.add_argument('--since', type=float, help="the unix time to sync from, overriding the high water marks")
+    parser.add_argument('--until', type=float, help="the unix time to sync up to. Defaults to now.")
+    parser.add_argument('--workers', type=int, default=DEFAULT_DOWNLOAD_WORKERS,
+                        help="the number of files to download at once")
+    parser.add_argument('--mark-type', default=DEFAULT_MARK_TYPE,
+                        help="the type of high water mark used to record progress")
+    parser.add_argument('--user-id', default=DEFAULT_USER_ID,
+                        help="the user recorded as having created the entities written to the local database")
+    parser.add_argument('--retry-file', help="the JSON file listing files to download again. Defaults to one "
+                                             "alongside the file store.")
+    parser.add_argument('--max-file-attempts', type=int, default=DEFAULT_MAX_FILE_ATTEMPTS,
+                        help="the number of runs on which to try to download a file before giving up on it")
+    args = parser.parse_args(argv)
+
+    # Only needed to run the mirror, so not a dependency of the client as a whole
+    import meteorpi_db
+
+    basicConfig(level=INFO, format='%(asctime)s %(message)s')
+    db = meteorpi_db.MeteorDatabase(file_store_path=args.file_store, db_host=args.db_host, db_user=args.db_user,
+                                    db_password=args.db_password, db_name=args.db_name)
+    client = MeteorClient(base_url=args.url, retries=3)
+    mirror = MeteorMirror(client=client, db=db, obstory_ids=args.obstory_ids,
+                          observation_types=args.observation_types, semantic_types=args.semantic_types,
+                          user_id=args.user_id, mark_type=args.mark_type, workers=args.workers,
+                          retry_path=args.retry_file, max_file_attempts=args.max_file_attempts)
+    try:
+        results = mirror.sync(since=args.since, until=args.until)
+    finally:
+        db.close_db()
+    return 0 if all(progress is not None for progress in results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,8 +12,10 @@ setup(
     packages=['meteorpi_client'],
     install_requires=[
         'meteorpi_model',
-        'pyyaml',
-        'requests'],
+        'requests',
+        'futures'],
+    extras_require={
+        'mirror': ['meteorpi_db']},
     include_package_data=True,
     test_suite='nose.collector',
     tests_require=['nose',
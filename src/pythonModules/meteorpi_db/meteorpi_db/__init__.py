@@ -26,20 +26,55 @@
 import os
 import sys
 import MySQLdb
+import MySQLdb.cursors
 import shutil
-import time
 import json
 import numbers
+import hashlib
 
 import passlib.hash
 import meteorpi_model as mp
 from meteorpi_db.generators import first_from_generator, MeteorDatabaseGenerators
-from meteorpi_db.sql_builder import search_observations_sql_builder, search_files_sql_builder, \
+from meteorpi_db.sql_builder import SQLBuilder, search_observations_sql_builder, search_files_sql_builder, \
     search_metadata_sql_builder, search_obsgroups_sql_builder
-from meteorpi_db.exporter import ObservationExportTask, FileExportTask, MetadataExportTask
+from meteorpi_db.export_queue import ExportQueue
 
 SOFTWARE_VERSION = 2
 
+# For each type of entity which can be exported: the table holding it, its public ID column, the time column used to
+# order exports, the join needed to find its observatory, and the export table with its column referring to the entity
+INVENTORY_TABLES = {
+    'observation': ('archive_observations e', 'e.publicId', 'e.obsTime',
+                    'INNER JOIN archive_observatories l ON e.observatory=l.uid',
+                    'archive_observationExport', 'observationId'),
+    'file': ('archive_files e', 'e.repositoryFname', 'e.fileTime',
+             'INNER JOIN archive_observations o ON e.observationId=o.uid '
+             'INNER JOIN archive_observatories l ON o.observatory=l.uid',
+             'archive_fileExport', 'fileId'),
+    'metadata': ('archive_metadata e', 'e.publicId', 'e.setAtTime',
+                 'INNER JOIN archive_observatories l ON e.observatory=l.uid',
+                 'archive_metadataExport', 'metadataId')
+}
+
+# Maximum number of IDs to place in a single SQL IN (...) clause
+MAX_IDS_PER_QUERY = 500
+
+
+class CountingDictCursor(MySQLdb.cursors.DictCursor):
+    """
+    A DictCursor which counts the queries it executes, so that the cost of each request to the web server can be
+    monitored.
+
+    :ivar int query_count:
+        The number of queries executed by this cursor
+    """
+
+    query_count = 0
+
+    def execute(self, query, args=None):
+        self.query_count += 1
+        return super(CountingDictCursor, self).execute(query, args)
+
 
 class MeteorDatabase(object):
     """
@@ -83,7 +118,7 @@ class MeteorDatabase(object):
             The local obstory ID
         """
         self.db = MySQLdb.connect(host=db_host, user=db_user, passwd=db_password, db=db_name)
-        self.con = self.db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+        self.con = self.db.cursor(cursorclass=CountingDictCursor)
 
         if not os.path.exists(file_store_path):
             os.makedirs(file_store_path)
@@ -97,11 +132,18 @@ class MeteorDatabase(object):
         self.obstory_name = obstory_name
         self.generators = MeteorDatabaseGenerators(db=self, con=self.con)
 
-        # Cache a query of items we're waiting to export, to save on database queries
-        self.export_queue_valid_until = 0
-        self.export_queue_metadata = []
-        self.export_queue_observations = []
-        self.export_queue_files = []
+        # Count the searches for which we needed to run a separate COUNT query to find the total number of results,
+        # and those where we could deduce it
+        self.count_queries_run = 0
+        self.count_queries_avoided = 0
+
+        # While running a batch of searches, files and observations which have already been fetched are held here, so
+        # that entities which appear in the results of several searches are only looked up once. None otherwise.
+        self._batch_lookups = None
+
+        # The queue of items waiting to export, and the tasks we have claimed from it but not yet handed out
+        self.export_queue = ExportQueue(db=self)
+        self._claimed_exports = []
 
     def __str__(self):
         """Simple string representation of this db object
@@ -118,9 +160,20 @@ class MeteorDatabase(object):
                 self.db_name,
                 self.obstory_name))
 
+    @property
+    def query_count(self):
+        """
+        :return:
+            The number of SQL queries run through this database connection
+        """
+        return self.con.query_count
+
     def commit(self):
         self.db.commit()
 
+    def rollback(self):
+        self.db.rollback()
+
     def close_db(self):
         self.con.close()
         self.db.close()
@@ -212,11 +265,7 @@ VALUES
                                limit=search.limit,
                                order='m.time DESC')
         items = list(self.generators.obstory_metadata_generator(sql=sql, sql_args=b.sql_args))
-        rows_returned = len(items)
-        total_rows = rows_returned + search.skip
-        if (rows_returned == search.limit > 0) or (rows_returned == 0 and search.skip > 0):
-            self.con.execute(b.get_count_sql(), b.sql_args)
-            total_rows = self.con.fetchone()[0]
+        total_rows = self._total_rows(builder=b, search=search, rows_returned=len(items))
         return {"count": total_rows,
                 "items": items}
 
@@ -360,6 +409,8 @@ WHERE observatory=%s AND fieldId=%s AND time<%s ORDER BY time DESC LIMIT 1
         :return:
             A :class:`meteorpi_model.FileRecord` instance, or None if not found
         """
+        if self._batch_lookups is not None and ('file', repository_fname) in self._batch_lookups:
+            return self._batch_lookups[('file', repository_fname)]
         search = mp.FileRecordSearch(repository_fname=repository_fname)
         b = search_files_sql_builder(search)
         sql = b.get_select_sql(columns='f.uid, o.publicId AS observationId, f.mimeType, '
@@ -368,9 +419,10 @@ WHERE observatory=%s AND fieldId=%s AND time<%s ORDER BY time DESC LIMIT 1
                                        'f.repositoryFname',
                                skip=0, limit=1, order='f.fileTime DESC')
         files = list(self.generators.file_generator(sql=sql, sql_args=b.sql_args))
-        if not files:
-            return None
-        return files[0]
+        result = files[0] if files else None
+        if self._batch_lookups is not None:
+            self._batch_lookups[('file', repository_fname)] = result
+        return result
 
     def search_files(self, search):
         """
@@ -392,14 +444,72 @@ WHERE observatory=%s AND fieldId=%s AND time<%s ORDER BY time DESC LIMIT 1
                                limit=search.limit,
                                order='f.fileTime DESC')
         files = list(self.generators.file_generator(sql=sql, sql_args=b.sql_args))
-        rows_returned = len(files)
-        total_rows = rows_returned + search.skip
-        if (rows_returned == search.limit > 0) or (rows_returned == 0 and search.skip > 0):
-            self.con.execute(b.get_count_sql(), b.sql_args)
-            total_rows = self.con.fetchone()['COUNT(*)']
+        total_rows = self._total_rows(builder=b, search=search, rows_returned=len(files))
         return {"count": total_rows,
                 "files": files}
 
+    def iter_files(self, search, page_size=100):
+        """
+        Iterate over the :class:`meteorpi_model.FileRecord` entities matching a search. Results are fetched from the
+        database a page at a time, so the complete result set is never held in memory at once.
+
+        :param search:
+            an instance of :class:`meteorpi_model.FileRecordSearch` used to constrain the files returned from the DB
+        :param int page_size:
+            the number of files to fetch from the database in each query
+        :return:
+            a generator of :class:`meteorpi_model.FileRecord`
+        """
+        b = search_files_sql_builder(search)
+        return self._iter_pages(builder=b,
+                                columns='f.uid, o.publicId AS observationId, f.mimeType, '
+                                        'f.fileName, s2.name AS semanticType, f.fileTime, '
+                                        'f.fileSize, f.fileMD5, l.publicId AS obstory_id, l.name AS obstory_name, '
+                                        'f.repositoryFname',
+                                time_column='f.fileTime', id_column='f.repositoryFname',
+                                generator=self.generators.file_generator, key=lambda x: [x.file_time, x.id],
+                                skip=search.skip, limit=search.limit, page_size=page_size)
+
+    def page_files(self, search, after=None):
+        """
+        Fetch one page of the :class:`meteorpi_model.FileRecord` entities matching a search, newest first, continuing
+        from where a previous page ended. Unlike search_files, this doesn't skip over the earlier results or count the
+        total, so is equally fast however far through the results we are.
+
+        :param search:
+            an instance of :class:`meteorpi_model.FileRecordSearch`. Its limit gives the size of the page, and its skip
+            is ignored.
+        :param list after:
+            the 'next' value returned with the previous page, or None for the first page
+        :return:
+            a structure of {files:list of :class:`meteorpi_model.FileRecord`, next:the value to pass as 'after' to
+            fetch the following page, or None if this is the last page}
+        """
+        b = search_files_sql_builder(search)
+        page, next_key = self._keyset_page(builder=b,
+                                           columns='f.uid, o.publicId AS observationId, f.mimeType, '
+                                                   'f.fileName, s2.name AS semanticType, f.fileTime, '
+                                                   'f.fileSize, f.fileMD5, l.publicId AS obstory_id, '
+                                                   'l.name AS obstory_name, f.repositoryFname',
+                                           time_column='f.fileTime', id_column='f.repositoryFname',
+                                           generator=self.generators.file_generator,
+                                           key=lambda x: [x.file_time, x.id], limit=search.limit, after=after)
+        return {"files": page,
+                "next": next_key}
+
+    def count_files(self, search):
+        """
+        Count the :class:`meteorpi_model.FileRecord` entities matching a search, ignoring its skip and limit
+
+        :param search:
+            an instance of :class:`meteorpi_model.FileRecordSearch`
+        :return:
+            the integer number of matching files
+        """
+        b = search_files_sql_builder(search)
+        self.con.execute(b.get_count_sql(), b.sql_args)
+        return self.con.fetchone()['COUNT(*)']
+
     def register_file(self, observation_id, user_id, file_path, file_time, mime_type, semantic_type,
                       file_md5=None, file_meta=None):
         """
@@ -586,15 +696,18 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_files WHERE repositoryF
         :return:
             A :class:`meteorpi_model.Observation` instance, or None if not found
         """
+        if self._batch_lookups is not None and ('observation', observation_id) in self._batch_lookups:
+            return self._batch_lookups[('observation', observation_id)]
         search = mp.ObservationSearch(observation_id=observation_id)
         b = search_observations_sql_builder(search)
         sql = b.get_select_sql(columns='l.publicId AS obstory_id, l.name AS obstory_name, '
                                        'o.obsTime, s.name AS obsType, o.publicId, o.uid',
                                skip=0, limit=1, order='o.obsTime DESC')
         obs = list(self.generators.observation_generator(sql=sql, sql_args=b.sql_args))
-        if not obs:
-            return None
-        return obs[0]
+        result = obs[0] if obs else None
+        if self._batch_lookups is not None:
+            self._batch_lookups[('observation', observation_id)] = result
+        return result
 
     def search_observations(self, search):
         """
@@ -614,14 +727,69 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_files WHERE repositoryF
                                limit=search.limit,
                                order='o.obsTime DESC')
         obs = list(self.generators.observation_generator(sql=sql, sql_args=b.sql_args))
-        rows_returned = len(obs)
-        total_rows = rows_returned + search.skip
-        if (rows_returned == search.limit > 0) or (rows_returned == 0 and search.skip > 0):
-            self.con.execute(b.get_count_sql(), b.sql_args)
-            total_rows = self.con.fetchone()['COUNT(*)']
+        total_rows = self._total_rows(builder=b, search=search, rows_returned=len(obs))
         return {"count": total_rows,
                 "obs": obs}
 
+    def iter_observations(self, search, page_size=100):
+        """
+        Iterate over the :class:`meteorpi_model.Observation` entities matching a search. Results are fetched from the
+        database a page at a time, so the complete result set is never held in memory at once.
+
+        :param search:
+            an instance of :class:`meteorpi_model.ObservationSearch` used to constrain the observations returned from
+            the DB
+        :param int page_size:
+            the number of observations to fetch from the database in each query
+        :return:
+            a generator of :class:`meteorpi_model.Observation`
+        """
+        b = search_observations_sql_builder(search)
+        return self._iter_pages(builder=b,
+                                columns='l.publicId AS obstory_id, l.name AS obstory_name, '
+                                        'o.obsTime, s.name AS obsType, o.publicId, o.uid',
+                                time_column='o.obsTime', id_column='o.publicId',
+                                generator=self.generators.observation_generator, key=lambda x: [x.obs_time, x.id],
+                                skip=search.skip, limit=search.limit, page_size=page_size)
+
+    def page_observations(self, search, after=None):
+        """
+        Fetch one page of the :class:`meteorpi_model.Observation` entities matching a search, newest first, continuing
+        from where a previous page ended. Unlike search_observations, this doesn't skip over the earlier results or
+        count the total, so is equally fast however far through the results we are.
+
+        :param search:
+            an instance of :class:`meteorpi_model.ObservationSearch`. Its limit gives the size of the page, and its skip
+            is ignored.
+        :param list after:
+            the 'next' value returned with the previous page, or None for the first page
+        :return:
+            a structure of {obs:list of :class:`meteorpi_model.Observation`, next:the value to pass as 'after' to fetch
+            the following page, or None if this is the last page}
+        """
+        b = search_observations_sql_builder(search)
+        page, next_key = self._keyset_page(builder=b,
+                                           columns='l.publicId AS obstory_id, l.name AS obstory_name, '
+                                                   'o.obsTime, s.name AS obsType, o.publicId, o.uid',
+                                           time_column='o.obsTime', id_column='o.publicId',
+                                           generator=self.generators.observation_generator,
+                                           key=lambda x: [x.obs_time, x.id], limit=search.limit, after=after)
+        return {"obs": page,
+                "next": next_key}
+
+    def count_observations(self, search):
+        """
+        Count the :class:`meteorpi_model.Observation` entities matching a search, ignoring its skip and limit
+
+        :param search:
+            an instance of :class:`meteorpi_model.ObservationSearch`
+        :return:
+            the integer number of matching observations
+        """
+        b = search_observations_sql_builder(search)
+        self.con.execute(b.get_count_sql(), b.sql_args)
+        return self.con.fetchone()['COUNT(*)']
+
     def register_observation(self, obstory_name, user_id, obs_time, obs_type, obs_meta=None):
         """
         Register a new observation, updating the database and returning the corresponding Observation object
@@ -798,11 +966,7 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_observations WHERE publ
                                limit=search.limit,
                                order='g.time DESC')
         obs_groups = list(self.generators.obsgroup_generator(sql=sql, sql_args=b.sql_args))
-        rows_returned = len(obs_groups)
-        total_rows = rows_returned + search.skip
-        if (rows_returned == search.limit > 0) or (rows_returned == 0 and search.skip > 0):
-            self.con.execute(b.get_count_sql(), b.sql_args)
-            total_rows = self.con.fetchone()['COUNT(*)']
+        total_rows = self._total_rows(builder=b, search=search, rows_returned=len(obs_groups))
         return {"count": total_rows,
                 "obsgroups": obs_groups}
 
@@ -1174,96 +1338,302 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_obs_groups WHERE public
 
     def get_next_entity_to_export(self):
         """
-        Examines the archive_observationExport and archive_metadataExport tables, and builds
-        either a :class:`meteorpi_db.ObservationExportTask` or a :class:`meteorpi_db.MetadataExportTask` as appropriate.
-        These task objects can be used to retrieve the underlying entity and export configuration, and to update the
-        completion state or push the timestamp into the future, deferring evaluation of the task until later.
+        Claims the next item waiting to be exported from the archive_metadataExport, archive_observationExport and
+        archive_fileExport tables, and builds a :class:`meteorpi_db.exporter.MetadataExportTask`,
+        :class:`meteorpi_db.exporter.ObservationExportTask` or :class:`meteorpi_db.exporter.FileExportTask` as
+        appropriate. These task objects can be used to retrieve the underlying entity and export configuration, and to
+        update the completion state. Items are claimed from the export queue in batches, see
+        :class:`meteorpi_db.export_queue.ExportQueue`.
+
+        :returns:
+            Either None, if no exports are available, or an export task
+        """
+        if not self._claimed_exports:
+            self._claimed_exports = self.get_entities_to_export(max_count=50)
+        if self._claimed_exports:
+            return self._claimed_exports.pop(0)
+        return None
+
+    def get_entities_to_export(self, max_count):
+        """
+        Claim up to max_count items waiting to be exported. The items are claimed for this database connection's export
+        queue for a limited time, during which no other exporter will be given them.
 
+        :param int max_count:
+            The maximum number of items to claim
         :returns:
-            Either None, if no exports are available, or an object, depending on whether an observation or metadata
-            item is next in the queue to export.
+            A list of export tasks, empty if no exports are available
         """
+        return self.export_queue.claim(max_count=max_count)
 
-        # If the queue of items waiting to export is old, delete it and fetch a new list from the database
-        if self.export_queue_valid_until < time.time():
-            self.export_queue_metadata = []
-            self.export_queue_observations = []
-            self.export_queue_files = []
+    def release_exports(self, tasks=None):
+        """
+        Give up our claim on export tasks which we haven't exported, so that they can be claimed again at once rather
+        than when their lease expires.
+
+        :param list tasks:
+            The tasks to release. Any tasks which were claimed by get_next_entity_to_export, but which it hasn't yet
+            returned, are always released.
+        """
+        tasks = list(tasks or []) + self._claimed_exports
+        self._claimed_exports = []
+        if tasks:
+            self.export_queue.release(tasks)
+
+    @staticmethod
+    def _inventory_table(entity_type):
+        if entity_type not in INVENTORY_TABLES:
+            raise ValueError("Unknown entity type %s" % entity_type)
+        return INVENTORY_TABLES[entity_type]
+
+    def get_missing_ids(self, entity_type, entity_ids):
+        """
+        Find which of a list of entities we don't hold. Used by the importer to tell an exporter which entities it needs
+        to send.
 
-        # If we don't have a queue of items waiting to export, query database for items
-        if (not self.export_queue_metadata) and (not self.export_queue_observations) and (not self.export_queue_files):
-            self.export_queue_valid_until = time.time() + 60
+        :param string entity_type:
+            One of 'observation', 'file' or 'metadata'
+        :param list entity_ids:
+            The public IDs of the entities
+        :return:
+            A list of those IDs which aren't in this database, in the order given
+        """
+        table, id_column = self._inventory_table(entity_type)[:2]
+        present = set()
+        for i in range(0, len(entity_ids), MAX_IDS_PER_QUERY):
+            chunk = entity_ids[i:i + MAX_IDS_PER_QUERY]
+            self.con.execute('SELECT {0} AS id FROM {1} WHERE {0} IN ({2})'.format(
+                id_column, table, ','.join(['%s'] * len(chunk))), tuple(chunk))
+            present.update(row['id'] for row in self.con.fetchall())
+        return [entity_id for entity_id in entity_ids if entity_id not in present]
+
+    def get_inventory_digest(self, entity_type, obstory_id, time_min, time_max):
+        """
+        Summarise the entities of one type we hold for an observatory within a time window, so that two databases can
+        compare their holdings without exchanging every ID.
+
+        :param string entity_type:
+            One of 'observation', 'file' or 'metadata'
+        :param string obstory_id:
+            The public ID of the observatory
+        :param float time_min:
+            The start of the time window, inclusive
+        :param float time_max:
+            The end of the time window, exclusive
+        :return:
+            The hex MD5 digest of the sorted IDs of the matching entities, each followed by a newline
+        """
+        table, id_column, time_column, join = self._inventory_table(entity_type)[:4]
+        self.con.execute('SELECT {0} AS id FROM {1} {2} WHERE l.publicId=%s AND {3}>=%s AND {3}<%s '
+                         'ORDER BY {0}'.format(id_column, table, join, time_column),
+                         (obstory_id, time_min, time_max))
+        digest = hashlib.md5()
+        for row in self.con.fetchall():
+            digest.update(row['id'] + '\n')
+        return digest.hexdigest()
+
+    def get_pending_exports(self, config_id, entity_type):
+        """
+        List the entities still waiting to be sent under an export configuration
+
+        :param string config_id:
+            The ID of the export configuration
+        :param string entity_type:
+            The type of entity exported by the configuration, one of 'observation', 'file' or 'metadata'
+        :return:
+            A list of (entity_id, obstory_id, time) tuples. The time is None for entities which don't have one.
+        """
+        table, id_column, time_column, join, export_table, export_column = self._inventory_table(entity_type)
+        self.con.execute('SELECT {0} AS id, l.publicId AS obstory_id, {1} AS time FROM {2} x '
+                         'INNER JOIN {3} ON x.{4}=e.uid {5} '
+                         'INNER JOIN archive_exportConfig c ON x.exportConfig=c.uid '
+                         'WHERE c.exportConfigId=%s AND x.exportState > 0'.format(
+                             id_column, time_column, export_table, table, export_column, join),
+                         (config_id,))
+        return [(row['id'], row['obstory_id'], row['time']) for row in self.con.fetchall()]
+
+    def mark_exported(self, config_id, entity_type, entity_ids):
+        """
+        Mark a set of entities as having been sent under an export configuration, for example because the target
+        server already holds them.
 
-            # Try to retrieve the earliest record in archive_metadataExport
-            self.con.execute('SELECT c.exportConfigId, o.publicId, x.exportState, '
-                             'c.targetURL, c.targetUser, c.targetPassword '
-                             'FROM archive_metadataExport x '
+        :param string config_id:
+            The ID of the export configuration
+        :param string entity_type:
+            The type of entity exported by the configuration, one of 'observation', 'file' or 'metadata'
+        :param list entity_ids:
+            The public IDs of the entities
+        """
+        table, id_column, time_column, join, export_table, export_column = self._inventory_table(entity_type)
+        entity_ids = list(entity_ids)
+        for i in range(0, len(entity_ids), MAX_IDS_PER_QUERY):
+            chunk = entity_ids[i:i + MAX_IDS_PER_QUERY]
+            self.con.execute('UPDATE {0} x INNER JOIN {1} ON x.{2}=e.uid '
                              'INNER JOIN archive_exportConfig c ON x.exportConfig=c.uid '
-                             'INNER JOIN archive_metadata o ON x.metadataId=o.uid '
-                             'WHERE c.active = 1 AND x.exportState > 0 '
-                             'ORDER BY x.setAtTime ASC, o.uid ASC LIMIT 50')
-            self.export_queue_metadata = list(self.con.fetchall())
-
-            if not self.export_queue_metadata:
-
-                # Try to retrieve the earliest record in archive_observationExport
-                self.con.execute('SELECT c.exportConfigId, o.publicId, x.exportState, '
-                                 'c.targetURL, c.targetUser, c.targetPassword '
-                                 'FROM archive_observationExport x '
-                                 'INNER JOIN archive_exportConfig c ON x.exportConfig=c.uid '
-                                 'INNER JOIN archive_observations o ON x.observationId=o.uid '
-                                 'WHERE c.active = 1  AND x.exportState > 0 '
-                                 'ORDER BY x.obsTime ASC, o.uid ASC LIMIT 50')
-                self.export_queue_observations = list(self.con.fetchall())
-
-                if not self.export_queue_observations:
-                    # Try to retrieve the earliest record in archive_fileExport
-                    self.con.execute('SELECT c.exportConfigId, o.repositoryFname, x.exportState, '
-                                     'c.targetURL, c.targetUser, c.targetPassword '
-                                     'FROM archive_fileExport x '
-                                     'INNER JOIN archive_exportConfig c ON x.exportConfig=c.uid '
-                                     'INNER JOIN archive_files o ON x.fileId=o.uid '
-                                     'WHERE c.active = 1 AND x.exportState > 0 '
-                                     'ORDER BY x.fileTime ASC, o.uid ASC LIMIT 50')
-                    self.export_queue_files = list(self.con.fetchall())
-
-        if self.export_queue_metadata:
-            row = self.export_queue_metadata.pop(0)
-            config_id = row['exportConfigId']
-            entity_id = row['publicId']
-            status = row['exportState']
-            target_url = row['targetURL']
-            target_user = row['targetUser']
-            target_password = row['targetPassword']
-            return MetadataExportTask(db=self, config_id=config_id, metadata_id=entity_id,
-                                      status=status, target_url=target_url, target_user=target_user,
-                                      target_password=target_password)
-
-        if self.export_queue_observations:
-            row = self.export_queue_observations.pop(0)
-            config_id = row['exportConfigId']
-            entity_id = row['publicId']
-            status = row['exportState']
-            target_url = row['targetURL']
-            target_user = row['targetUser']
-            target_password = row['targetPassword']
-            return ObservationExportTask(db=self, config_id=config_id, observation_id=entity_id,
-                                         status=status, target_url=target_url, target_user=target_user,
-                                         target_password=target_password)
-
-        if self.export_queue_files:
-            row = self.export_queue_files.pop(0)
-            config_id = row['exportConfigId']
-            entity_id = row['repositoryFname']
-            status = row['exportState']
-            target_url = row['targetURL']
-            target_user = row['targetUser']
-            target_password = row['targetPassword']
-            return FileExportTask(db=self, config_id=config_id, file_id=entity_id,
-                                  status=status, target_url=target_url, target_user=target_user,
-                                  target_password=target_password)
+                             'SET x.exportState=0 '
+                             'WHERE c.exportConfigId=%s AND {3} IN ({4})'.format(
+                                 export_table, table, export_column, id_column, ','.join(['%s'] * len(chunk))),
+                             (config_id,) + tuple(chunk))
 
-        return None
+    def _total_rows(self, builder, search, rows_returned):
+        """
+        Work out the total number of results a search would return without its limit. In most cases this can be
+        deduced from the number of rows returned, but if the limit was reached, or we skipped past the end of the
+        results, a COUNT query is needed.
+
+        :param builder:
+            the :class:`meteorpi_db.sql_builder.SQLBuilder` used to run the search
+        :param search:
+            the search, used for its skip and limit values
+        :param int rows_returned:
+            the number of rows returned by the search
+        :return:
+            the total number of results
+        :internal:
+        """
+        if (rows_returned == search.limit > 0) or (rows_returned == 0 and search.skip > 0):
+            self.count_queries_run += 1
+            self.con.execute(builder.get_count_sql(), builder.sql_args)
+            return self.con.fetchone()['COUNT(*)']
+        self.count_queries_avoided += 1
+        return rows_returned + search.skip
+
+    # Functions for running several searches at once
+    def search_batch(self, searches):
+        """
+        Run a list of searches, each of which may be an :class:`meteorpi_model.ObservationSearch`,
+        :class:`meteorpi_model.FileRecordSearch`, :class:`meteorpi_model.ObservationGroupSearch` or
+        :class:`meteorpi_model.ObservatoryMetadataSearch`. Identical searches are only run once, and files and
+        observations which appear in the results of more than one search are only fetched once.
+
+        :param list searches:
+            the searches to run
+        :return:
+            a list with one entry per search, in the same order, each of which is the structure returned by the
+            corresponding method: search_observations, search_files, search_obsgroups or search_obstory_metadata
+        :raises:
+            ValueError if any of the searches is not of a recognised type
+        """
+        search_methods = [(mp.ObservationSearch, self.search_observations),
+                          (mp.FileRecordSearch, self.search_files),
+                          (mp.ObservationGroupSearch, self.search_obsgroups),
+                          (mp.ObservatoryMetadataSearch, self.search_obstory_metadata)]
+        output = []
+        results_by_search = {}
+        self._batch_lookups = {}
+        try:
+            for search in searches:
+                method = None
+                for search_class, search_method in search_methods:
+                    if isinstance(search, search_class):
+                        method = search_method
+                if method is None:
+                    raise ValueError("Cannot run a batch search on a {0}".format(search.__class__.__name__))
+                key = (search.__class__.__name__, json.dumps(search.as_dict(), sort_keys=True))
+                if key not in results_by_search:
+                    results_by_search[key] = method(search)
+                output.append(results_by_search[key])
+        finally:
+            self._batch_lookups = None
+        return output
+
+    # Functions for streaming search results
+    def _iter_pages(self, builder, columns, time_column, id_column, generator, key, skip, limit, page_size):
+        """
+        Run the query described by a :class:`meteorpi_db.sql_builder.SQLBuilder` repeatedly, a page at a time,
+        yielding the entities produced by one of the :class:`meteorpi_db.generators.MeteorDatabaseGenerators` methods.
+        Results are ordered by time and then public ID, both descending, and each page continues from the last result
+        of the one before, as in _keyset_page, so every query is equally fast however far through the results we are,
+        and entities added while we are iterating don't shift results between pages.
+
+        :param builder:
+            the SQLBuilder describing the search
+        :param string columns:
+            the columns to select, as required by the generator
+        :param string time_column:
+            the column holding the time by which results are ordered
+        :param string id_column:
+            the column holding the public ID of each result, which breaks ties between results with the same time
+        :param generator:
+            the generator method used to build model objects from each page of rows
+        :param key:
+            a function returning [time, public ID] for a model object
+        :param int skip:
+            the number of results to skip before the first one returned
+        :param int limit:
+            the maximum number of results to return, or 0 / None for no limit
+        :param int page_size:
+            the number of rows to fetch in each query
+        :internal:
+        """
+        remaining = limit if limit else 0
+        after = None
+        while True:
+            if limit:
+                this_page = min(page_size, remaining)
+            else:
+                this_page = page_size
+            page, after = self._keyset_page(builder=builder, columns=columns, time_column=time_column,
+                                            id_column=id_column, generator=generator, key=key, limit=this_page,
+                                            after=after, skip=skip)
+            # Only the first page skips results; the others start from the last result of the page before
+            skip = 0
+            for item in page:
+                yield item
+            if after is None:
+                return
+            if limit:
+                remaining -= this_page
+                if remaining <= 0:
+                    return
+
+    @staticmethod
+    def _keyset_page(builder, columns, time_column, id_column, generator, key, limit, after, skip=0):
+        """
+        Fetch one page of results ordered by time and then public ID, both descending, starting after a given entity.
+        Each page ends with the time and ID of its last result, which identify where the next page starts, so pages
+        never overlap or miss results, even if new entities are added between requests.
+
+        :param builder:
+            the SQLBuilder describing the search. It is left unchanged, so may be used again for the next page.
+        :param string columns:
+            the columns to select, as required by the generator
+        :param string time_column:
+            the column holding the time by which results are ordered
+        :param string id_column:
+            the column holding the public ID of each result, which breaks ties between results with the same time
+        :param generator:
+            the generator method used to build model objects from the rows
+        :param key:
+            a function returning [time, public ID] for a model object
+        :param int limit:
+            the size of the page, or 0 / None to return all remaining results
+        :param list after:
+            [time, public ID] of the last result of the previous page, or None for the first page
+        :param int skip:
+            the number of results to skip before the first one returned
+        :return:
+            a tuple of the list of results, and [time, public ID] of the last one, or None if there are no more results
+        :raises:
+            ValueError if after is malformed
+        :internal:
+        """
+        where_clauses = builder.where_clauses
+        sql_args = builder.sql_args
+        if after is not None:
+            try:
+                after_time, after_id = float(after[0]), str(after[1])
+            except (TypeError, ValueError, IndexError):
+                raise ValueError("Malformed page continuation")
+            where_clauses = where_clauses + ['({0} < %s OR ({0} = %s AND {1} < %s))'.format(time_column, id_column)]
+            sql_args = sql_args + [after_time, after_time, after_id]
+        sql = SQLBuilder(tables=builder.tables, where_clauses=where_clauses).get_select_sql(
+            columns=columns, order='{0} DESC, {1} DESC'.format(time_column, id_column), limit=limit if limit else 0,
+            skip=skip)
+        page = generator(sql=sql, sql_args=sql_args)
+        if limit and len(page) == limit:
+            return page, key(page[-1])
+        return page, None
 
     # Functions relating to high water marks
     def get_hwm_key_id(self, metakey):
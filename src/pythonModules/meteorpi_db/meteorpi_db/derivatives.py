@@ -0,0 +1,365 @@
+# derivatives.py
+# Meteor Pi, Cambridge Science Centre
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# Produces resized copies (derivatives) of images in the file store, such as the thumbnails shown in the web interface,
+# and keeps them in a size-limited cache directory. Files in the file store never change once registered, so a
+# derivative never needs regenerating once it has been made, only evicting when the cache is full.
+#
+# Derivatives are produced with the Python Imaging Library (Pillow), and numpy for 16-bit images. Where Pillow isn't
+# installed, PNG thumbnails of PNG images can still be produced by the resize tool in src/imageProjection, if the cache
+# is told where to find it; other sizes and formats are then unavailable.
+
+import os
+import sys
+import time
+import uuid
+import threading
+import subprocess
+
+# Widths, in pixels, of each size of derivative we can produce. Images are never enlarged.
+DERIVATIVE_SIZES = {
+    'thumbnail': 220,
+    'small': 480,
+    'medium': 1024
+}
+
+# Image formats in which derivatives can be produced: PIL format name, MIME type and file extension
+DERIVATIVE_FORMATS = {
+    'png': ('PNG', 'image/png', 'png'),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'webp': ('WEBP', 'image/webp', 'webp')
+}
+
+# MIME types of files in the file store from which we can make derivatives
+SOURCE_MIME_TYPES = ['image/png', 'image/jpeg']
+
+# Default maximum size of the cache directory, in bytes
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+
+# When the cache is full, evict files until it is this fraction of its maximum size, so that we don't have to scan the
+# cache directory every time a new derivative is added
+EVICTION_TARGET = 0.9
+
+# Cached files record when they were last used in their modification time. Only update it if it is older than this
+# many seconds, to avoid writing to the disk on every request.
+TOUCH_INTERVAL = 3600
+
+
+def default_cache_path(file_store_path):
+    """
+    :param string file_store_path:
+        The path to the database file store
+    :return:
+        The path of the cache directory used by default for a file store, shared by the web server and importer
+    """
+    return os.path.join(file_store_path, "../thumbnails")
+
+
+def _resize_with_tool(resize_tool, source_path, dest_path, width):
+    """
+    Write a resized PNG copy of a PNG image using the resize tool from src/imageProjection
+
+    :raises:
+        ValueError if the tool failed
+    """
+    temp_path = "%s.%s.tmp" % (dest_path, uuid.uuid4().hex)
+    try:
+        status = subprocess.call([resize_tool, source_path, str(width), temp_path])
+        if status != 0 or not os.path.exists(temp_path):
+            raise ValueError("Could not resize image <%s> with %s" % (source_path, resize_tool))
+        os.rename(temp_path, dest_path)
+    except OSError:
+        raise ValueError("Could not run %s" % resize_tool)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def resize_image(source_path, dest_path, width, image_format, resize_tool=None):
+    """
+    Write a resized copy of an image file. The copy is written to a temporary file and then renamed, so that other
+    processes never see a partially-written derivative.
+
+    :param string source_path:
+        The path of the image to resize
+    :param string dest_path:
+        The path to write the resized image to
+    :param int width:
+        The maximum width of the resized image, in pixels. The aspect ratio of the image is preserved.
+    :param string image_format:
+        One of the keys of DERIVATIVE_FORMATS
+    :param string resize_tool:
+        If specified, the path of the resize tool from src/imageProjection, used to make PNG copies of PNG images if
+        PIL isn't available. Only pass this if the source image is a PNG.
+    :raises:
+        ValueError if the image could not be read or written, or if PIL isn't available and the resize tool can't be
+        used instead
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        if resize_tool is not None and image_format == 'png':
+            _resize_with_tool(resize_tool=resize_tool, source_path=source_path, dest_path=dest_path, width=width)
+            return
+        raise ValueError("The Python Imaging Library (Pillow) is required to produce image derivatives")
+    pil_format = DERIVATIVE_FORMATS[image_format][0]
+
+    try:
+        image = Image.open(source_path)
+        # Only decode as much of a JPEG image as we need
+        image.draft('RGB', (width, width))
+        image.load()
+    except IOError:
+        raise ValueError("Could not read image <%s>" % source_path)
+
+    # Our cameras can produce 16-bit greyscale images, which most browsers and all JPEG encoders can't cope with, so
+    # scale these down to 8 bits
+    if image.mode in ('I', 'I;16', 'F'):
+        import numpy
+        pixels = numpy.asarray(image, dtype=numpy.float32)
+        peak = pixels.max()
+        if peak > 0:
+            pixels *= 255. / peak
+        image = Image.fromarray(pixels.clip(0, 255).astype(numpy.uint8), 'L')
+    if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA')
+
+    if image.size[0] > width:
+        height = max(1, int(round(image.size[1] * width / float(image.size[0]))))
+        image = image.resize((width, height), Image.LANCZOS)
+
+    temp_path = "%s.%s.tmp" % (dest_path, uuid.uuid4().hex)
+    try:
+        if pil_format == 'PNG':
+            image.save(temp_path, pil_format)
+        else:
+            image.save(temp_path, pil_format, quality=85)
+        os.rename(temp_path, dest_path)
+    except (IOError, KeyError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise ValueError("Could not write image <%s> in format %s" % (dest_path, pil_format))
+
+
+class DerivativeCache(object):
+    """
+    A directory of image derivatives, produced on demand and evicted least-recently-used first when the directory
+    exceeds its maximum size. A single instance should be shared between all the threads of a process: if several
+    threads request the same missing derivative at once, only one of them produces it while the others wait.
+
+    :ivar string cache_path:
+        The directory in which derivatives are stored
+    :ivar int max_bytes:
+        The maximum total size of the files in the cache directory
+    :ivar string resize_tool:
+        The path of the resize tool from src/imageProjection, used to make PNG derivatives of PNG images if PIL isn't
+        available, or None
+    :ivar int hits:
+        The number of requests for derivatives which were already in the cache
+    :ivar int misses:
+        The number of derivatives which have been produced
+    """
+
+    def __init__(self, cache_path, max_bytes=DEFAULT_CACHE_BYTES, resize_tool=None):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.resize_tool = resize_tool
+        self._size = None
+        self._size_lock = threading.Lock()
+        self._key_locks = {}
+        self._key_locks_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _acquire(self, key):
+        with self._key_locks_lock:
+            entry = self._key_locks.get(key)
+            if entry is None:
+                entry = self._key_locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        entry[0].acquire()
+
+    def _release(self, key):
+        with self._key_locks_lock:
+            entry = self._key_locks[key]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._key_locks[key]
+
+    def path_for(self, file_id, size_name, image_format):
+        """
+        :param string file_id:
+            The repository ID of the source file
+        :param string size_name:
+            One of the keys of DERIVATIVE_SIZES
+        :param string image_format:
+            One of the keys of DERIVATIVE_FORMATS
+        :return:
+            The path at which this derivative is stored, whether or not it has been produced yet
+        :raises:
+            ValueError if the size or format is not recognised
+        """
+        if size_name not in DERIVATIVE_SIZES:
+            raise ValueError("Unknown derivative size: %s" % size_name)
+        if image_format not in DERIVATIVE_FORMATS:
+            raise ValueError("Unknown derivative format: %s" % image_format)
+        return os.path.join(self.cache_path, size_name, "%s.%s" % (file_id, DERIVATIVE_FORMATS[image_format][2]))
+
+    def get_derivative(self, file_record, source_path, size_name, image_format):
+        """
+        Return the path of a derivative of an image, producing it if it isn't already in the cache
+
+        :param FileRecord file_record:
+            The :class:`meteorpi_model.FileRecord` of the source image
+        :param string source_path:
+            The path of the source image in the file store
+        :param string size_name:
+            One of the keys of DERIVATIVE_SIZES
+        :param string image_format:
+            One of the keys of DERIVATIVE_FORMATS
+        :return:
+            A tuple of the path of the derivative and its MIME type
+        :raises:
+            ValueError if the source file isn't an image, or the derivative couldn't be produced
+        """
+        if file_record.mime_type not in SOURCE_MIME_TYPES:
+            raise ValueError("Cannot make derivatives of files of type %s" % file_record.mime_type)
+        dest_path = self.path_for(file_record.id, size_name, image_format)
+        mime_type = DERIVATIVE_FORMATS[image_format][1]
+        if self._touch(dest_path):
+            self.hits += 1
+            return dest_path, mime_type
+
+        key = (file_record.id, size_name, image_format)
+        self._acquire(key)
+        try:
+            # Another thread may have produced this derivative while we were waiting for the lock
+            if os.path.exists(dest_path):
+                self.hits += 1
+                return dest_path, mime_type
+            self.misses += 1
+            dest_dir = os.path.dirname(dest_path)
+            if not os.path.isdir(dest_dir):
+                try:
+                    os.makedirs(dest_dir)
+                except OSError:
+                    # Created by another process
+                    pass
+            resize_tool = self.resize_tool if file_record.mime_type == 'image/png' else None
+            resize_image(source_path=source_path, dest_path=dest_path, width=DERIVATIVE_SIZES[size_name],
+                         image_format=image_format, resize_tool=resize_tool)
+        finally:
+            self._release(key)
+
+        self._added(os.path.getsize(dest_path))
+        return dest_path, mime_type
+
+    def generate_all(self, file_record, source_path, size_names=None, image_formats=None):
+        """
+        Produce derivatives of an image in several sizes and formats ahead of them being requested, for example when
+        the image is first registered.
+
+        :param FileRecord file_record:
+            The :class:`meteorpi_model.FileRecord` of the source image
+        :param string source_path:
+            The path of the source image in the file store
+        :param list size_names:
+            The sizes to produce, defaults to all of DERIVATIVE_SIZES
+        :param list image_formats:
+            The formats to produce, defaults to ['png']
+        :return:
+            A list of the paths of the derivatives
+        """
+        if size_names is None:
+            size_names = sorted(DERIVATIVE_SIZES.keys())
+        if image_formats is None:
+            image_formats = ['png']
+        return [self.get_derivative(file_record, source_path, size_name, image_format)[0]
+                for size_name in size_names for image_format in image_formats]
+
+    @staticmethod
+    def _touch(path):
+        """
+        Mark a cached file as having been used, so that it is evicted later
+
+        :return:
+            True if the file exists, False if it needs producing
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+        now = time.time()
+        if now - mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+        return True
+
+    def _scan(self):
+        """
+        :return:
+            A list of (mtime, size, path) for every file in the cache directory
+        """
+        files = []
+        for dir_path, dir_names, file_names in os.walk(self.cache_path):
+            for file_name in file_names:
+                # Skip derivatives which are still being written
+                if file_name.endswith('.tmp'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _added(self, size):
+        """
+        Record that a file has been added to the cache, evicting the least recently used files if the cache is now
+        over its size limit. Other processes may also be writing to the cache directory, so the directory is rescanned
+        before evicting anything, rather than trusting our running total.
+        """
+        with self._size_lock:
+            if self._size is None:
+                self._size = sum(item[1] for item in self._scan())
+            else:
+                self._size += size
+            if self._size <= self.max_bytes:
+                return
+            files = self._scan()
+            files.sort()
+            self._size = sum(item[1] for item in files)
+            target = self.max_bytes * EVICTION_TARGET
+            for mtime, file_size, path in files:
+                if self._size <= target:
+                    break
+                try:
+                    os.remove(path)
+                    self._size -= file_size
+                except OSError:
+                    sys.stderr.write("Could not remove <%s> from derivative cache\n" % path)
@@ -0,0 +1,331 @@
+# export_queue.py
+# Meteor Pi, Cambridge Science Centre
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+
+# A work queue over the archive_*Export tables. Exporters claim rows in batches by writing their own ID and a lease
+# expiry time into the rows, so that several exporters, in one process or many, can share the work without sending the
+# same entity twice. A claim lapses when its lease expires, so rows claimed by an exporter which crashed are picked up
+# again by the others automatically. Exporters renew their claims on tasks which take a long time to send, such as large
+# files sent over a slow connection, before their leases run out, and only mark a task as done while they still hold it.
+#
+# The importer can't accept a file until it holds the observation the file belongs to, so a file is only claimed once
+# its observation is no longer waiting to be exported to the same server.
+
+import os
+import math
+import time
+import uuid
+import socket
+
+from meteorpi_db.exporter import ObservationExportTask, FileExportTask, MetadataExportTask
+
+# Default number of seconds for which a claim on an export task lasts
+DEFAULT_LEASE_SECONDS = 900
+
+# Default relative share of each claim given to each type of entity. Metadata is small and is needed by the importer
+# before the observations it describes, but observations and files still make progress while it is being sent.
+DEFAULT_PRIORITIES = {
+    'metadata': 4,
+    'observation': 2,
+    'file': 1
+}
+
+# For each type of entity: the export table, the column in it referring to the entity, the column the queue is ordered
+# by, the entity table and its public ID column, and the class of task produced
+EXPORT_QUEUE_TABLES = {
+    'metadata': ('archive_metadataExport', 'metadataId', 'setAtTime', 'archive_metadata', 'publicId',
+                 MetadataExportTask),
+    'observation': ('archive_observationExport', 'observationId', 'obsTime', 'archive_observations', 'publicId',
+                    ObservationExportTask),
+    'file': ('archive_fileExport', 'fileId', 'fileTime', 'archive_files', 'repositoryFname',
+             FileExportTask)
+}
+
+
+def default_owner_id():
+    """
+    :return:
+        A string identifying this exporter, unique across hosts and processes
+    """
+    return "%s:%d:%s" % (socket.gethostname()[:32], os.getpid(), uuid.uuid4().hex[:8])
+
+
+class ExportQueue(object):
+    """
+    Hands out export tasks from the archive_*Export tables, claiming them for this exporter for a limited time.
+
+    :ivar string owner:
+        The ID written into the rows we claim
+    :ivar int lease_seconds:
+        The number of seconds for which each claim lasts
+    :ivar dict priorities:
+        The relative share of each claim given to each type of entity, when there are several types waiting
+    :ivar list size_classes:
+        Upper bounds, in bytes, of the size classes into which files are divided. All the files in one class are
+        claimed before any in the next, and files in the same class are claimed oldest first. Files whose observations
+        are still waiting to be sent aren't claimed at all, so size classes only reorder files which the importer is
+        ready to accept.
+    :ivar int max_file_size:
+        If not None, files larger than this many bytes are not claimed
+    """
+
+    def __init__(self, db, owner=None, lease_seconds=DEFAULT_LEASE_SECONDS, priorities=None, size_classes=None):
+        """
+        :param MeteorDatabase db:
+            The database holding the export tables
+        :param string owner:
+            The ID written into the rows we claim, defaults to one made from the host name and process ID
+        :param int lease_seconds:
+            The number of seconds for which each claim lasts
+        :param dict priorities:
+            The relative share of each claim given to each type of entity, defaults to DEFAULT_PRIORITIES. Types with
+            a priority of zero are only claimed when there is nothing else to do.
+        :param list size_classes:
+            Upper bounds, in bytes, of the size classes into which files are divided, smallest first. By default files
+            are claimed oldest first whatever their size.
+        """
+        self.db = db
+        self.owner = owner if owner is not None else default_owner_id()
+        self.lease_seconds = lease_seconds
+        self.priorities = dict(DEFAULT_PRIORITIES)
+        if priorities is not None:
+            self.priorities.update(priorities)
+        self.size_classes = sorted(size_classes or [])
+        self.max_file_size = None
+
+    def _new_expiry(self):
+        return time.time() + self.lease_seconds
+
+    def claim(self, max_count):
+        """
+        Claim up to max_count export tasks. Tasks are divided between the types of entity according to their
+        priorities, with any shortfall in one type made up from the others, and each type is claimed oldest first.
+        Files whose observations are still waiting to be sent to the same server are left until they have been.
+
+        :param int max_count:
+            The maximum number of tasks to claim
+        :return:
+            A list of export tasks, which is empty if there is nothing waiting to be exported
+        """
+        total_weight = sum(self.priorities.get(entity_type, 0) for entity_type in EXPORT_QUEUE_TABLES)
+        order = sorted(EXPORT_QUEUE_TABLES.keys(), key=lambda x: -self.priorities.get(x, 0))
+        tasks = []
+        exhausted = set()
+        if total_weight > 0:
+            for entity_type in order:
+                share = int(math.ceil(max_count * self.priorities.get(entity_type, 0) / float(total_weight)))
+                share = min(share, max_count - len(tasks))
+                if share > 0:
+                    claimed = self._claim_type(entity_type, share)
+                    if len(claimed) < share:
+                        exhausted.add(entity_type)
+                    tasks.extend(claimed)
+        for entity_type in order:
+            if len(tasks) >= max_count:
+                break
+            if entity_type not in exhausted:
+                tasks.extend(self._claim_type(entity_type, max_count - len(tasks)))
+        self.db.commit()
+        return tasks
+
+    def _claim_type(self, entity_type, count):
+        """
+        Claim up to count tasks for one type of entity
+
+        :return:
+            A list of export tasks
+        """
+        export_table, entity_column, time_column, entity_table, id_column, task_class = \
+            EXPORT_QUEUE_TABLES[entity_type]
+        now = time.time()
+        join = ''
+        conditions = ''
+        order = 'x.{0} ASC, x.uid ASC'.format(time_column)
+        args = [now]
+        if entity_type == 'file':
+            join = 'INNER JOIN archive_files o ON x.fileId=o.uid'
+            conditions = ('AND NOT EXISTS (SELECT 1 FROM archive_observationExport ox '
+                          'INNER JOIN archive_exportConfig oc ON ox.exportConfig=oc.uid '
+                          'WHERE ox.observationId=o.observationId AND ox.exportState > 0 AND oc.active = 1 '
+                          'AND oc.targetURL=c.targetURL)')
+            if self.max_file_size is not None:
+                conditions += ' AND o.fileSize <= %s'
+                args.append(self.max_file_size)
+            if self.size_classes:
+                order = 'CASE {0} ELSE {1} END, {2}'.format(
+                    ' '.join('WHEN o.fileSize <= %s THEN {0}'.format(i) for i in range(len(self.size_classes))),
+                    len(self.size_classes), order)
+                args.extend(self.size_classes)
+
+        # Find the rows to claim, then claim them, skipping any which another exporter claimed in the meantime
+        self.db.con.execute('SELECT x.uid FROM {0} x '
+                            'INNER JOIN archive_exportConfig c ON x.exportConfig=c.uid {1} '
+                            'WHERE c.active = 1 AND x.exportState > 0 AND x.leaseExpiry < %s {2} '
+                            'ORDER BY {3} LIMIT %s'.format(export_table, join, conditions, order),
+                            tuple(args) + (count,))
+        uids = [row['uid'] for row in self.db.con.fetchall()]
+        if not uids:
+            return []
+        expiry = self._new_expiry()
+        self.db.con.execute('UPDATE {0} SET leaseOwner=%s, leaseExpiry=%s '
+                            'WHERE uid IN ({1}) AND exportState > 0 AND leaseExpiry < %s'.format(
+                                export_table, ','.join(['%s'] * len(uids))),
+                            (self.owner, expiry) + tuple(uids) + (now,))
+        if self.db.con.rowcount == 0:
+            return []
+        # Rows which another exporter claimed between our SELECT and UPDATE carry its owner ID, not ours
+        self.db.con.execute('SELECT x.uid, c.exportConfigId, o.{0} AS entityId, x.exportState, '
+                            'c.targetURL, c.targetUser, c.targetPassword '
+                            'FROM {1} x '
+                            'INNER JOIN archive_exportConfig c ON x.exportConfig=c.uid '
+                            'INNER JOIN {2} o ON x.{3}=o.uid '
+                            'WHERE x.uid IN ({4}) AND x.leaseOwner=%s'.format(id_column, export_table, entity_table,
+                                                                               entity_column,
+                                                                               ','.join(['%s'] * len(uids))),
+                            tuple(uids) + (self.owner,))
+        # Return the tasks in the order in which we chose them
+        position = dict((uid, index) for index, uid in enumerate(uids))
+        rows = sorted(self.db.con.fetchall(), key=lambda row: position[row['uid']])
+        tasks = [task_class(self.db, row['exportConfigId'], row['entityId'], row['exportState'],
+                            row['targetURL'], row['targetUser'], row['targetPassword'])
+                 for row in rows]
+        for task in tasks:
+            task.lease_expiry = expiry
+        return tasks
+
+    def _update_leases(self, tasks, lease_expiry, owner):
+        """
+        Update our claim on tasks, skipping any which we no longer hold. The lease_expiry of each of those is set to
+        None, so that we don't try to renew it again.
+
+        :return:
+            The tasks whose claims were updated
+        """
+        updated = []
+        for task in tasks:
+            entity_type = task.entity_type
+            export_table, entity_column, time_column, entity_table, id_column, task_class = \
+                EXPORT_QUEUE_TABLES[entity_type]
+            self.db.con.execute('UPDATE {0} x '
+                                'SET x.leaseOwner=%s, x.leaseExpiry=%s '
+                                'WHERE x.{1} = (SELECT uid FROM {2} o WHERE o.{3}=%s) '
+                                'AND x.exportConfig = (SELECT uid FROM archive_exportConfig c '
+                                'WHERE c.exportConfigId=%s) '
+                                'AND x.leaseOwner=%s AND x.exportState > 0'.format(export_table, entity_column,
+                                                                                    entity_table, id_column),
+                                (owner, lease_expiry, task.get_entity_id(), task.config_id, self.owner))
+            if self.db.con.rowcount > 0:
+                task.lease_expiry = lease_expiry
+                updated.append(task)
+            else:
+                task.lease_expiry = None
+        self.db.commit()
+        return updated
+
+    def renew(self, tasks):
+        """
+        Extend our claim on tasks which are taking a long time to export
+
+        :param list tasks:
+            Export tasks previously returned by claim()
+        :return:
+            The tasks which we still hold. Tasks whose leases lapsed and which another exporter has since claimed are
+            left out.
+        """
+        return self._update_leases(tasks, lease_expiry=self._new_expiry(), owner=self.owner)
+
+    def renew_due(self, tasks):
+        """
+        Renew our claim on those of a list of tasks whose leases are at least half over. Exporters call this regularly
+        while sending, so that no other exporter claims a task we are still working on.
+
+        :param list tasks:
+            Export tasks previously returned by claim()
+        :return:
+            The number of tasks whose claims were renewed
+        """
+        threshold = time.time() + self.lease_seconds / 2.
+        due = [task for task in tasks if task.lease_expiry is not None and task.lease_expiry < threshold]
+        if not due:
+            return 0
+        return len(self.renew(due))
+
+    def release(self, tasks):
+        """
+        Give up our claim on tasks which we haven't finished exporting, so that they may be claimed again at once.
+        Tasks which have been completed are released automatically when their status is set.
+
+        :param list tasks:
+            Export tasks previously returned by claim()
+        """
+        self._update_leases(tasks, lease_expiry=0, owner=None)
+
+    def summarise_waiting(self):
+        """
+        Summarise the tasks waiting to be exported, for estimating how long they will take to send
+
+        :return:
+            A list of (name, count, file_bytes) tuples, in the order in which tasks are claimed when there are enough
+            of every type waiting: metadata and observations in order of priority, then files in each size class
+        """
+        summary = []
+        counts = self.count_waiting()
+        order = sorted(EXPORT_QUEUE_TABLES.keys(), key=lambda x: -self.priorities.get(x, 0))
+        for entity_type in order:
+            if entity_type != 'file':
+                summary.append((entity_type, counts[entity_type], 0))
+                continue
+            bounds = self.size_classes + [None]
+            lower = None
+            for upper in bounds:
+                conditions = ''
+                args = []
+                if lower is not None:
+                    conditions += ' AND o.fileSize > %s'
+                    args.append(lower)
+                if upper is not None:
+                    conditions += ' AND o.fileSize <= %s'
+                    args.append(upper)
+                self.db.con.execute('SELECT COUNT(*) AS count, SUM(o.fileSize) AS bytes FROM archive_fileExport x '
+                                    'INNER JOIN archive_exportConfig c ON x.exportConfig=c.uid '
+                                    'INNER JOIN archive_files o ON x.fileId=o.uid '
+                                    'WHERE c.active = 1 AND x.exportState > 0' + conditions, tuple(args))
+                row = self.db.con.fetchone()
+                name = 'file' if upper is None and lower is None else \
+                    'file<={0}'.format(upper) if upper is not None else 'file>{0}'.format(lower)
+                summary.append((name, row['count'], int(row['bytes'] or 0)))
+                lower = upper
+        return summary
+
+    def count_waiting(self):
+        """
+        :return:
+            A dict giving the number of tasks of each type of entity which are waiting to be exported, whether or not
+            they are currently claimed
+        """
+        counts = {}
+        for entity_type, table_info in EXPORT_QUEUE_TABLES.items():
+            self.db.con.execute('SELECT COUNT(*) AS count FROM {0} x '
+                                'INNER JOIN archive_exportConfig c ON x.exportConfig=c.uid '
+                                'WHERE c.active = 1 AND x.exportState > 0'.format(table_info[0]))
+            counts[entity_type] = self.db.con.fetchone()['count']
+        return counts
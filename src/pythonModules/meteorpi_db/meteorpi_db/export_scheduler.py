@@ -0,0 +1,258 @@
+# export_scheduler.py
+# Meteor Pi, Cambridge Science Centre
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+
+# Decides how fast, and in what order, exports are sent. Observatories usually share a domestic internet connection, so
+# exports can be limited to a number of bytes per second, which may vary with the time of day. Metadata and observations
+# are sent before files, and small files such as images before large ones such as videos, so that if there isn't time
+# to send everything before the observatory starts observing again, it is the most useful data which has been sent.
+# Size classes only reorder files whose observations have already been sent, since the importer needs an observation
+# before its files. Files which couldn't be sent before we must stop aren't started.
+
+import time
+import threading
+
+# Default upper bounds, in bytes, of the size classes into which files are divided. Files in the first class, mostly
+# images, are sent before any in the second, and so on; files larger than the last bound are sent last.
+DEFAULT_SIZE_CLASSES = [512 * 1024, 8 * 1024 * 1024]
+
+# Rough number of bytes sent to export an entity, excluding any file data, used to estimate how long exports will take
+ENTITY_OVERHEAD_BYTES = 2048
+
+# Step, in seconds, used when estimating how many bytes can be sent before a deadline
+ESTIMATE_STEP = 300
+
+
+class TokenBucket(object):
+    """
+    Limits the rate at which bytes are sent. Each sender calls consume() with the number of bytes it is about to send,
+    and is made to wait until sending them would keep the average rate within the limit. Large transfers should call
+    consume() for each chunk as it is sent, rather than once for the whole transfer. May be shared between threads, in
+    which case the limit applies to all of them together.
+
+    :ivar float bytes_per_second:
+        The maximum average rate, or None for no limit
+    :ivar float burst_seconds:
+        The number of seconds' worth of bytes which may be sent at once after a quiet period
+    :ivar float deadline:
+        If not None, the unix time by which we must stop sending. Senders aren't made to wait past it.
+    """
+
+    def __init__(self, bytes_per_second=None, burst_seconds=2., deadline=None):
+        self.bytes_per_second = bytes_per_second
+        self.burst_seconds = burst_seconds
+        self.deadline = deadline
+        self._tokens = 0.
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, byte_count):
+        """
+        Wait until byte_count bytes may be sent
+
+        :param int byte_count:
+            The number of bytes about to be sent
+        :return:
+            True once the bytes may be sent, or False at once if we would have to wait past the deadline, in which case
+            the bytes shouldn't be sent
+        """
+        with self._lock:
+            rate = self.bytes_per_second
+            now = time.time()
+            if not rate:
+                self._updated = now
+                return True
+            capacity = rate * self.burst_seconds
+            tokens = min(capacity, self._tokens + (now - self._updated) * rate) - byte_count
+            wait = -tokens / rate if tokens < 0 else 0
+            if self.deadline is not None and now + wait > self.deadline:
+                return False
+            self._tokens = tokens
+            self._updated = now
+        # Sleep outside the lock; other senders will find the bucket in debt and wait their turn after us
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+
+class ExportWindow(object):
+    """
+    A period of each day during which exports are limited to a particular rate and file size
+
+    :ivar float start_hour:
+        The local time at which the window opens, in hours after midnight
+    :ivar float end_hour:
+        The local time at which the window closes. If this is earlier than start_hour the window spans midnight.
+    :ivar float bytes_per_second:
+        The maximum rate at which to send data in this window, or None for no limit
+    :ivar int max_file_size:
+        The largest file, in bytes, to send in this window, or None for no limit
+    """
+
+    def __init__(self, start_hour, end_hour, bytes_per_second=None, max_file_size=None):
+        self.start_hour = start_hour
+        self.end_hour = end_hour
+        self.bytes_per_second = bytes_per_second
+        self.max_file_size = max_file_size
+
+    @staticmethod
+    def from_dict(d):
+        return ExportWindow(start_hour=d['start_hour'], end_hour=d['end_hour'],
+                            bytes_per_second=d.get('bytes_per_second'), max_file_size=d.get('max_file_size'))
+
+    def contains(self, utc):
+        """
+        :param float utc:
+            A unix time
+        :return:
+            True if the local time of day at this instant falls within this window
+        """
+        local = time.localtime(utc)
+        hour = local.tm_hour + local.tm_min / 60. + local.tm_sec / 3600.
+        if self.start_hour <= self.end_hour:
+            return self.start_hour <= hour < self.end_hour
+        return hour >= self.start_hour or hour < self.end_hour
+
+
+class ExportScheduler(object):
+    """
+    Applies a bandwidth limit, time-of-day windows and size classes to exports. The scheduler adjusts the
+    :class:`meteorpi_db.export_queue.ExportQueue` of a database, so that files are claimed smallest size class first and
+    files too large for the current window aren't claimed, and holds a :class:`meteorpi_db.export_scheduler.TokenBucket`
+    which should be passed to each :class:`meteorpi_db.exporter.MeteorExporter`.
+
+    :ivar float bytes_per_second:
+        The rate limit outside any window, or None for no limit
+    :ivar list windows:
+        A list of :class:`meteorpi_db.export_scheduler.ExportWindow`. Where windows overlap the first one applies.
+    :ivar list size_classes:
+        Upper bounds, in bytes, of the file size classes
+    :ivar float link_bytes_per_second:
+        The rate our connection can manage when not limited, used when estimating how long exports will take
+    :ivar float deadline:
+        If not None, the unix time by which we must stop exporting. Files which we estimate couldn't be sent by then
+        aren't claimed.
+    :ivar TokenBucket bandwidth:
+        The rate limiter shared by all exporters using this scheduler
+    """
+
+    def __init__(self, bytes_per_second=None, windows=None, size_classes=None, link_bytes_per_second=None,
+                 deadline=None):
+        self.bytes_per_second = bytes_per_second
+        self.windows = windows or []
+        self.size_classes = sorted(size_classes) if size_classes is not None else list(DEFAULT_SIZE_CLASSES)
+        self.link_bytes_per_second = link_bytes_per_second
+        self.deadline = deadline
+        self.bandwidth = TokenBucket()
+
+    def limits_at(self, utc):
+        """
+        :param float utc:
+            A unix time
+        :return:
+            A tuple of the rate limit in bytes per second and the largest file size to send at this time, either of
+            which may be None for no limit
+        """
+        for window in self.windows:
+            if window.contains(utc):
+                return window.bytes_per_second, window.max_file_size
+        return self.bytes_per_second, None
+
+    def apply(self, db, utc=None):
+        """
+        Set the export queue of a database, and our rate limiter, to the limits in force at a given time. Call this
+        before each batch of exports, so that limits change as windows open and close.
+
+        :param MeteorDatabase db:
+            The database whose export queue should be adjusted
+        :param float utc:
+            The current time, defaults to now
+        """
+        if utc is None:
+            utc = time.time()
+        rate, max_file_size = self.limits_at(utc)
+        self.bandwidth.bytes_per_second = rate
+        self.bandwidth.deadline = self.deadline
+        if self.deadline is not None:
+            # Don't start files which we don't expect to finish sending before we must stop
+            sendable = self.bytes_sendable(utc, self.deadline)
+            if sendable is not None:
+                sendable = max(0, int(sendable) - ENTITY_OVERHEAD_BYTES)
+                max_file_size = sendable if max_file_size is None else min(max_file_size, sendable)
+        db.export_queue.size_classes = list(self.size_classes)
+        db.export_queue.max_file_size = max_file_size
+
+    def bytes_sendable(self, utc_start, utc_end):
+        """
+        Estimate how many bytes we can send between two times, given the rate limits in force
+
+        :param float utc_start:
+            The start of the period
+        :param float utc_end:
+            The end of the period
+        :return:
+            The estimated number of bytes, or None if neither the rate limits nor the speed of our connection are known
+        """
+        total = 0.
+        utc = utc_start
+        while utc < utc_end:
+            step = min(ESTIMATE_STEP, utc_end - utc)
+            rate = self.limits_at(utc)[0]
+            if rate is None:
+                rate = self.link_bytes_per_second
+            if rate is None:
+                return None
+            total += rate * step
+            utc += step
+        return total
+
+    def estimate_backlog(self, db, utc_now, utc_deadline):
+        """
+        Estimate how much of the export backlog will be sent before a deadline, such as the time the observatory must
+        start observing again. Tasks are assumed to be sent in the order the export queue claims them, and the limits on
+        file size in each window are ignored, so this is only a rough guide.
+
+        :param MeteorDatabase db:
+            The database holding the export queue
+        :param float utc_now:
+            The current time
+        :param float utc_deadline:
+            The time by which exporting must stop
+        :return:
+            A list of (name, count, bytes, fraction) tuples for each class of task, in the order they will be sent,
+            where fraction is the estimated fraction of the bytes in that class which will be sent before the deadline,
+            or None if neither the rate limits nor the speed of our connection are known
+        """
+        db.export_queue.size_classes = list(self.size_classes)
+        budget = self.bytes_sendable(utc_now, utc_deadline)
+        estimate = []
+        for name, count, file_bytes in db.export_queue.summarise_waiting():
+            class_bytes = count * ENTITY_OVERHEAD_BYTES + file_bytes
+            if budget is None:
+                fraction = None
+            elif class_bytes == 0:
+                fraction = 1. if budget > 0 else 0.
+            else:
+                fraction = max(0., min(1., budget / class_bytes))
+                budget = max(0., budget - class_bytes)
+            estimate.append((name, count, class_bytes, fraction))
+        return estimate
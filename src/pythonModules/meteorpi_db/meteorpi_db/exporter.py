@@ -21,10 +21,91 @@
 
 # Functions which export database objects to an external server
 
+import os
+import math
+import time
+import threading
 import traceback
-from requests import post
+import Queue
+from requests import Session
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError, ConnectionError
-from requests_toolbelt.multipart.encoder import MultipartEncoder
+from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
+from meteorpi_model import serialisation
+
+# Default number of entities sent to the importer in each batch
+DEFAULT_BATCH_SIZE = 50
+
+# Entities in a batch which the importer asks us to send again, for example after we have sent it their file data, are
+# re-sent in a smaller batch. Give up on them, leaving them to be retried later, after this many rounds.
+MAX_BATCH_ROUNDS = 4
+
+# When assembling a batch, we set aside tasks for other export configurations to be sent in later batches. Stop looking
+# for more tasks for the current batch when we have set aside this many batches' worth.
+MAX_DEFERRED_BATCHES = 4
+
+# Size, in bytes, of the chunks in which files are uploaded to servers which support resumable uploads
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Number of times in a row the importer may fail to accept a chunk before we give up on uploading a file
+MAX_UPLOAD_STALLS = 3
+
+# Width, in seconds, of the time buckets in which we compare our holdings with a server's before exporting
+INVENTORY_BUCKET_SECONDS = 86400
+
+# Maximum number of IDs, and of time buckets, sent in each inventory request. Must not exceed the importer's limits.
+INVENTORY_MAX_IDS = 5000
+INVENTORY_MAX_BUCKETS = 500
+
+# Default number of simultaneous connections, and so simultaneous batches, which we make to any one target server
+DEFAULT_CONNECTIONS_PER_TARGET = 2
+
+# Seconds to wait before sending anything more to a server after successive failed exports to it
+BACKOFF_INTERVALS = [30, 300, 600, 1200, 2400]
+
+
+class SessionPool(object):
+    """
+    Holds a requests Session for each target URL, so that connections to import servers are kept alive and reused
+    between requests rather than making a new TCP connection and TLS handshake for each entity. A pool may be shared
+    between threads.
+    """
+
+    def __init__(self, max_connections=DEFAULT_CONNECTIONS_PER_TARGET):
+        """
+        :param int max_connections:
+            The number of connections to keep open to each target
+        """
+        self.max_connections = max_connections
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session_for(self, target_url):
+        """
+        :param string target_url:
+            The import URL of a target server
+        :return:
+            The Session used for requests to that server
+        """
+        with self._lock:
+            session = self._sessions.get(target_url)
+            if session is None:
+                session = Session()
+                session.verify = False
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[target_url] = session
+            return session
+
+    def close(self):
+        """
+        Close all open connections
+        """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
 
 
 class MeteorExporter(object):
@@ -34,15 +115,66 @@ class MeteorExporter(object):
     This class in effect defines the communication protocol used by this process.
     """
 
-    def __init__(self, db):
+    def __init__(self, db, sessions=None, legacy_targets=None, bandwidth=None, no_chunked_upload_targets=None):
         """
         Build a new MeteorExporter. The export process won't run by default, you must call the appropriate methods on
         this object to actually start exporting.
 
         :param MeteorDatabase db:
             The database to read from, for both entities under replication and the export configurations.
+        :param SessionPool sessions:
+            The HTTP sessions to use, which may be shared with other exporters. A new pool is created if not specified.
+        :param set legacy_targets:
+            Target URLs of servers known not to support the batch import protocol, which may be shared with other
+            exporters. Servers are added to this set as we discover them.
+        :param TokenBucket bandwidth:
+            If specified, a :class:`meteorpi_db.export_scheduler.TokenBucket` which limits the rate at which we send
+            data, and which may be shared with other exporters
+        :param set no_chunked_upload_targets:
+            Target URLs of servers known not to support chunked file uploads, which may be shared with other exporters.
+            Servers are added to this set as we discover them.
         """
         self.db = db
+        self.bandwidth = bandwidth
+        self.sessions = sessions if sessions is not None else SessionPool()
+        # Target URLs of servers which don't support the batch import protocol, to which we send entities one at a time
+        self.legacy_targets = legacy_targets if legacy_targets is not None else set()
+        # Target URLs of servers which don't support chunked uploads, to which we send each file in a single request.
+        # A server may support batches but not chunked uploads, so this is kept separate from legacy_targets.
+        self.no_chunked_upload_targets = no_chunked_upload_targets if no_chunked_upload_targets is not None else set()
+        # Tasks which we've taken from the database queue, but which were for a different target from the batch being
+        # assembled at the time
+        self._deferred_tasks = []
+        # Tasks which we're in the middle of sending
+        self._exporting = []
+
+    def _throttle(self, byte_count):
+        """
+        Wait until we may send byte_count bytes without exceeding our bandwidth limit
+
+        :return:
+            True once the bytes may be sent, or False if they couldn't be sent before the bandwidth limiter's deadline
+        """
+        if self.bandwidth is not None:
+            return self.bandwidth.consume(byte_count)
+        return True
+
+    def renew_leases(self):
+        """
+        Renew our claim on the tasks we're sending or holding back, where at least half of the lease has passed. This is
+        called while sending each request and each chunk of a file, so that a task which takes a long time to send
+        isn't claimed by another exporter meanwhile.
+        """
+        self.db.export_queue.renew_due(self._exporting + self._deferred_tasks)
+
+    def release_tasks(self):
+        """
+        Give up our claim on any tasks we have taken from the export queue but not yet sent, so that they can be
+        claimed again straight away. Call this when finishing exporting.
+        """
+        self.db.release_exports(self._deferred_tasks)
+        self._deferred_tasks = []
+        self.db.commit()
 
     def handle_next_export(self):
         """
@@ -61,6 +193,9 @@ class MeteorExporter(object):
                     A job was processed but an error occurred during processing
                 :confused:
                     A job was processed, but the importer returned a response which we couldn't recognise
+                :deferred:
+                    A job wasn't sent, because the bandwidth limiter's deadline would have passed before it could be.
+                    The job has been released, to be sent on a later run.
         """
         state = None
         while True:
@@ -68,6 +203,8 @@ class MeteorExporter(object):
             if state is None:
                 return None
             elif state.export_task is None:
+                if state.state == 'deferred':
+                    self.db.export_queue.release(self._exporting)
                 return state
 
     def _handle_next_export_subtask(self, export_state=None):
@@ -87,34 +224,35 @@ class MeteorExporter(object):
             export = self.db.get_next_entity_to_export()
             if export is not None:
                 export_state = self.ExportState(export_task=export)
+                self._exporting = [export]
             else:
                 return None
         try:
+            self.renew_leases()
             auth = (export_state.export_task.target_user,
                     export_state.export_task.target_password)
             target_url = export_state.export_task.target_url
-            response = post(url=target_url, verify=False,
-                            json=export_state.entity_dict,
-                            auth=auth)
+            data = serialisation.dumps(export_state.entity_dict)
+            if not self._throttle(len(data)):
+                return export_state.deferred()
+            response = self.sessions.session_for(target_url).post(
+                url=target_url,
+                data=data,
+                headers={'Content-Type': 'application/json'},
+                auth=auth)
             response.raise_for_status()
-            json = response.json()
+            json = serialisation.loads(response.content)
             state = json['state']
             if state == 'complete':
                 return export_state.fully_processed()
             elif state == 'need_file_data':
-                file_id = json['file_id']
-                file_record = self.db.get_file(repository_fname=file_id)
-                if file_record is None:
+                if not self._send_file_data(target_url=target_url, auth=auth, file_id=json['file_id']):
                     return export_state.failed()
-                with open(self.db.file_path_for_id(file_id), 'rb') as file_content:
-                    multi = MultipartEncoder(fields={'file': ('file', file_content, file_record.mime_type)})
-                    post(url="{0}/data/{1}/{2}".format(target_url, file_id, file_record.file_md5),
-                         data=multi, verify=False,
-                         headers={'Content-Type': multi.content_type},
-                         auth=auth)
                 return export_state.partially_processed()
             elif state == 'continue':
                 return export_state.partially_processed()
+            elif state == 'failed':
+                return export_state.failed()
             else:
                 return export_state.confused()
         except HTTPError:
@@ -123,6 +261,401 @@ class MeteorExporter(object):
         except ConnectionError:
             traceback.print_exc()
             return export_state.failed()
+        except (ValueError, KeyError, TypeError):
+            traceback.print_exc()
+            return export_state.confused()
+
+    def _send_file_data(self, target_url, auth, file_id):
+        """
+        Send the contents of a file to the importer, in response to a need_file_data state. Files are uploaded in
+        chunks, so that an interrupted upload resumes where it left off when the entity is next exported. Servers which
+        don't support chunked uploads are sent the whole file in a single request.
+
+        :param string target_url:
+            The import URL of the target server
+        :param tuple auth:
+            The username and password to authenticate with
+        :param string file_id:
+            The repository ID of the file to send
+        :return:
+            True if the file was sent, False if we don't have a record of this file, the importer rejected it, or we
+            ran out of time to send it
+        """
+        file_record = self.db.get_file(repository_fname=file_id)
+        if file_record is None:
+            return False
+        file_path = self.db.file_path_for_id(file_id)
+        if target_url not in self.no_chunked_upload_targets:
+            sent = self._upload_file_chunks(target_url=target_url, auth=auth, file_id=file_id,
+                                            file_md5=file_record.file_md5, file_path=file_path)
+            if sent is not None:
+                return sent
+            self.no_chunked_upload_targets.add(target_url)
+        # Throttle each block of the request body as it is read, rather than reserving the whole file in one go
+        progress = {'sent': 0}
+
+        def throttle_block(monitor):
+            if not self._throttle(monitor.bytes_read - progress['sent']):
+                raise self.DeadlineReached()
+            progress['sent'] = monitor.bytes_read
+            self.renew_leases()
+
+        with open(file_path, 'rb') as file_content:
+            multi = MultipartEncoder(fields={'file': ('file', file_content, file_record.mime_type)})
+            monitor = MultipartEncoderMonitor(multi, throttle_block)
+            try:
+                self.sessions.session_for(target_url).post(
+                    url="{0}/data/{1}/{2}".format(target_url, file_id, file_record.file_md5),
+                    data=monitor,
+                    headers={'Content-Type': monitor.content_type},
+                    auth=auth)
+            except self.DeadlineReached:
+                return False
+        return True
+
+    def _upload_file_chunks(self, target_url, auth, file_id, file_md5, file_path, chunk_size=UPLOAD_CHUNK_SIZE):
+        """
+        Upload a file using the resumable chunked upload protocol. The importer tells us how much of the file it
+        already holds, and we send the rest in chunks, then ask it to check the MD5 sum.
+
+        :param string target_url:
+            The import URL of the target server
+        :param tuple auth:
+            The username and password to authenticate with
+        :param string file_id:
+            The repository ID of the file to send
+        :param string file_md5:
+            The MD5 sum of the file
+        :param string file_path:
+            The path of the file in our file store
+        :param int chunk_size:
+            The number of bytes to send in each request
+        :return:
+            True if the importer now holds the file, False if it rejected it, or None if it doesn't support chunked
+            uploads
+        """
+        session = self.sessions.session_for(target_url)
+        upload_url = "{0}/upload/{1}/{2}".format(target_url, file_id, file_md5)
+        response = session.post(url=upload_url, auth=auth)
+        if response.status_code in (404, 405):
+            return None
+        response.raise_for_status()
+        reply = serialisation.loads(response.content)
+        file_size = os.path.getsize(file_path)
+        stalls = 0
+        with open(file_path, 'rb') as file_content:
+            while reply.get('state') == 'upload' and reply.get('offset', 0) < file_size:
+                offset = reply.get('offset', 0)
+                file_content.seek(offset)
+                chunk = file_content.read(chunk_size)
+                if not self._throttle(len(chunk)):
+                    # We've run out of time; the importer keeps what it has, so the upload resumes from here next time
+                    return False
+                self.renew_leases()
+                response = session.post(url="{0}/{1}".format(upload_url, offset), data=chunk,
+                                        headers={'Content-Type': 'application/octet-stream'},
+                                        auth=auth)
+                response.raise_for_status()
+                reply = serialisation.loads(response.content)
+                if reply.get('state') == 'upload' and reply.get('offset', 0) <= offset:
+                    stalls += 1
+                    if stalls >= MAX_UPLOAD_STALLS:
+                        return False
+                else:
+                    stalls = 0
+        if reply.get('state') == 'upload':
+            response = session.post(url="{0}/finish".format(upload_url), auth=auth)
+            response.raise_for_status()
+            reply = serialisation.loads(response.content)
+        return reply.get('state') == 'continue'
+
+    def reconcile_inventory(self, export_config, bucket_size=INVENTORY_BUCKET_SECONDS):
+        """
+        Ask the target server of an export configuration which of the entities waiting to be sent it already holds,
+        and mark those as exported without sending them. This turns re-synchronising with a server, for example when
+        an export configuration is re-enabled or an observatory comes back online after an outage, into a handful of
+        requests rather than one for every entity.
+
+        Waiting entities are grouped by observatory and time bucket, and for each bucket we send a digest of all the
+        entities we hold in it. If the server's digest matches, it holds everything in the bucket. For the remaining
+        buckets, and for entities with no time, we send the IDs of the waiting entities themselves.
+
+        :param ExportConfiguration export_config:
+            The :class:`meteorpi_model.ExportConfiguration` to reconcile
+        :param int bucket_size:
+            The width of the time buckets, in seconds
+        :return:
+            The number of entities marked as exported, or None if the server couldn't tell us what it holds
+        """
+        target_url = export_config.target_url
+        auth = (export_config.user_id, export_config.password)
+        config_id = export_config.config_id
+        entity_type = export_config.type
+        pending = self.db.get_pending_exports(config_id=config_id, entity_type=entity_type)
+        if not pending:
+            return 0
+
+        buckets = {}
+        # Entities with no time, such as metadata whose setAtTime is NULL, can't be put in a bucket
+        unresolved = []
+        for entity_id, obstory_id, entity_time in pending:
+            if entity_time is None:
+                unresolved.append(entity_id)
+                continue
+            key = (obstory_id, int(math.floor(entity_time / bucket_size)))
+            buckets.setdefault(key, []).append(entity_id)
+        keys = sorted(buckets.keys())
+
+        def inventory(request_dict):
+            response = self.sessions.session_for(target_url).post(
+                url="{0}/inventory".format(target_url),
+                data=serialisation.dumps(request_dict),
+                headers={'Content-Type': 'application/json'},
+                auth=auth)
+            if response.status_code in (404, 405):
+                return None
+            response.raise_for_status()
+            return serialisation.loads(response.content)
+
+        held = []
+        try:
+            for i in range(0, len(keys), INVENTORY_MAX_BUCKETS):
+                chunk = keys[i:i + INVENTORY_MAX_BUCKETS]
+                bucket_dicts = []
+                for obstory_id, bucket in chunk:
+                    time_min = bucket * bucket_size
+                    time_max = (bucket + 1) * bucket_size
+                    bucket_dicts.append({'obstory_id': obstory_id, 'time_min': time_min, 'time_max': time_max,
+                                         'digest': self.db.get_inventory_digest(entity_type=entity_type,
+                                                                                obstory_id=obstory_id,
+                                                                                time_min=time_min,
+                                                                                time_max=time_max)})
+                reply = inventory({'type': entity_type, 'buckets': bucket_dicts})
+                if reply is None:
+                    return None
+                mismatched = set(reply['mismatched'])
+                for index, key in enumerate(chunk):
+                    if index in mismatched:
+                        unresolved.extend(buckets[key])
+                    else:
+                        held.extend(buckets[key])
+            for i in range(0, len(unresolved), INVENTORY_MAX_IDS):
+                chunk = unresolved[i:i + INVENTORY_MAX_IDS]
+                reply = inventory({'type': entity_type, 'ids': chunk})
+                if reply is None:
+                    return None
+                missing = set(reply['missing'])
+                held.extend(entity_id for entity_id in chunk if entity_id not in missing)
+        except (HTTPError, ConnectionError):
+            traceback.print_exc()
+            return None
+        except (ValueError, KeyError, TypeError):
+            traceback.print_exc()
+            return None
+        self.db.mark_exported(config_id=config_id, entity_type=entity_type, entity_ids=held)
+        return len(held)
+
+    def handle_next_export_batch(self, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Retrieve up to batch_size export tasks for the same export configuration, and send them to the importer in a
+        single request, followed by any binary data it asks for. Servers which don't understand batches are sent each
+        entity individually, using the same protocol as handle_next_export.
+
+        :param int batch_size:
+            The maximum number of entities to send in one request
+        :return:
+            An instance of ExportBatchState summarising what happened to each of the entities, or None if there were no
+            jobs to run
+        """
+        tasks = self.next_export_batch(batch_size=batch_size)
+        if not tasks:
+            return None
+        return self.export_tasks(tasks)
+
+    def export_tasks(self, tasks):
+        """
+        Send a list of export tasks, all for the same export configuration, to the importer, using the batch protocol
+        if the server supports it and sending entities one at a time otherwise.
+
+        :param list tasks:
+            The export tasks to send
+        :return:
+            An instance of ExportBatchState summarising what happened to each of the entities
+        """
+        target_url = tasks[0].target_url
+        batch_state = None
+        self._exporting = list(tasks)
+        try:
+            if target_url not in self.legacy_targets:
+                try:
+                    batch_state = self._export_batch(tasks)
+                except self.BatchNotSupported:
+                    self.legacy_targets.add(target_url)
+            if batch_state is None:
+                batch_state = self.ExportBatchState()
+                for task in tasks:
+                    state = self.ExportState(export_task=task)
+                    while state.export_task is not None:
+                        state = self._handle_next_export_subtask(export_state=state)
+                    batch_state.add(state)
+        finally:
+            self._exporting = []
+        # Give up our claim on tasks which failed or which we ran out of time to send, so that they can be sent again
+        # once the server has recovered or on the next run, rather than when their leases expire
+        unsent = set((x.config_id, x.entity_id) for x in batch_state.states if x.state in ('failed', 'deferred'))
+        if unsent:
+            self.db.export_queue.release([task for task in tasks if (task.config_id, task.get_entity_id()) in unsent])
+        return batch_state
+
+    def next_export_batch(self, batch_size):
+        """
+        Take up to batch_size tasks from the database export queue, all for the same export configuration. Tasks for
+        other configurations which we take from the queue on the way are held back by this exporter, and returned by
+        later calls; renew_leases() keeps our claim on them. The caller becomes responsible for the tasks returned: it
+        should send them with export_tasks(), or release them with the database's release_exports(). When finished,
+        call release_tasks() to release any tasks still held back.
+
+        :param int batch_size:
+            The maximum number of tasks to return
+        :return:
+            A list of export tasks, which is empty if there is nothing to export
+        """
+        tasks = []
+        config_id = None
+        remaining = []
+        for task in self._deferred_tasks:
+            if config_id is None:
+                config_id = task.config_id
+            if task.config_id == config_id and len(tasks) < batch_size:
+                tasks.append(task)
+            else:
+                remaining.append(task)
+        self._deferred_tasks = remaining
+        # Tasks for several configurations may be interleaved in the queue, so keep looking past those for other
+        # configurations, up to a limit
+        while len(tasks) < batch_size and len(self._deferred_tasks) < batch_size * MAX_DEFERRED_BATCHES:
+            task = self.db.get_next_entity_to_export()
+            if task is None:
+                break
+            if config_id is None:
+                config_id = task.config_id
+            if task.config_id == config_id:
+                tasks.append(task)
+            else:
+                self._deferred_tasks.append(task)
+        return tasks
+
+    def _export_batch(self, tasks):
+        """
+        Send a list of export tasks for the same export configuration to the importer using the batch protocol
+
+        :param list tasks:
+            The export tasks to send
+        :return:
+            An instance of ExportBatchState
+        :raises:
+            BatchNotSupported if the target server doesn't implement the batch protocol
+        """
+        target_url = tasks[0].target_url
+        auth = (tasks[0].target_user, tasks[0].target_password)
+        batch_state = self.ExportBatchState()
+        outstanding = [self.ExportState(export_task=task) for task in tasks]
+        for round_number in range(MAX_BATCH_ROUNDS):
+            if not outstanding:
+                break
+            try:
+                self.renew_leases()
+                data = serialisation.dumps({'entities': [x.entity_dict for x in outstanding]})
+                if not self._throttle(len(data)):
+                    for export_state in outstanding:
+                        batch_state.add(export_state.deferred())
+                    return batch_state
+                response = self.sessions.session_for(target_url).post(
+                    url="{0}/batch".format(target_url),
+                    data=data,
+                    headers={'Content-Type': 'application/json'},
+                    auth=auth)
+                if response.status_code in (404, 405) and round_number == 0:
+                    raise self.BatchNotSupported()
+                response.raise_for_status()
+                replies = serialisation.loads(response.content)['states']
+                if len(replies) != len(outstanding):
+                    raise ValueError("Importer returned {0} states for {1} entities".format(len(replies),
+                                                                                       len(outstanding)))
+                still_outstanding = []
+                for export_state, reply in zip(outstanding, replies):
+                    state = reply.get('state')
+                    if state == 'complete':
+                        batch_state.add(export_state.fully_processed())
+                    elif state == 'need_file_data':
+                        if self._send_file_data(target_url=target_url, auth=auth, file_id=reply['file_id']):
+                            still_outstanding.append(export_state.partially_processed())
+                        else:
+                            batch_state.add(export_state.failed())
+                    elif state == 'continue':
+                        still_outstanding.append(export_state.partially_processed())
+                    elif state == 'failed':
+                        batch_state.add(export_state.failed())
+                    else:
+                        batch_state.add(export_state.confused())
+                outstanding = still_outstanding
+            except (HTTPError, ConnectionError):
+                traceback.print_exc()
+                for export_state in outstanding:
+                    batch_state.add(export_state.failed())
+                return batch_state
+            except (ValueError, KeyError, TypeError):
+                traceback.print_exc()
+                for export_state in outstanding:
+                    batch_state.add(export_state.confused())
+                return batch_state
+        # Anything left over is still queued in the database, and will be sent again in a later batch
+        for export_state in outstanding:
+            batch_state.add(export_state)
+        return batch_state
+
+    class BatchNotSupported(Exception):
+        """
+        Raised when a target server doesn't implement the batch import protocol
+        """
+        pass
+
+    class DeadlineReached(Exception):
+        """
+        Raised to abandon sending a file when the bandwidth limiter says we have run out of time
+        """
+        pass
+
+    class ExportBatchState(object):
+        """
+        Summarises the outcome of sending a batch of entities. The 'state' field has the same meanings as in
+        ExportState, applying to the batch as a whole: it is 'failed' if any entity failed, otherwise 'confused' if the
+        importer returned a response we couldn't recognise for any entity, otherwise 'deferred' if we ran out of time to
+        send some entities, otherwise 'partial' if some entities were left unfinished, and otherwise 'complete'.
+
+        :ivar list states:
+            The ExportState of each entity in the batch
+        :ivar dict counts:
+            The number of entities in each state
+        """
+
+        def __init__(self):
+            self.states = []
+            self.counts = {}
+
+        def add(self, export_state):
+            self.states.append(export_state)
+            self.counts[export_state.state] = self.counts.get(export_state.state, 0) + 1
+
+        @property
+        def state(self):
+            for state in ('failed', 'confused', 'deferred', 'partial'):
+                if self.counts.get(state):
+                    return state
+            return 'complete'
+
+        def __str__(self):
+            return ', '.join('{0} {1}'.format(count, state) for state, count in sorted(self.counts.items()))
 
     class ExportState(object):
         """
@@ -163,6 +696,224 @@ class MeteorExporter(object):
             self.entity_dict = None
             return self
 
+        def deferred(self):
+            self.state = "deferred"
+            self.export_task = None
+            self.entity_dict = None
+            return self
+
+
+class ConcurrentExporter(object):
+    """
+    Runs exports in a pool of worker threads, so that several batches, to one or more servers, are in progress at
+    once. The calling thread takes tasks from the database queue and hands them in batches to the workers, each of
+    which has its own database connection and a :class:`meteorpi_db.exporter.MeteorExporter` sharing a common
+    :class:`meteorpi_db.exporter.SessionPool`. The number of batches in progress to any one server is limited, and a
+    server which fails is backed off without holding up exports to other servers.
+
+    Each task is only ever held by one worker at a time, and workers update the archive_*Export rows of their own
+    tasks on their own connection, committing after each batch, so no two connections update the same row at once.
+    """
+
+    def __init__(self, db, workers=4, max_per_target=DEFAULT_CONNECTIONS_PER_TARGET, batch_size=DEFAULT_BATCH_SIZE,
+                 max_failures=len(BACKOFF_INTERVALS), bandwidth=None):
+        """
+        :param MeteorDatabase db:
+            The database from which export tasks are taken. Each worker opens its own connection to the same database.
+        :param int workers:
+            The number of batches which may be in progress at once
+        :param int max_per_target:
+            The number of batches which may be in progress at once to any one target URL
+        :param int batch_size:
+            The maximum number of entities sent in each batch
+        :param int max_failures:
+            The number of successive failed batches after which we give up on a target until the next run
+        :param TokenBucket bandwidth:
+            If specified, limits the rate at which all of the workers together send data
+        """
+        self.db = db
+        self.workers = workers
+        self.max_per_target = max_per_target
+        self.batch_size = batch_size
+        self.max_failures = max_failures
+        self.sessions = SessionPool(max_connections=max_per_target)
+        self.legacy_targets = set()
+        self.no_chunked_upload_targets = set()
+        self.bandwidth = bandwidth
+        # Assembles batches on the calling thread, holding back tasks for other configurations until their turn; see
+        # MeteorExporter.next_export_batch()
+        self._exporter = MeteorExporter(db=db, sessions=self.sessions, legacy_targets=self.legacy_targets,
+                                        bandwidth=bandwidth, no_chunked_upload_targets=self.no_chunked_upload_targets)
+
+    def _open_db(self):
+        """
+        :return:
+            A new connection to the same database as self.db, for use by a worker thread
+        """
+        db = self.db
+        return db.__class__(file_store_path=db.file_store_path, db_host=db.db_host, db_user=db.db_user,
+                            db_password=db.db_password, db_name=db.db_name, obstory_name=db.obstory_name)
+
+    def _worker(self, jobs, results):
+        """
+        Body of each worker thread. Takes lists of tasks from the jobs queue until it receives None, putting a tuple of
+        the tasks and their ExportBatchState, or None if the export raised an exception, onto the results queue.
+        """
+        db = self._open_db()
+        # The tasks were claimed by the calling thread, so act as the same owner when releasing them
+        db.export_queue.owner = self.db.export_queue.owner
+        exporter = MeteorExporter(db=db, sessions=self.sessions, legacy_targets=self.legacy_targets,
+                                  bandwidth=self.bandwidth, no_chunked_upload_targets=self.no_chunked_upload_targets)
+        try:
+            while True:
+                tasks = jobs.get()
+                if tasks is None:
+                    break
+                # Read entities and update export states using this thread's connection
+                for task in tasks:
+                    task.db = db
+                try:
+                    batch_state = exporter.export_tasks(tasks)
+                    db.commit()
+                except Exception:
+                    traceback.print_exc()
+                    batch_state = None
+                    try:
+                        db.rollback()
+                        db.export_queue.release(tasks)
+                    except Exception:
+                        traceback.print_exc()
+                results.put((tasks, batch_state))
+        finally:
+            db.close_db()
+
+    def run(self, should_continue=None, report=None):
+        """
+        Export entities until there are none left, should_continue returns False, the bandwidth limiter says there's
+        no time left to send anything, or we have given up on every server with entities waiting to be sent to it.
+
+        :param function should_continue:
+            Called with no arguments before starting each batch, returning False to stop starting new batches. Batches
+            already in progress are allowed to finish.
+        :param function report:
+            Called with the target URL and ExportBatchState of each batch as it finishes. The ExportBatchState is None
+            if the export raised an exception.
+        :return:
+            An ExportBatchState summarising all of the entities sent
+        """
+        jobs = Queue.Queue()
+        results = Queue.Queue()
+        threads = [threading.Thread(target=self._worker, args=(jobs, results)) for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        summary = MeteorExporter.ExportBatchState()
+        # Number of batches in progress, successive failures, and the time before which we won't send anything, for
+        # each target URL
+        running = {}
+        failures = {}
+        backoff_until = {}
+        given_up = set()
+        # (config_id, entity_id) of each task held by a worker, so that we never hand the same task to two workers
+        in_flight = set()
+        # Batches waiting for their target to have a free slot, or to come out of backoff
+        held = []
+        # Tasks for targets we've given up on, which we keep hold of until we finish so we don't take them again
+        skipped = []
+        active = 0
+        exhausted = False
+        # Set when the tasks we took from the queue were all held by workers already, in which case we wait for a
+        # batch to finish before looking again
+        starved = False
+        # Set when a batch was deferred because it couldn't be sent before the bandwidth limiter's deadline
+        out_of_time = False
+
+        def ready(target_url):
+            return running.get(target_url, 0) < self.max_per_target and backoff_until.get(target_url, 0) <= time.time()
+
+        try:
+            while True:
+                stopping = out_of_time or (should_continue is not None and not should_continue())
+                # Keep hold of the tasks waiting for a worker; the workers renew their own
+                self.db.export_queue.renew_due([task for batch in held for task in batch] + skipped)
+                self._exporter.renew_leases()
+
+                # Start as many batches as we have free workers for
+                while active < self.workers and not stopping:
+                    tasks = None
+                    for index, batch in enumerate(held):
+                        if ready(batch[0].target_url):
+                            tasks = held.pop(index)
+                            break
+                    if tasks is None:
+                        if exhausted or starved or len(held) >= self.workers:
+                            break
+                        # Make sure we see the export states committed by the workers
+                        self.db.commit()
+                        tasks = self._exporter.next_export_batch(batch_size=self.batch_size)
+                        if not tasks:
+                            exhausted = True
+                            break
+                        if tasks[0].target_url in given_up:
+                            skipped.extend(tasks)
+                            continue
+                        tasks = [task for task in tasks if (task.config_id, task.get_entity_id()) not in in_flight]
+                        if not tasks:
+                            starved = True
+                            break
+                        if not ready(tasks[0].target_url):
+                            held.append(tasks)
+                            continue
+                    target_url = tasks[0].target_url
+                    running[target_url] = running.get(target_url, 0) + 1
+                    in_flight.update((task.config_id, task.get_entity_id()) for task in tasks)
+                    active += 1
+                    jobs.put(tasks)
+
+                if active == 0:
+                    if stopping or not held:
+                        break
+                    # Everything left is waiting for a server to come out of backoff
+                    wait = min(backoff_until.get(batch[0].target_url, 0) for batch in held) - time.time()
+                    time.sleep(max(0, min(wait, 10)))
+                    continue
+
+                try:
+                    tasks, batch_state = results.get(timeout=10)
+                except Queue.Empty:
+                    continue
+                target_url = tasks[0].target_url
+                active -= 1
+                starved = False
+                running[target_url] -= 1
+                in_flight.difference_update((task.config_id, task.get_entity_id()) for task in tasks)
+                if batch_state is not None:
+                    for export_state in batch_state.states:
+                        summary.add(export_state)
+                    if batch_state.counts.get('deferred'):
+                        out_of_time = True
+                if batch_state is None or batch_state.state == 'failed':
+                    failures[target_url] = failures.get(target_url, 0) + 1
+                    if failures[target_url] >= self.max_failures:
+                        given_up.add(target_url)
+                        skipped.extend(task for batch in held if batch[0].target_url == target_url for task in batch)
+                        held = [batch for batch in held if batch[0].target_url != target_url]
+                    else:
+                        backoff_until[target_url] = time.time() + BACKOFF_INTERVALS[failures[target_url] - 1]
+                else:
+                    failures[target_url] = 0
+                if report is not None:
+                    report(target_url, batch_state)
+        finally:
+            for thread in threads:
+                jobs.put(None)
+            for thread in threads:
+                thread.join()
+            self.db.release_exports([task for batch in held for task in batch] + skipped)
+            self._exporter.release_tasks()
+        return summary
+
 
 class ObservationExportTask(object):
     """
@@ -171,6 +922,8 @@ class ObservationExportTask(object):
     state in the database.
     """
 
+    entity_type = 'observation'
+
     def __init__(self, db, config_id, observation_id, status, target_url, target_user, target_password):
         self.db = db
         self.config_id = config_id
@@ -179,6 +932,8 @@ class ObservationExportTask(object):
         self.target_url = target_url
         self.target_user = target_user
         self.target_password = target_password
+        # Unix time at which our claim on this task lapses, kept up to date by the export queue. None if we've lost it.
+        self.lease_expiry = 0
 
     def get_observation(self):
         return self.db.get_observation(self.observation_id)
@@ -196,11 +951,14 @@ class ObservationExportTask(object):
         return self.observation_id
 
     def set_status(self, status):
+        # Only touch the row while we still hold it, so that if our lease lapsed and another exporter has claimed the
+        # task, we don't clear its claim
         self.db.con.execute('UPDATE archive_observationExport x '
-                            'SET x.exportState = %s '
+                            'SET x.exportState = %s, x.leaseOwner = NULL, x.leaseExpiry = 0 '
                             'WHERE x.observationId = (SELECT uid FROM archive_observations o WHERE o.publicId=%s) '
-                            'AND x.exportConfig = (SELECT uid FROM archive_exportConfig o WHERE o.exportConfigId=%s) ',
-                            (status, self.observation_id, self.config_id))
+                            'AND x.exportConfig = (SELECT uid FROM archive_exportConfig o WHERE o.exportConfigId=%s) '
+                            'AND x.leaseOwner = %s',
+                            (status, self.observation_id, self.config_id, self.db.export_queue.owner))
 
 
 class FileExportTask(object):
@@ -210,6 +968,8 @@ class FileExportTask(object):
     completion state in the database.
     """
 
+    entity_type = 'file'
+
     def __init__(self, db, config_id, file_id, status, target_url, target_user, target_password):
         self.db = db
         self.config_id = config_id
@@ -218,6 +978,8 @@ class FileExportTask(object):
         self.target_url = target_url
         self.target_user = target_user
         self.target_password = target_password
+        # Unix time at which our claim on this task lapses, kept up to date by the export queue. None if we've lost it.
+        self.lease_expiry = 0
 
     def get_file(self):
         return self.db.get_file(self.file_id)
@@ -236,10 +998,11 @@ class FileExportTask(object):
 
     def set_status(self, status):
         self.db.con.execute('UPDATE archive_fileExport x '
-                            'SET x.exportState = %s '
+                            'SET x.exportState = %s, x.leaseOwner = NULL, x.leaseExpiry = 0 '
                             'WHERE x.fileId = (SELECT uid FROM archive_files o WHERE o.repositoryFname=%s) '
-                            'AND x.exportConfig = (SELECT uid FROM archive_exportConfig o WHERE o.exportConfigId=%s) ',
-                            (status, self.file_id, self.config_id))
+                            'AND x.exportConfig = (SELECT uid FROM archive_exportConfig o WHERE o.exportConfigId=%s) '
+                            'AND x.leaseOwner = %s',
+                            (status, self.file_id, self.config_id, self.db.export_queue.owner))
 
 
 class MetadataExportTask(object):
@@ -249,6 +1012,8 @@ class MetadataExportTask(object):
     completion state in the database.
     """
 
+    entity_type = 'metadata'
+
     def __init__(self, db, config_id, metadata_id, status, target_url, target_user, target_password):
         self.db = db
         self.config_id = config_id
@@ -257,6 +1022,8 @@ class MetadataExportTask(object):
         self.target_url = target_url
         self.target_user = target_user
         self.target_password = target_password
+        # Unix time at which our claim on this task lapses, kept up to date by the export queue. None if we've lost it.
+        self.lease_expiry = 0
 
     def get_metadata(self):
         return self.db.get_obstory_metadata(self.metadata_id)
@@ -275,7 +1042,8 @@ class MetadataExportTask(object):
 
     def set_status(self, status):
         self.db.con.execute('UPDATE archive_metadataExport x '
-                            'SET x.exportState = %s '
+                            'SET x.exportState = %s, x.leaseOwner = NULL, x.leaseExpiry = 0 '
                             'WHERE x.metadataId = (SELECT uid FROM archive_metadata o WHERE o.publicId=%s) '
-                            'AND x.exportConfig = (SELECT uid FROM archive_exportConfig o WHERE o.exportConfigId=%s) ',
-                            (status, self.metadata_id, self.config_id))
+                            'AND x.exportConfig = (SELECT uid FROM archive_exportConfig o WHERE o.exportConfigId=%s) '
+                            'AND x.leaseOwner = %s',
+                            (status, self.metadata_id, self.config_id, self.db.export_queue.owner))
@@ -16,6 +16,8 @@ setup(
         'passlib',
         'requests',
         'requests-toolbelt'],
+    extras_require={
+        'derivatives': ['Pillow', 'numpy']},
     include_package_data=True,
     test_suite='nose.collector',
     tests_require=['nose'],
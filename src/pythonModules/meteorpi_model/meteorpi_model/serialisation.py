@@ -0,0 +1,209 @@
+# serialisation.py
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# Functions which convert Meteor Pi model and search objects to and from JSON strings
+
+import json
+
+import meteorpi_model as mp
+
+# Use the fastest JSON library we can find. ujson and simplejson (with its C speedups) are both considerably faster
+# than the standard library module when encoding the large lists of dicts we return from searches.
+try:
+    import ujson as _json_library
+
+    JSON_LIBRARY = 'ujson'
+except ImportError:
+    try:
+        import simplejson as _json_library
+
+        JSON_LIBRARY = 'simplejson'
+    except ImportError:
+        _json_library = json
+        JSON_LIBRARY = 'json'
+
+if JSON_LIBRARY == 'ujson':
+    def dumps(obj):
+        """
+        Encode a structure of dicts, lists, strings and numbers as a compact JSON string
+
+        :param obj:
+            The object to encode
+        :return:
+            A JSON string
+        """
+        return _json_library.dumps(obj, ensure_ascii=False)
+else:
+    def dumps(obj):
+        """
+        Encode a structure of dicts, lists, strings and numbers as a compact JSON string
+
+        :param obj:
+            The object to encode
+        :return:
+            A JSON string
+        """
+        return _json_library.dumps(obj, separators=(',', ':'))
+
+loads = _json_library.loads
+
+
+def loads_legacy(text):
+    """
+    Decode a string which should contain JSON, but which may have been written as YAML by an older client. The YAML
+    parser is many times slower than the JSON one, so is only used if the string isn't valid JSON.
+
+    :param string text:
+        The string to decode
+    :return:
+        The decoded structure of dicts, lists, strings and numbers
+    :raises:
+        ValueError if the string is neither valid JSON nor valid YAML
+    """
+    try:
+        return loads(text)
+    except ValueError:
+        pass
+    from yaml import safe_load, YAMLError
+    try:
+        return safe_load(text)
+    except YAMLError:
+        raise ValueError("Could not parse string as either JSON or YAML")
+
+
+class ModelCodec(object):
+    """
+    Encodes and decodes instances of a single model or search class, such as :class:`meteorpi_model.FileRecord`, to
+    and from JSON. One codec is built for each class when this module is imported, so callers don't need to look up
+    the conversion methods each time they are used.
+
+    :ivar string name:
+        The name by which this codec is registered, e.g. 'file' or 'observation_search'
+    :ivar model_class:
+        The class which this codec handles
+    """
+
+    def __init__(self, name, model_class):
+        self.name = name
+        self.model_class = model_class
+        self.from_dict = model_class.from_dict
+
+    def encode(self, item):
+        """
+        :param item:
+            An instance of this codec's model class
+        :return:
+            A JSON string representing the item
+        """
+        return dumps(item.as_dict())
+
+    def decode(self, text):
+        """
+        :param string text:
+            A JSON string, as produced by encode()
+        :return:
+            A new instance of this codec's model class
+        """
+        return self.from_dict(loads(text))
+
+    def decode_legacy(self, text):
+        """
+        As decode(), but also accepts YAML strings from older clients
+
+        :param string text:
+            A JSON or YAML string
+        :return:
+            A new instance of this codec's model class
+        """
+        return self.from_dict(loads_legacy(text))
+
+    @staticmethod
+    def as_dicts(items):
+        """
+        :param items:
+            An iterable of instances of this codec's model class
+        :return:
+            A list of dicts, ready to be included in a larger structure passed to dumps()
+        """
+        return [item.as_dict() for item in items]
+
+    def from_dicts(self, dicts):
+        """
+        :param dicts:
+            An iterable of dicts, as produced by as_dicts()
+        :return:
+            A list of new instances of this codec's model class
+        """
+        from_dict = self.from_dict
+        return [from_dict(d) for d in dicts]
+
+    def encode_list(self, items):
+        """
+        :param items:
+            An iterable of instances of this codec's model class
+        :return:
+            A JSON string containing an array of the items
+        """
+        return dumps(self.as_dicts(items))
+
+    def decode_list(self, text):
+        """
+        :param string text:
+            A JSON string containing an array, as produced by encode_list()
+        :return:
+            A list of new instances of this codec's model class
+        """
+        return self.from_dicts(loads(text))
+
+
+user = ModelCodec('user', mp.User)
+file_record = ModelCodec('file', mp.FileRecord)
+observation = ModelCodec('observation', mp.Observation)
+obstory_metadata = ModelCodec('metadata', mp.ObservatoryMetadata)
+obsgroup = ModelCodec('obsgroup', mp.ObservationGroup)
+meta = ModelCodec('meta', mp.Meta)
+meta_constraint = ModelCodec('meta_constraint', mp.MetaConstraint)
+export_configuration = ModelCodec('export_configuration', mp.ExportConfiguration)
+file_record_search = ModelCodec('file_search', mp.FileRecordSearch)
+observation_search = ModelCodec('observation_search', mp.ObservationSearch)
+obsgroup_search = ModelCodec('obsgroup_search', mp.ObservationGroupSearch)
+obstory_metadata_search = ModelCodec('metadata_search', mp.ObservatoryMetadataSearch)
+
+codecs = dict((codec.name, codec) for codec in [user, file_record, observation, obstory_metadata, obsgroup, meta,
+                                                  meta_constraint, export_configuration, file_record_search,
+                                                  observation_search, obsgroup_search, obstory_metadata_search])
+
+
+def codec_for_name(name):
+    """
+    Look up the codec registered under a given name
+
+    :param string name:
+        The name of the codec, e.g. 'file', 'observation' or 'metadata'. These match the 'type' field used by the
+        import API.
+    :return:
+        A :class:`meteorpi_model.serialisation.ModelCodec`
+    :raises:
+        ValueError if there is no codec with this name
+    """
+    if name not in codecs:
+        raise ValueError("Unknown entity type: %s" % name)
+    return codecs[name]
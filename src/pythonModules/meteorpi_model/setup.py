@@ -8,6 +8,7 @@ setup(name='meteorpi_model',
       author_email='tomoinn@crypticsquid.com',
       license='GPL',
       packages=['meteorpi_model'],
+      extras_require={'fastjson': ['ujson']},
       test_suite='nose.collector',
       tests_require=['nose'],
       zip_safe=False)
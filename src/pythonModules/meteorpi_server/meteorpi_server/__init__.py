@@ -18,13 +18,35 @@
 # along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
 # -------------------------------------------------
 
+import os
 from functools import wraps
 
-from flask import Flask, request, g
-from meteorpi_db import MeteorDatabase
-from flask.ext.jsonpify import jsonify
+from flask import Flask, Response, request, g, has_request_context
+from meteorpi_db import MeteorDatabase, derivatives
+from meteorpi_model import serialisation
 from flask.ext.cors import CORS
 
+from meteorpi_server import file_serving, caching, compression, metrics, upload_spool, ingest_spool
+
+
+def json_response(obj, status_code=200):
+    """
+    Build a response containing a JSON representation of the supplied object, encoded using the fastest available JSON
+    library. As with flask-jsonpify, if the request has a 'callback' parameter the JSON is wrapped as a JSONP call.
+
+    :param obj:
+        A structure of dicts, lists, strings and numbers to send
+    :param int status_code:
+        The HTTP status code of the response, defaults to 200
+    :return:
+        A flask Response object, can be used as a return type from service methods
+    """
+    body = serialisation.dumps(obj)
+    callback = request.args.get('callback')
+    if callback:
+        return Response('{0}({1})'.format(callback, body), status=status_code, mimetype='application/javascript')
+    return Response(body, status=status_code, mimetype='application/json')
+
 
 class MeteorApp(object):
     """
@@ -38,20 +60,78 @@ class MeteorApp(object):
         external server such as LigHTTPD or Apache to the application logic.
     """
 
-    def __init__(self, file_store_path, binary_path):
+    def __init__(self, file_store_path, binary_path, file_offload=None, file_offload_locations=None,
+                 derivative_cache_path=None, derivative_cache_bytes=derivatives.DEFAULT_CACHE_BYTES,
+                 query_max_age=caching.DEFAULT_QUERY_MAX_AGE, compress_responses=True,
+                 compression_minimum_size=compression.DEFAULT_MINIMUM_SIZE, upload_spool_path=None,
+                 ingest_spool_path=None):
         """
         Create a new MeteorApp, setting up the internal DB
 
         :param string file_store_path
             The path to the database file store.
+        :param string binary_path:
+            The directory holding the tools built in src/imageProjection. Its resize tool is used to make thumbnails if
+            Pillow isn't installed.
+        :param string file_offload:
+            How files should be sent to clients. If None, files are sent by the WSGI server. If 'x-sendfile' or
+            'x-accel-redirect', the front-end web server is asked to send files using the corresponding header, which
+            must be enabled in its configuration. See :func:`meteorpi_server.file_serving.serve_file`.
+        :param dict file_offload_locations:
+            For 'x-accel-redirect', a dict mapping local directories (such as the file store path) to the nginx
+            internal locations which serve them.
+        :param string derivative_cache_path:
+            The directory in which thumbnails and other resized images are cached. Defaults to a 'thumbnails'
+            directory alongside the file store.
+        :param int derivative_cache_bytes:
+            The maximum size of the thumbnail cache, in bytes. The least recently used images are removed when the
+            cache grows larger than this.
+        :param int query_max_age:
+            The number of seconds for which clients may cache the results of searches and status queries. Files and
+            thumbnails never change, so may always be cached indefinitely.
+        :param Boolean compress_responses:
+            If True, JSON and other textual responses are compressed for clients which accept gzip, or brotli or
+            zstd if the corresponding Python modules are installed. Images and video are never compressed.
+        :param int compression_minimum_size:
+            Responses smaller than this many bytes are not compressed
+        :param string upload_spool_path:
+            The directory in which files being uploaded to the import API in chunks are held until complete. Defaults
+            to an 'upload_spool' directory alongside the file store.
+        :param string ingest_spool_path:
+            The directory in which entities received by the import API are held until they are written to the
+            database, if the import API is used in ingest mode. Defaults to an 'ingest_spool' directory alongside the
+            file store. See :func:`meteorpi_server.importer_api.add_routes`.
         """
         self.file_store_path = file_store_path
         self.binary_path = binary_path
+        self.file_offload = file_offload
+        self.file_offload_locations = file_offload_locations
+        if derivative_cache_path is None:
+            derivative_cache_path = derivatives.default_cache_path(file_store_path)
+        resize_tool = os.path.join(binary_path, "resize") if binary_path else None
+        self.derivative_cache = derivatives.DerivativeCache(cache_path=derivative_cache_path,
+                                                            max_bytes=derivative_cache_bytes, resize_tool=resize_tool)
+        self.query_max_age = query_max_age
+        if upload_spool_path is None:
+            upload_spool_path = upload_spool.default_spool_path(file_store_path)
+        self.upload_spool = upload_spool.UploadSpool(spool_path=upload_spool_path)
+        if ingest_spool_path is None:
+            ingest_spool_path = ingest_spool.default_spool_path(file_store_path)
+        self.ingest_spool = ingest_spool.IngestSpool(spool_path=ingest_spool_path)
+        self.validator_cache = caching.ValidatorCache()
+        self.metrics = metrics.ServerMetrics()
         self.app = Flask(__name__)
         CORS(app=self.app, resources='/*', allow_headers=['authorization', 'content-type'])
+        if compress_responses:
+            self.app.wsgi_app = compression.CompressionMiddleware(self.app.wsgi_app,
+                                                                  minimum_size=compression_minimum_size)
 
     def get_db(self):
-        return MeteorDatabase(file_store_path=self.file_store_path)
+        db = MeteorDatabase(file_store_path=self.file_store_path)
+        # Keep track of the connections opened by each request, so that the metrics module can count their queries
+        if has_request_context() and hasattr(g, 'metrics_dbs'):
+            g.metrics_dbs.append(db)
+        return db
 
     @staticmethod
     def success(message='Okay'):
@@ -63,9 +143,7 @@ class MeteorApp(object):
         :return:
             A flask Response object, can be used as a return type from service methods
         """
-        resp = jsonify({'message': message})
-        resp.status_code = 200
-        return resp
+        return json_response({'message': message}, status_code=200)
 
     @staticmethod
     def not_found(entity_id=None, message='Entity not found'):
@@ -79,9 +157,7 @@ class MeteorApp(object):
         :return:
             A flask Response object, can be used as a return type from service methods
         """
-        resp = jsonify({'message': message, 'entity_id': entity_id})
-        resp.status_code = 404
-        return resp
+        return json_response({'message': message, 'entity_id': entity_id}, status_code=404)
 
     @staticmethod
     def authentication_failure(message='Authorization required'):
@@ -93,9 +169,26 @@ class MeteorApp(object):
         :return:
             flask error code, can be used as a return type from service methods
         """
-        resp = jsonify({'message': message})
-        resp.status_code = 403
-        return resp
+        return json_response({'message': message}, status_code=403)
+
+    def serve_file(self, file_path, mime_type, etag=None, cache_control=None):
+        """
+        Build a response which sends a file to the client, supporting Range requests and using whichever file offload
+        mode this app was configured with.
+
+        :param string file_path:
+            The path of the file to send
+        :param string mime_type:
+            The MIME type of the file
+        :param string etag:
+            Optionally, a strong ETag for the file
+        :param string cache_control:
+            Optionally, the value of the Cache-Control header to send
+        :return:
+            A flask Response object, can be used as a return type from service methods
+        """
+        return file_serving.serve_file(file_path=file_path, mime_type=mime_type, etag=etag, cache_control=cache_control,
+                                       offload=self.file_offload, offload_locations=self.file_offload_locations)
 
     @staticmethod
     def get_user():
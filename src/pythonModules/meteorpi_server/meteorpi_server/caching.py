@@ -0,0 +1,207 @@
+# caching.py
+# Meteor Pi, Cambridge Science Centre
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# HTTP caching policy for the query API. There are two kinds of response:
+#
+# Media (file content and image derivatives) is addressed by repository ID, and a file never changes once it has been
+# registered. These responses carry a strong ETag derived from the file's MD5 sum and may be cached by clients for a
+# year. Since the content at a given URL can never change, conditional requests for media can usually be answered
+# without touching the database.
+#
+# Search and status responses change as new data arrives. These carry an ETag computed from the response body, so that
+# a client polling for updates only receives the body when it has changed, and may be cached for a short time.
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import request, Response
+from werkzeug.http import parse_etags
+
+# Cache lifetime, in seconds, for responses which never change
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+IMMUTABLE_CACHE_CONTROL = 'public, max-age={0}, immutable'.format(IMMUTABLE_MAX_AGE)
+
+# Default cache lifetime, in seconds, for search and status responses
+DEFAULT_QUERY_MAX_AGE = 30
+
+# Number of file IDs for which we remember MD5 sums, to answer conditional requests without a database query
+DEFAULT_VALIDATOR_CACHE_SIZE = 10000
+
+
+def immutable_cache_control(response):
+    """
+    Mark a response as being cacheable indefinitely
+
+    :param response:
+        A flask Response object, which is modified in place
+    :return:
+        The same response
+    """
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+def query_cache_control(response, max_age):
+    """
+    Mark a response as being cacheable for a short time
+
+    :param response:
+        A flask Response object, which is modified in place
+    :param int max_age:
+        The number of seconds for which the response may be cached
+    :return:
+        The same response
+    """
+    response.headers['Cache-Control'] = 'public, max-age={0}'.format(max_age)
+    return response
+
+
+def not_modified(etag=None, cache_control=None):
+    """
+    Build a 304 Not Modified response
+
+    :param string etag:
+        The strong ETag of the resource, without quotes, or None
+    :param string cache_control:
+        The Cache-Control header to send, or None
+    :return:
+        A flask Response object, can be used as a return type from service methods
+    """
+    rv = Response(status=304)
+    if etag is not None:
+        rv.set_etag(etag)
+    if cache_control is not None:
+        rv.headers['Cache-Control'] = cache_control
+    return rv
+
+
+def conditional_json(response, max_age):
+    """
+    Add an ETag computed from the body of a JSON response, and a short cache lifetime. If the client already holds a
+    copy of the response with the same ETag, the response is turned into a 304 Not Modified with no body.
+
+    :param response:
+        A flask Response object, as returned by :func:`meteorpi_server.json_response`
+    :param int max_age:
+        The number of seconds for which the response may be cached
+    :return:
+        A flask Response object, can be used as a return type from service methods
+    """
+    query_cache_control(response, max_age)
+    if response.status_code != 200 or request.method not in ('GET', 'HEAD'):
+        return response
+    response.set_etag(hashlib.md5(response.get_data()).hexdigest())
+    return response.make_conditional(request)
+
+
+class ValidatorCache(object):
+    """
+    Remembers the MD5 sums and MIME types of recently requested files, keyed by repository ID. Files never change once
+    registered, so the entries never need invalidating; the least recently used entries are dropped when the cache is
+    full. Shared between the threads of a process.
+
+    :ivar int hits:
+        The number of lookups which found an MD5 sum
+    :ivar int misses:
+        The number of lookups which didn't
+    """
+
+    def __init__(self, max_entries=DEFAULT_VALIDATOR_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, file_id):
+        with self._lock:
+            entry = self._entries.pop(file_id, None)
+            if entry is not None:
+                self._entries[file_id] = entry
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def get(self, file_id):
+        """
+        :param string file_id:
+            The repository ID of a file
+        :return:
+            The MD5 sum of the file, or None if we don't know it
+        """
+        entry = self._lookup(file_id)
+        return None if entry is None else entry[0]
+
+    def put(self, file_id, md5, mime_type=None):
+        """
+        :param string file_id:
+            The repository ID of a file
+        :param string md5:
+            The MD5 sum of the file, as stored in its FileRecord
+        :param string mime_type:
+            The MIME type of the file, as stored in its FileRecord
+        """
+        if md5 is None:
+            return
+        with self._lock:
+            self._entries.pop(file_id, None)
+            self._entries[file_id] = (md5, mime_type)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def check_not_modified(self, file_id, etag_suffix='', mime_types=None):
+        """
+        Work out whether a conditional request for an immutable file, or a derivative of one, can be answered with a
+        304 Not Modified without consulting the database. This is only possible if we know that the file exists,
+        because it is in this cache; otherwise the request must be handled in full, so that requests for files which
+        don't exist get a 404.
+
+        :param string file_id:
+            The repository ID of the file
+        :param string etag_suffix:
+            Appended to the MD5 sum to form the ETag, used to distinguish derivatives from the original file
+        :param list mime_types:
+            If not None, only answer with a 304 if the file has one of these MIME types, e.g. those from which a
+            derivative can be made
+        :return:
+            A 304 flask Response object if the client's copy is current, or None if the request must be handled in full
+        """
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        if_none_match = request.headers.get('If-None-Match')
+        if_modified_since = request.headers.get('If-Modified-Since')
+        if not (if_none_match or if_modified_since):
+            return None
+        entry = self._lookup(file_id)
+        if entry is None:
+            return None
+        [md5, mime_type] = entry
+        if mime_types is not None and mime_type not in mime_types:
+            return None
+        etag = md5 + etag_suffix
+        if if_none_match and not parse_etags(if_none_match).contains_weak(etag):
+            return None
+        # With only If-Modified-Since to go on, any copy the client holds must be current, as the file can never have
+        # changed
+        return not_modified(etag=etag, cache_control=IMMUTABLE_CACHE_CONTROL)
@@ -0,0 +1,297 @@
+# compression.py
+# Meteor Pi, Cambridge Science Centre
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# WSGI middleware which compresses responses, using whichever of brotli, zstd and gzip is supported by both the client
+# and this server. Only textual responses such as JSON are compressed; images and video are already compressed, and are
+# passed through untouched so that byte range requests and sendfile() keep working. Responses are compressed as they
+# are produced, so streamed search results are sent to the client as they become available.
+
+import zlib
+
+# The optional compression libraries. gzip is always available via zlib.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# MIME types of responses which are worth compressing. All text/* types are also compressed.
+COMPRESSIBLE_MIME_TYPES = ['application/json', 'application/x-ndjson', 'application/javascript', 'application/xml']
+
+# Responses smaller than this many bytes are not compressed, as the saving isn't worth the CPU time
+DEFAULT_MINIMUM_SIZE = 1024
+
+
+class _GzipEncoder(object):
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliEncoder(object):
+    def __init__(self, level):
+        # Brotli qualities run from 0 to 11; its higher settings are too slow to use on the fly
+        self._compressor = brotli.Compressor(quality=min(level, 5))
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class _ZstdEncoder(object):
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=min(level, 9)).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+def available_encodings():
+    """
+    :return:
+        A list of the content codings supported by this server, in order of preference
+    """
+    encodings = []
+    if brotli is not None:
+        encodings.append('br')
+    if zstandard is not None:
+        encodings.append('zstd')
+    encodings.append('gzip')
+    return encodings
+
+
+def choose_encoding(accept_encoding, encodings):
+    """
+    Pick a content coding for a response, given the value of the client's Accept-Encoding header
+
+    :param string accept_encoding:
+        The value of the Accept-Encoding header, e.g. 'gzip, deflate, br;q=0.9'
+    :param list encodings:
+        The content codings supported by this server, in order of preference
+    :return:
+        One of the codings in the list, or None if the response should not be compressed
+    """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(','):
+        parts = item.split(';')
+        name = parts[0].strip().lower()
+        quality = 1.
+        for param in parts[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+        qualities[name] = quality
+    best = None
+    best_quality = 0.
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get('*', 0.))
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+    return best
+
+
+class CompressionMiddleware(object):
+    """
+    Wraps a WSGI application, compressing its responses when the client can accept a compressed response, the
+    response has a compressible MIME type, and it is large enough to be worth compressing. Apply it to a Flask app with
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app).
+
+    :ivar int minimum_size:
+        Responses smaller than this many bytes are sent uncompressed
+    :ivar int level:
+        The compression level, from 1 (fastest) to 9 (smallest)
+    :ivar list encodings:
+        The content codings which may be used, in order of preference
+    """
+
+    def __init__(self, app, minimum_size=DEFAULT_MINIMUM_SIZE, level=6, encodings=None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        if encodings is None:
+            encodings = available_encodings()
+        self.encodings = [e for e in encodings if e in available_encodings()]
+
+    def _encoder(self, encoding):
+        if encoding == 'br':
+            return _BrotliEncoder(self.level)
+        if encoding == 'zstd':
+            return _ZstdEncoder(self.level)
+        return _GzipEncoder(self.level)
+
+    @staticmethod
+    def _is_compressible_type(headers):
+        """
+        :return:
+            True if a response with these headers has a MIME type which is worth compressing
+        """
+        for name, value in headers:
+            if name.lower() == 'content-type':
+                content_type = value.split(';')[0].strip().lower()
+                return content_type.startswith('text/') or content_type in COMPRESSIBLE_MIME_TYPES
+        return False
+
+    def __call__(self, environ, start_response):
+        encoding = None
+        if environ.get('REQUEST_METHOD') != 'HEAD':
+            encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING'), self.encodings)
+
+        # We send weak ETags for compressed responses, as they are not byte-for-byte identical to the uncompressed
+        # representation. If-None-Match always uses weak comparison, so strip the marker before the application sees it.
+        if encoding is not None and environ.get('HTTP_IF_NONE_MATCH'):
+            environ['HTTP_IF_NONE_MATCH'] = environ['HTTP_IF_NONE_MATCH'].replace('W/', '')
+
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+            captured['exc_info'] = exc_info
+            # Defer the real start_response until we know whether we are compressing. The WSGI spec requires us to
+            # return a write() callable, but none of our routes use it.
+            return None
+
+        app_iter = self.app(environ, capture_start_response)
+        status = captured['status']
+        headers = captured['headers']
+
+        # Add Vary to compressible responses whether or not we compress them, so that caches don't serve a compressed
+        # response to a client which can't accept it
+        if not self._is_compressible_type(headers):
+            start_response(status, headers, captured['exc_info'])
+            return app_iter
+        headers = [(name, value) for name, value in headers if name.lower() != 'vary'] + \
+                  [('Vary', ', '.join(_vary_values(headers)))]
+
+        compress = encoding is not None and status.startswith('200')
+        content_length = None
+        for name, value in headers:
+            name = name.lower()
+            if name in ('content-encoding', 'content-range'):
+                compress = False
+            elif name == 'cache-control' and 'no-transform' in value.lower():
+                compress = False
+            elif name == 'content-length':
+                content_length = int(value)
+        if content_length is not None and content_length < self.minimum_size:
+            compress = False
+
+        if not compress:
+            start_response(status, headers, captured['exc_info'])
+            return app_iter
+        return self._compressed_response(app_iter, encoding, status, headers, content_length, captured['exc_info'],
+                                         start_response)
+
+    def _compressed_response(self, app_iter, encoding, status, headers, content_length, exc_info, start_response):
+        """
+        Generator which yields the compressed body of a response, calling start_response before the first chunk. If
+        the length of the response isn't known in advance, and it turns out to be shorter than our minimum size, it is
+        sent uncompressed.
+        """
+        try:
+            chunks = iter(app_iter)
+
+            # If we don't know how long the response is, read enough of it to decide whether to compress
+            head = []
+            if content_length is None:
+                head_size = 0
+                for chunk in chunks:
+                    head.append(chunk)
+                    head_size += len(chunk)
+                    if head_size >= self.minimum_size:
+                        break
+                else:
+                    start_response(status, headers + [('Content-Length', str(head_size))], exc_info)
+                    for chunk in head:
+                        yield chunk
+                    return
+
+            new_headers = []
+            for name, value in headers:
+                lower_name = name.lower()
+                if lower_name == 'content-length':
+                    continue
+                if lower_name == 'etag' and not value.startswith('W/'):
+                    value = 'W/' + value
+                new_headers.append((name, value))
+            new_headers.append(('Content-Encoding', encoding))
+            start_response(status, new_headers, exc_info)
+
+            # Flush the compressor after each chunk from the application, so that clients processing streamed results
+            # receive them promptly. The chunks our streaming routes produce are large enough that this costs little.
+            encoder = self._encoder(encoding)
+            for chunk in head:
+                data = encoder.compress(chunk)
+                if data:
+                    yield data
+            if head:
+                yield encoder.flush()
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                yield encoder.compress(chunk) + encoder.flush()
+            yield encoder.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def _vary_values(headers):
+    """
+    :return:
+        The values of the Vary header in a list of headers, with Accept-Encoding added if it isn't already present
+    """
+    values = []
+    for name, value in headers:
+        if name.lower() == 'vary':
+            values.extend(v.strip() for v in value.split(',') if v.strip())
+    if 'accept-encoding' not in [v.lower() for v in values]:
+        values.append('Accept-Encoding')
+    return values
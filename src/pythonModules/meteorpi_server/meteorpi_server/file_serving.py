@@ -0,0 +1,295 @@
+# file_serving.py
+# Meteor Pi, Cambridge Science Centre
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# Functions for sending files from the file store to HTTP clients, with support for byte range requests. Where
+# possible the file contents are never read into Python: either the front-end web server is asked to send the file
+# itself (X-Sendfile / X-Accel-Redirect), or the file is passed to the WSGI server's wsgi.file_wrapper, which will
+# typically use the sendfile() system call.
+
+import os
+import re
+import uuid
+
+from flask import request, Response
+from werkzeug.wsgi import FileWrapper
+from werkzeug.http import http_date, is_resource_modified
+
+# Values for the 'offload' argument of serve_file()
+OFFLOAD_NONE = None
+OFFLOAD_X_SENDFILE = 'x-sendfile'
+OFFLOAD_X_ACCEL_REDIRECT = 'x-accel-redirect'
+
+# Size of the blocks in which partial content is read when it can't be handed to wsgi.file_wrapper
+BLOCK_SIZE = 65536
+
+# Range headers asking for more than this number of ranges are ignored, and the whole file is sent instead
+MAX_RANGES = 16
+
+_range_spec = re.compile('^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_range_header(range_header, size):
+    """
+    Parse the value of an HTTP Range header into a list of byte ranges within a file
+
+    :param string range_header:
+        The value of the Range header, e.g. 'bytes=0-499,1000-'
+    :param int size:
+        The size of the file being requested, in bytes
+    :return:
+        A list of (first, last) tuples, with both values inclusive and clipped to the size of the file. Returns None if
+        the header is malformed, or asks for more than MAX_RANGES ranges, in which case it should be ignored and the
+        whole file sent. Returns an empty list if the header is valid, but none of the ranges it specifies lie within
+        the file. Overlapping and adjacent ranges are merged, and the ranges are returned in order.
+    """
+    units, _, range_set = range_header.partition('=')
+    if units.strip().lower() != 'bytes' or not range_set:
+        return None
+    if range_set.count(',') >= MAX_RANGES:
+        return None
+    ranges = []
+    for spec in range_set.split(','):
+        m = _range_spec.match(spec)
+        if m is None:
+            return None
+        first, last = m.groups()
+        if first == '':
+            # Suffix range, e.g. '-500' for the final 500 bytes
+            if last == '':
+                return None
+            suffix_length = int(last)
+            if suffix_length == 0 or size == 0:
+                continue
+            ranges.append((max(0, size - suffix_length), size - 1))
+            continue
+        first = int(first)
+        last = size - 1 if last == '' else min(int(last), size - 1)
+        if last < first:
+            if m.group(2) != '' and int(m.group(2)) < first:
+                return None
+            continue
+        ranges.append((first, last))
+
+    # Merge ranges which overlap or touch, so that no byte is sent more than once
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def _if_range_matches(if_range, etag, last_modified):
+    """
+    Check whether the value of an If-Range header matches the current version of a file. Only strong validators can
+    be used with If-Range, so weak ETags never match.
+
+    :param string if_range:
+        The value of the If-Range header
+    :param string etag:
+        The strong ETag of the file, without quotes, or None if we don't have one
+    :param string last_modified:
+        The HTTP date of the file's modification time, as sent in the Last-Modified header
+    :return:
+        True if the range request should be honoured, False if the whole file should be sent
+    """
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return etag is not None and if_range == '"{0}"'.format(etag)
+    return if_range == last_modified
+
+
+class _FileRangeIterator(object):
+    """
+    Iterates over a single byte range of an open file in blocks of BLOCK_SIZE, so that partial content can be sent
+    without reading the whole range into memory. Closes the file when the WSGI server closes the response.
+    """
+
+    def __init__(self, f, first, length):
+        self.f = f
+        self.first = first
+        self.length = length
+
+    def __iter__(self):
+        self.f.seek(self.first)
+        remaining = self.length
+        while remaining > 0:
+            data = self.f.read(min(BLOCK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.f.close()
+
+
+class _MultipartRangeIterator(object):
+    """
+    Iterates over a multipart/byteranges response body, comprising several byte ranges of the same open file, each
+    preceded by its own part headers.
+    """
+
+    def __init__(self, f, parts, terminator):
+        self.f = f
+        self.parts = parts
+        self.terminator = terminator
+
+    def __iter__(self):
+        for part_header, first, last in self.parts:
+            yield part_header
+            for data in _FileRangeIterator(self.f, first, last - first + 1):
+                yield data
+        yield self.terminator
+
+    def close(self):
+        self.f.close()
+
+
+def _offload_response(file_path, mime_type, offload, offload_locations):
+    """
+    Build a response which asks the front-end web server to send a file on our behalf. The web server then deals with
+    Range and conditional requests itself.
+
+    :return:
+        A flask Response object, or None if the file can't be offloaded
+    """
+    if offload == OFFLOAD_X_SENDFILE:
+        header_value = file_path
+    elif offload == OFFLOAD_X_ACCEL_REDIRECT:
+        # nginx needs a URI for an internal location rather than a path
+        header_value = None
+        real_path = os.path.realpath(file_path)
+        for local_dir, uri_prefix in (offload_locations or {}).iteritems():
+            local_dir = os.path.join(os.path.realpath(local_dir), '')
+            if real_path.startswith(local_dir):
+                header_value = uri_prefix.rstrip('/') + '/' + real_path[len(local_dir):]
+                break
+        if header_value is None:
+            return None
+    else:
+        raise ValueError("Unknown file offload mode: %s" % offload)
+    rv = Response(mimetype=mime_type)
+    rv.headers['X-Sendfile' if offload == OFFLOAD_X_SENDFILE else 'X-Accel-Redirect'] = header_value
+    return rv
+
+
+def serve_file(file_path, mime_type, etag=None, cache_control=None, offload=OFFLOAD_NONE, offload_locations=None):
+    """
+    Build a response which sends a file to the client, honouring any Range and If-Range headers in the current
+    request. Multiple ranges are sent as a multipart/byteranges response.
+
+    :param string file_path:
+        The path of the file to send
+    :param string mime_type:
+        The MIME type of the file
+    :param string etag:
+        Optionally, a strong ETag for the file, such as its MD5 sum. Used when evaluating If-Range and If-None-Match
+        headers.
+    :param string cache_control:
+        Optionally, the value of the Cache-Control header to send
+    :param string offload:
+        If OFFLOAD_X_SENDFILE, the file is sent by the front-end web server using the X-Sendfile header, as supported
+        by Apache mod_xsendfile and lighttpd. If OFFLOAD_X_ACCEL_REDIRECT, the file is sent by nginx using the
+        X-Accel-Redirect header. If None, the file is sent by the WSGI server.
+    :param dict offload_locations:
+        Only used with OFFLOAD_X_ACCEL_REDIRECT. A dict mapping local directories to the URI prefixes of the nginx
+        internal locations which serve them. Files outside these directories are sent by the WSGI server.
+    :return:
+        A flask Response object, can be used as a return type from service methods
+    """
+    environ = request.environ
+    stat = os.stat(file_path)
+    size = stat.st_size
+    last_modified = http_date(stat.st_mtime)
+
+    headers = {'Accept-Ranges': 'bytes', 'Last-Modified': last_modified}
+    if etag is not None:
+        headers['ETag'] = '"{0}"'.format(etag)
+    if cache_control is not None:
+        headers['Cache-Control'] = cache_control
+
+    # The client already has the current version of the file
+    if not is_resource_modified(environ, etag=etag, last_modified=last_modified):
+        return Response(status=304, headers=headers)
+
+    if offload is not None:
+        rv = _offload_response(file_path, mime_type, offload, offload_locations)
+        if rv is not None:
+            rv.headers.extend(headers)
+            return rv
+
+    f = open(file_path, 'rb')
+
+    ranges = None
+    range_header = request.headers.get('Range')
+    if range_header:
+        if_range = request.headers.get('If-Range')
+        if if_range is None or _if_range_matches(if_range, etag, last_modified):
+            ranges = parse_range_header(range_header, size)
+
+    # Whole file. Hand the file to the WSGI server, which will generally use sendfile() to send it.
+    if ranges is None:
+        file_wrapper = environ.get('wsgi.file_wrapper', FileWrapper)
+        rv = Response(file_wrapper(f, BLOCK_SIZE), status=200, mimetype=mime_type, headers=headers,
+                      direct_passthrough=True)
+        rv.content_length = size
+        return rv
+
+    # None of the requested ranges lie within the file
+    if len(ranges) == 0:
+        f.close()
+        headers['Content-Range'] = 'bytes */{0}'.format(size)
+        return Response(status=416, headers=headers)
+
+    # Single range
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        length = last - first + 1
+        headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(first, last, size)
+        if 'mod_wsgi.version' in environ and 'wsgi.file_wrapper' in environ:
+            # mod_wsgi's file_wrapper starts from the file's current position and stops after Content-Length bytes,
+            # so it can send a range without copying it through Python. Other servers may send to the end of the file.
+            f.seek(first)
+            body = environ['wsgi.file_wrapper'](f, BLOCK_SIZE)
+        else:
+            body = _FileRangeIterator(f, first, length)
+        rv = Response(body, status=206, mimetype=mime_type, headers=headers, direct_passthrough=True)
+        rv.content_length = length
+        return rv
+
+    # Several ranges, sent as a multipart/byteranges response
+    boundary = uuid.uuid4().hex
+    parts = []
+    content_length = 0
+    for first, last in ranges:
+        part_header = '\r\n--{0}\r\nContent-Type: {1}\r\nContent-Range: bytes {2}-{3}/{4}\r\n\r\n'.format(
+            boundary, mime_type, first, last, size)
+        parts.append((part_header, first, last))
+        content_length += len(part_header) + last - first + 1
+    terminator = '\r\n--{0}--\r\n'.format(boundary)
+    content_length += len(terminator)
+    rv = Response(_MultipartRangeIterator(f, parts, terminator), status=206, headers=headers,
+                  mimetype='multipart/byteranges; boundary={0}'.format(boundary), direct_passthrough=True)
+    rv.content_length = content_length
+    return rv
@@ -21,14 +21,33 @@
 # along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
 # -------------------------------------------------
 
+import threading
 from logging import getLogger
 
-from yaml import safe_load
 from os import path, remove
 import meteorpi_model as model
-from flask.ext.jsonpify import jsonify
+from meteorpi_model import serialisation
+from meteorpi_server import json_response
 from flask import request, g
 
+# Maximum number of entities which may be sent in one batch import request
+MAX_IMPORT_BATCH_SIZE = 500
+
+# Maximum number of IDs, and of time buckets, which may be sent in one inventory request
+MAX_INVENTORY_IDS = 10000
+MAX_INVENTORY_BUCKETS = 1000
+
+# In ingest mode, the number of spooled entities each worker writes to the database in a single transaction
+DEFAULT_INGEST_BATCH_SIZE = 200
+
+# Seconds an idle ingest worker waits before looking for work, and for which it backs off if the database fails
+INGEST_POLL_INTERVAL = 5
+INGEST_BACKOFF_INTERVAL = 30
+
+# Order in which entities of each type are written when ingesting a batch, so that observatories are registered by
+# their metadata before their observations are written, and observations before their files
+INGEST_ORDER = ['metadata', 'observation', 'file']
+
 
 class MeteorDatabaseImportReceiver(object):
     """
@@ -37,38 +56,77 @@ class MeteorDatabaseImportReceiver(object):
     additional information (camera status, binary file data) required in the process.
     """
 
-    def __init__(self, db):
+    def __init__(self, db, metrics=None, user_id=None, autocommit=True):
+        """
+        :param MeteorDatabase db:
+            The database to import into
+        :param ServerMetrics metrics:
+            Optionally, the metrics to update as data is received
+        :param string user_id:
+            The user recorded as having created imported entities. Defaults to the user who made the current request.
+        :param Boolean autocommit:
+            If True, each entity is committed as soon as it is imported. If False, the caller must commit.
+        """
         self.db = db
+        self.metrics = metrics
+        self.user_id = user_id
+        self.autocommit = autocommit
 
-    @staticmethod
-    def get_importing_user_id():
+    def get_importing_user_id(self):
         """
-        Retrieve the importing user ID from the request context, this user will have already authenticated correctly
-        by the point the import receiver is called.
+        Retrieve the importing user ID, by default from the request context, this user will have already authenticated
+        correctly by the point the import receiver is called.
 
         :return:
             The string user_id for the importing user
         """
+        if self.user_id is not None:
+            return self.user_id
         return g.user.user_id
 
-    def receive_observation(self, import_request):
-        obs = import_request.entity
+    def _commit(self):
+        if self.autocommit:
+            self.db.commit()
+
+    def import_observation(self, obs):
+        """
+        Write an observation to the database, unless we already hold it
+        """
         if not self.db.has_observation_id(obs.id):
             self.db.import_observation(observation=obs, user_id=self.get_importing_user_id())
-            self.db.commit()
-        return import_request.response_complete()
+            self._commit()
 
-    def receive_file_record(self, import_request):
-        file_record = import_request.entity
+    def receive_observation(self, import_request):
+        self.import_observation(import_request.entity)
+        return import_request.state_complete()
+
+    def import_file_record(self, file_record):
+        """
+        Write a file record to the database, unless we already hold it
+
+        :return:
+            True if we now hold the file, or False if its data hasn't been received yet, so it couldn't be imported
+        :raises:
+            ValueError if we don't hold the observation the file belongs to
+        """
         if not self.db.has_file_id(file_record.id):
             if not path.isfile(self.db.file_path_for_id(file_record.id)):
-                return import_request.response_need_file_data(file_id=file_record.id)
+                return False
             self.db.import_file(file_item=file_record, user_id=self.get_importing_user_id())
-            self.db.commit()
-        return import_request.response_complete()
+            self._commit()
+        return True
 
-    def receive_metadata(self, import_request):
-        entity = import_request.entity
+    def receive_file_record(self, import_request):
+        file_record = import_request.entity
+        if not self.import_file_record(file_record):
+            return import_request.state_need_file_data(file_id=file_record.id)
+        return import_request.state_complete()
+
+    def import_metadata(self, entity):
+        """
+        Write an item of observatory metadata to the database, unless we already hold it, registering the observatory
+        if it is new to us
+        """
         if not self.db.has_obstory_metadata(entity.id):
             if not self.db.has_obstory_name(entity.obstory_name):
                 self.db.register_obstory(obstory_id=entity.obstory_id, obstory_name=entity.obstory_name,
@@ -78,15 +136,22 @@ class MeteorDatabaseImportReceiver(object):
                                             time_created=entity.time_created,
                                             user_created=self.get_importing_user_id(),
                                             item_id=entity.id)
-            self.db.commit()
-        return import_request.response_complete()
+            self._commit()
+
+    def receive_metadata(self, import_request):
+        self.import_metadata(import_request.entity)
+        return import_request.state_complete()
 
     def receive_file_data(self, file_id, file_data, md5_hex):
         file_path = self.db.file_path_for_id(file_id)
         if not path.isfile(file_path):
             file_data.save(file_path)
+            if self.metrics is not None:
+                self.metrics.import_bytes.inc(path.getsize(file_path))
             if md5_hex != model.get_md5_hash(file_path):
                 remove(file_path)
+                if self.metrics is not None:
+                    self.metrics.import_md5_failures.inc()
 
 
 class ImportRequest(object):
@@ -126,7 +191,7 @@ class ImportRequest(object):
         else:
             raise ValueError("Unknown entity type, cannot continue.")
 
-    def response_complete(self):
+    def state_complete(self):
         """
         Signal that this particular entity has been fully processed. The exporter will not send it to this target again
         under this particular export configuration (there is no guarantee another export configuration on the same
@@ -134,29 +199,29 @@ class ImportRequest(object):
         you have an entity and return this status as early as possible if so)
 
         :return:
-            A response that can be returned from a Flask service method
+            A dict describing the state of the import, as sent to the exporter
         """
         ImportRequest.logger.info("Completed import for {0} with id {1}".format(self.entity_type, self.entity_id))
         ImportRequest.logger.debug("Sending: complete")
-        return jsonify({'state': 'complete'})
+        return {'state': 'complete'}
 
     @staticmethod
-    def response_failed(message='Import failed'):
+    def state_failed(message='Import failed'):
         """
         Signal that import for this entity failed. Whether this results in a retry either immediately or later in time
         is entirely up to the exporting party - this should therefore only be used for error cases, and not used to
-        indicate duplicate data (use the response_complete for this as it tells the exporter that it shouldn't send the
+        indicate duplicate data (use the state_complete for this as it tells the exporter that it shouldn't send the
         data again)
 
         :param string message:
             An optional message to convey about the failure
         :return:
-            A response that can be returned from a Flask service method
+            A dict describing the state of the import, as sent to the exporter
         """
         ImportRequest.logger.debug("Sending: failed")
-        return jsonify({'state': 'failed', 'message': message})
+        return {'state': 'failed', 'message': message}
 
-    def response_continue(self):
+    def state_continue(self):
         """
         Signals that a partial reception of data has occurred and that the exporter should continue to send data for
         this entity. This should also be used if import-side caching has missed, in which case the response will direct
@@ -166,14 +231,52 @@ class ImportRequest(object):
         a cache miss during import.
 
         :return:
-            A response that can be returned from a Flask service method
+            A dict describing the state of the import, as sent to the exporter
         """
         if self.entity is not None:
             ImportRequest.logger.debug("Sending: continue")
-            return jsonify({'state': 'continue'})
+            return {'state': 'continue'}
         else:
             ImportRequest.logger.debug("Sending: continue-nocache")
-            return jsonify({'state': 'continue-nocache'})
+            return {'state': 'continue-nocache'}
+
+    @staticmethod
+    def state_need_file_data(file_id):
+        """
+        Signal the exporter that we need the binary data associated with a given file ID
+
+        :param string file_id:
+            the UUID of the :class:`meteorpi_model.FileRecord` for which we don't currently have data
+        :return:
+            A dict describing the state of the import, as sent to the exporter
+        """
+        ImportRequest.logger.debug("Sending: need_file_data, id={0}".format(file_id))
+        return {'state': 'need_file_data', 'file_id': file_id}
+
+    def response_complete(self):
+        """
+        As state_complete, as a response that can be returned from a Flask service method
+        """
+        return json_response(self.state_complete())
+
+    @staticmethod
+    def response_failed(message='Import failed', status_code=200):
+        """
+        As state_failed, as a response that can be returned from a Flask service method
+
+        :param string message:
+            An optional message to convey about the failure
+        :param int status_code:
+            The HTTP status code of the response. Use 400 if the request itself couldn't be understood, so that the
+            exporter treats it as an error rather than looking for a state in the response.
+        """
+        return json_response(ImportRequest.state_failed(message), status_code=status_code)
+
+    def response_continue(self):
+        """
+        As state_continue, as a response that can be returned from a Flask service method
+        """
+        return json_response(self.state_continue())
 
     @staticmethod
     def response_continue_after_file():
@@ -185,20 +288,14 @@ class ImportRequest(object):
         :return:
             A response that can be returned from a Flask service method
         """
-        return jsonify({'state': 'continue'})
+        return json_response({'state': 'continue'})
 
     @staticmethod
     def response_need_file_data(file_id):
         """
-        Signal the exporter that we need the binary data associated with a given file ID
-
-        :param string file_id:
-            the UUID of the :class:`meteorpi_model.FileRecord` for which we don't currently have data
-        :return:
-            A response that can be returned from a Flask service method
+        As state_need_file_data, as a response that can be returned from a Flask service method
         """
-        ImportRequest.logger.debug("Sending: need_file_data, id={0}".format(file_id))
-        return jsonify({'state': 'need_file_data', 'file_id': file_id})
+        return json_response(ImportRequest.state_need_file_data(file_id))
 
     @staticmethod
     def process_request():
@@ -214,39 +311,285 @@ class ImportRequest(object):
             cache miss, and 'entity-id' which will be the UUID of the entity requested.
             The entity corresponding to this request, or None if we had an issue and there was an unexpected cache miss.
         """
-        g.request_dict = safe_load(request.get_data())
-        entity_type = g.request_dict['type']
-        entity_id = g.request_dict[entity_type]['id']
+        g.request_dict = serialisation.loads_legacy(request.get_data())
+        return ImportRequest.from_dict(g.request_dict)
+
+    @staticmethod
+    def from_dict(request_dict):
+        """
+        Build an ImportRequest from a dict describing a single entity, of the form {'type':..., type:{...}}, as sent by
+        the exporter either on its own or as one member of a batch.
+
+        :param dict request_dict:
+            The decoded request
+        :return:
+            An ImportRequest for the entity
+        :raises:
+            ValueError if the dict does not describe an entity
+        """
+        try:
+            entity_type = request_dict['type']
+            entity_id = request_dict[entity_type]['id']
+        except (KeyError, TypeError):
+            raise ValueError("Malformed import request")
         ImportRequest.logger.debug("Received request, type={0}, id={1}".format(entity_type, entity_id))
-        entity = ImportRequest._get_entity(entity_id)
+        entity = ImportRequest._get_entity(request_dict)
         ImportRequest.logger.debug("Entity with id={0} was {1}".format(entity_id, entity))
         return ImportRequest(entity=entity, entity_id=entity_id)
 
     @staticmethod
-    def _get_entity(entity_id):
+    def _get_entity(request_dict):
         """
-        Uses the request context to retrieve a :class:`meteorpi_model.CameraStatus`, :class:`meteorpi_model.Event` or
-        :class:`meteorpi_model.FileRecord` from the POSTed JSON string.
+        Retrieve a :class:`meteorpi_model.ObservatoryMetadata`, :class:`meteorpi_model.Observation` or
+        :class:`meteorpi_model.FileRecord` from a decoded import request.
 
-        :param string entity_id:
-            The ID of a CameraStatus, Event or FileRecord contained within the request
+        :param dict request_dict:
+            The decoded request
         :return:
             The corresponding entity from the request.
         """
-        entity_type = g.request_dict['type']
+        entity_type = request_dict['type']
         if entity_type == 'file':
-            return model.FileRecord.from_dict(g.request_dict['file'])
+            return serialisation.file_record.from_dict(request_dict['file'])
         elif entity_type == 'metadata':
-            return model.ObservatoryMetadata.from_dict(g.request_dict['metadata'])
+            return serialisation.obstory_metadata.from_dict(request_dict['metadata'])
         elif entity_type == 'observation':
-            return model.Observation.from_dict(g.request_dict['observation'])
+            return serialisation.observation.from_dict(request_dict['observation'])
         else:
             return None
 
 
-def add_routes(meteor_app, url_path='/importv2'):
+def receive_import_request(handler, import_request):
+    """
+    Pass an import request to the appropriate method of an import receiver, according to the type of entity
+
+    :param MeteorDatabaseImportReceiver handler:
+        The receiver which processes the entity
+    :param ImportRequest import_request:
+        The request to process
+    :return:
+        A dict describing the state of the import, generally using one of the state_xxx methods in ImportRequest
     """
-    Add two routes to the specified instance of :class:`meteorpi_server.MeteorApp` to implement the import API and allow
+    if import_request.entity is None:
+        return import_request.state_continue()
+    if import_request.entity_type == 'file':
+        state = handler.receive_file_record(import_request)
+        default_state = import_request.state_complete
+    elif import_request.entity_type == 'observation':
+        state = handler.receive_observation(import_request)
+        default_state = import_request.state_complete
+    elif import_request.entity_type == 'metadata':
+        state = handler.receive_metadata(import_request)
+        default_state = import_request.state_continue
+    else:
+        return import_request.state_failed("Unknown import request")
+    handler.db.commit()
+    if state is not None:
+        return state
+    return default_state()
+
+
+def ingest_entities(handler, import_requests):
+    """
+    Write a batch of spooled entities to the database, skipping any we already hold. Nothing is committed, so the
+    handler should be created with autocommit=False, and the caller should commit once the whole batch is written.
+
+    :param MeteorDatabaseImportReceiver handler:
+        The receiver used to write entities to the database
+    :param list import_requests:
+        A list of :class:`meteorpi_server.importer_api.ImportRequest`
+    :return:
+        A list of those requests whose entities couldn't be written yet, such as files which arrived before their
+        observations, and which should be tried again later
+    """
+    by_type = {}
+    for import_request in import_requests:
+        by_type.setdefault(import_request.entity_type, []).append(import_request)
+    retry = []
+    for entity_type in INGEST_ORDER:
+        type_requests = by_type.get(entity_type, [])
+        if not type_requests:
+            continue
+        # Exporters may send the same entity several times, so find which we need with a single query
+        missing = set(handler.db.get_missing_ids(entity_type=entity_type,
+                                                 entity_ids=list(set(x.entity_id for x in type_requests))))
+        for import_request in type_requests:
+            if import_request.entity_id not in missing:
+                continue
+            missing.discard(import_request.entity_id)
+            try:
+                if entity_type == 'metadata':
+                    handler.import_metadata(import_request.entity)
+                elif entity_type == 'observation':
+                    handler.import_observation(import_request.entity)
+                elif not handler.import_file_record(import_request.entity):
+                    retry.append(import_request)
+                    continue
+            except ValueError:
+                retry.append(import_request)
+                continue
+            if handler.metrics is not None:
+                handler.metrics.ingest_entities.inc(1, entity_type)
+    return retry
+
+
+class IngestWorkers(object):
+    """
+    A pool of background threads which take entities from the ingest spool of a :class:`meteorpi_server.MeteorApp` and
+    write them to its database in batches. If the WSGI server runs several processes, each may run its own workers,
+    which share the spool safely.
+
+    :cvar logger:
+        Logs to 'meteorpi.server.ingest'
+    """
+
+    logger = getLogger("meteorpi.server.ingest")
+
+    def __init__(self, meteor_app, workers=2, batch_size=DEFAULT_INGEST_BATCH_SIZE):
+        """
+        :param MeteorApp meteor_app:
+            The app whose spool and database we use
+        :param int workers:
+            The number of worker threads
+        :param int batch_size:
+            The number of entities each worker writes in a single transaction
+        """
+        self.meteor_app = meteor_app
+        self.spool = meteor_app.ingest_spool
+        self.workers = workers
+        self.batch_size = batch_size
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """
+        Start the worker threads. They are daemon threads, so don't prevent the process from exiting.
+        """
+        self.spool.recover()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name="meteorpi-ingest-{0}".format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Ask the worker threads to stop once they have finished their current batches, and wait for them to do so
+        """
+        self._stopping.set()
+        self.spool.added.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                state = self.run_once()
+            except Exception:
+                IngestWorkers.logger.exception("Ingest worker failed")
+                state = 'failed'
+            if state == 'failed':
+                self._stopping.wait(INGEST_BACKOFF_INTERVAL)
+            elif state == 'idle':
+                self.spool.added.wait(INGEST_POLL_INTERVAL)
+                self.spool.added.clear()
+                self.spool.recover()
+
+    def run_once(self):
+        """
+        Claim one batch of entities from the spool and write it to the database. May be called directly, for example
+        from a script which ingests the spool in a separate process from the web server.
+
+        :return:
+            'idle' if the spool was empty, 'failed' if the database couldn't be written, in which case the batch is
+            returned to the spool, or 'complete' otherwise
+        """
+        claimed = self.spool.claim(max_entities=self.batch_size)
+        if not claimed:
+            return 'idle'
+        file_names = [x[0] for x in claimed]
+        items = []
+        for file_name, user_id, attempts, entity_dicts in claimed:
+            for entity_dict in entity_dicts:
+                try:
+                    import_request = ImportRequest.from_dict(entity_dict)
+                except ValueError:
+                    IngestWorkers.logger.warning("Discarding malformed spooled entity from {0}".format(file_name))
+                    continue
+                if import_request.entity is not None:
+                    items.append((user_id, attempts, entity_dict, import_request))
+        try:
+            db = self.meteor_app.get_db()
+        except Exception:
+            IngestWorkers.logger.exception("Could not connect to the database to ingest spooled entities")
+            self.spool.release(file_names)
+            return 'failed'
+        try:
+            try:
+                retry = self._ingest(db, items)
+            except Exception:
+                # Something in the batch upset the database, so write the entities one at a time to find out what
+                db.rollback()
+                IngestWorkers.logger.exception("Could not ingest a batch of {0} entities, trying them singly".format(
+                    len(items)))
+                retry = []
+                for item in items:
+                    try:
+                        retry.extend(self._ingest(db, [item]))
+                    except Exception:
+                        db.rollback()
+                        retry.append(item)
+                if items and len(retry) == len(items):
+                    # Nothing could be written, so the database itself is probably unavailable
+                    self.spool.release(file_names)
+                    return 'failed'
+        finally:
+            db.close_db()
+        self._respool(retry)
+        self.spool.complete(file_names)
+        return 'complete'
+
+    def _ingest(self, db, items):
+        """
+        Write and commit a list of (user_id, attempts, entity_dict, import_request) items
+
+        :return:
+            The items which should be retried
+        """
+        by_user = {}
+        for item in items:
+            by_user.setdefault(item[0], []).append(item)
+        retry = []
+        for user_id, user_items in by_user.items():
+            handler = MeteorDatabaseImportReceiver(db=db, metrics=self.meteor_app.metrics, user_id=user_id,
+                                                   autocommit=False)
+            retry_requests = set(id(x) for x in ingest_entities(handler, [x[3] for x in user_items]))
+            retry.extend(x for x in user_items if id(x[3]) in retry_requests)
+        db.commit()
+        return retry
+
+    def _respool(self, items):
+        """
+        Return items which couldn't be written to the spool, to be retried later. Items which have run out of attempts
+        are moved to the spool's 'failed' directory, and are only written again after a call to
+        :meth:`meteorpi_server.ingest_spool.IngestSpool.requeue_failed`.
+        """
+        groups = {}
+        for user_id, attempts, entity_dict, import_request in items:
+            groups.setdefault((user_id, attempts + 1), []).append(entity_dict)
+        for (user_id, attempts), entity_dicts in groups.items():
+            self.spool.append(user_id=user_id, entities=entity_dicts, attempts=attempts)
+            if self.meteor_app.metrics is not None:
+                self.meteor_app.metrics.ingest_retries.inc(len(entity_dicts))
+            if attempts >= self.spool.max_attempts:
+                IngestWorkers.logger.warning("Set aside {0} spooled entities after {1} attempts, until they are "
+                                             "requeued".format(len(entity_dicts), attempts))
+
+
+def add_routes(meteor_app, url_path='/importv2', ingest_workers=0, ingest_batch_size=DEFAULT_INGEST_BATCH_SIZE):
+    """
+    Add routes to the specified instance of :class:`meteorpi_server.MeteorApp` to implement the import API and allow
     for replication of data to this server.
 
     :param meteorpi_server.MeteorApp meteor_app:
@@ -257,54 +600,187 @@ def add_routes(meteor_app, url_path='/importv2'):
         which will replicate any missing information from the import into the database attached to the meteor_app.
     :param string url_path:
         The base of the import routes for this application. Defaults to '/import' - routes will be created at this path
-        and as import_path/data/<id> for binary data reception. Both paths only respond to POST requests and require
-        that the requests are authenticated and that the authenticated user has the 'import' role.
+        as import_path/batch for batches of entities, as import_path/inventory for finding out which entities need
+        sending, and as import_path/data/<id> and import_path/upload/<id>/... for binary data reception. All paths
+        only respond to POST requests and require that the requests are authenticated and that the authenticated user
+        has the 'import' role.
+    :param int ingest_workers:
+        If zero, the default, entities are written to the database while the exporter waits for a response. Otherwise,
+        the import API runs in ingest mode: entities are checked and appended to the app's ingest spool, and the
+        exporter is told at once that they are complete; this many background threads then write them to the database
+        in batches. Entities which still can't be written after several attempts are set aside until they are requeued,
+        as the exporter won't send them again. See :class:`meteorpi_server.ingest_spool.IngestSpool`.
+    :param int ingest_batch_size:
+        In ingest mode, the number of entities written to the database in each transaction
     """
     app = meteor_app.app
 
+    spooling = ingest_workers > 0
+    if spooling:
+        meteor_app.ingest_workers = IngestWorkers(meteor_app=meteor_app, workers=ingest_workers,
+                                                  batch_size=ingest_batch_size)
+        meteor_app.ingest_workers.start()
+
+        def collect_spool_depth():
+            for state, count in zip(['pending', 'working', 'failed'], meteor_app.ingest_spool.depth()):
+                meteor_app.metrics.ingest_spool_files.set(count, state)
+
+        meteor_app.metrics.collectors.append(collect_spool_depth)
+
+    def spool_import_requests(import_requests):
+        """
+        In ingest mode, append entities to the spool and work out the states to send before they have been written to
+        the database. Only file records whose data we don't yet hold need anything more from the exporter.
+
+        :param list import_requests:
+            A list of (entity_dict, import_request) tuples, where entity_dict is the entity as sent by the exporter
+        :return:
+            A list of dicts describing the state of each import, in the same order
+        """
+        states = []
+        to_spool = []
+        for entity_dict, import_request in import_requests:
+            if import_request.entity is None:
+                states.append(import_request.state_continue())
+            elif import_request.entity_type == 'file' and not path.isfile(
+                    path.join(meteor_app.file_store_path, import_request.entity.id)):
+                # This is the path given by MeteorDatabase.file_path_for_id, found without connecting to the database
+                states.append(import_request.state_need_file_data(file_id=import_request.entity.id))
+            else:
+                states.append(None)
+                to_spool.append(entity_dict)
+        if to_spool:
+            try:
+                meteor_app.ingest_spool.append(user_id=g.user.user_id, entities=to_spool)
+                spooled = True
+            except (IOError, OSError):
+                ImportRequest.logger.exception("Could not write to the ingest spool")
+                spooled = False
+            for index, (entity_dict, import_request) in enumerate(import_requests):
+                if states[index] is None:
+                    if spooled:
+                        states[index] = import_request.state_complete()
+                    else:
+                        states[index] = ImportRequest.state_failed("Could not spool import request")
+        return states
+
     @app.route(url_path, methods=['POST'])
     @meteor_app.requires_auth(roles=['import'])
     def import_entities():
         """
         Receive an entity import request, using :class:`meteorpi_server.import_api.ImportRequest` to parse it, then
         passing the parsed request on to an instance of :class:`meteorpi_server.import_api.BaseImportReceiver` to deal
-        with the possible import types.
+        with the possible import types, or in ingest mode appending it to the ingest spool.
 
         :return:
-            A response, generally using one of the response_xxx methods in ImportRequest
+            A response containing the state of the import, or with status 400 if the request couldn't be parsed
         """
+        try:
+            import_request = ImportRequest.process_request()
+        except ValueError:
+            return ImportRequest.response_failed("Could not parse import request", status_code=400)
+        meteor_app.metrics.import_entities.inc(1, import_request.entity_type)
+        if spooling:
+            return json_response(spool_import_requests([(g.request_dict, import_request)])[0])
         db = meteor_app.get_db()
-        handler = MeteorDatabaseImportReceiver(db=db)
-        import_request = ImportRequest.process_request()
-        if import_request.entity is None:
-            return import_request.response_continue()
-        if import_request.entity_type == 'file':
-            response = handler.receive_file_record(import_request)
-            handler.db.commit()
-            db.close_db()
-            if response is not None:
-                return response
-            else:
-                return import_request.response_complete()
-        elif import_request.entity_type == 'observation':
-            response = handler.receive_observation(import_request)
-            handler.db.commit()
+        handler = MeteorDatabaseImportReceiver(db=db, metrics=meteor_app.metrics)
+        try:
+            state = receive_import_request(handler, import_request)
+        finally:
             db.close_db()
-            if response is not None:
-                return response
-            else:
-                return import_request.response_complete()
-        elif import_request.entity_type == 'metadata':
-            response = handler.receive_metadata(import_request)
-            handler.db.commit()
-            db.close_db()
-            if response is not None:
-                return response
-            else:
-                return import_request.response_continue()
+        return json_response(state)
+
+    @app.route('{0}/batch'.format(url_path), methods=['POST'])
+    @meteor_app.requires_auth(roles=['import'])
+    def import_entity_batch():
+        """
+        Receive a batch of entities, of the form {'entities':[...]}, where each member of the list has the same form as
+        a request to import_entities. Each entity is processed as if it had been sent on its own, and the response
+        contains a list of the states which would have been returned, in the same order, as {'states':[...]}.
+
+        :return:
+            A response containing the state of each entity, or with status 400 if the request couldn't be parsed
+        """
+        try:
+            entity_dicts = serialisation.loads(request.get_data())['entities']
+            if not isinstance(entity_dicts, list):
+                raise ValueError("Entities must be a list")
+        except (ValueError, KeyError, TypeError):
+            return ImportRequest.response_failed("Could not parse batch import request", status_code=400)
+        if len(entity_dicts) > MAX_IMPORT_BATCH_SIZE:
+            return ImportRequest.response_failed("Batches may contain at most {0} entities".format(
+                MAX_IMPORT_BATCH_SIZE), status_code=400)
+        parsed = []
+        for entity_dict in entity_dicts:
+            try:
+                import_request = ImportRequest.from_dict(entity_dict)
+            except ValueError:
+                parsed.append((entity_dict, None))
+                continue
+            meteor_app.metrics.import_entities.inc(1, import_request.entity_type)
+            parsed.append((entity_dict, import_request))
+        valid = [x for x in parsed if x[1] is not None]
+        if spooling:
+            valid_states = spool_import_requests(valid)
         else:
+            db = meteor_app.get_db()
+            handler = MeteorDatabaseImportReceiver(db=db, metrics=meteor_app.metrics)
+            try:
+                valid_states = [receive_import_request(handler, x[1]) for x in valid]
+            finally:
+                db.close_db()
+        valid_states = iter(valid_states)
+        states = []
+        for entity_dict, import_request in parsed:
+            if import_request is None:
+                states.append(ImportRequest.state_failed("Malformed import request"))
+                continue
+            state = dict(next(valid_states))
+            state['id'] = import_request.entity_id
+            states.append(state)
+        return json_response({'states': states})
+
+    @app.route('{0}/inventory'.format(url_path), methods=['POST'])
+    @meteor_app.requires_auth(roles=['import'])
+    def import_inventory():
+        """
+        Tell an exporter which entities it needs to send, so that it doesn't have to send those we already hold. The
+        request is of the form {'type':..., 'ids':[...], 'buckets':[...]}, where type is one of 'observation', 'file' or
+        'metadata', and both ids and buckets are optional. Each bucket is a dict of obstory_id, time_min, time_max and
+        digest, as produced by :meth:`meteorpi_db.MeteorDatabase.get_inventory_digest`.
+
+        :return:
+            A response of the form {'missing':[...], 'mismatched':[...]}, listing the IDs we don't hold, and the indices
+            of the buckets whose digests differ from ours. All entities in the other buckets are already held here.
+        """
+        try:
+            request_dict = serialisation.loads(request.get_data())
+            entity_type = request_dict['type']
+            entity_ids = [str(x) for x in request_dict.get('ids', [])]
+            buckets = request_dict.get('buckets', [])
+            if not isinstance(buckets, list):
+                raise ValueError("Buckets must be a list")
+        except (ValueError, KeyError, TypeError):
+            return ImportRequest.response_failed("Could not parse inventory request", status_code=400)
+        if len(entity_ids) > MAX_INVENTORY_IDS or len(buckets) > MAX_INVENTORY_BUCKETS:
+            return ImportRequest.response_failed(
+                "Inventory requests may contain at most {0} IDs and {1} buckets".format(MAX_INVENTORY_IDS,
+                                                                                        MAX_INVENTORY_BUCKETS),
+                status_code=400)
+        db = meteor_app.get_db()
+        try:
+            missing = db.get_missing_ids(entity_type=entity_type, entity_ids=entity_ids)
+            mismatched = []
+            for index, bucket in enumerate(buckets):
+                digest = db.get_inventory_digest(entity_type=entity_type, obstory_id=bucket['obstory_id'],
+                                                 time_min=bucket['time_min'], time_max=bucket['time_max'])
+                if digest != bucket['digest']:
+                    mismatched.append(index)
+        except (ValueError, KeyError, TypeError):
+            return ImportRequest.response_failed("Could not parse inventory request", status_code=400)
+        finally:
             db.close_db()
-            return import_request.response_failed("Unknown import request")
+        return json_response({'missing': missing, 'mismatched': mismatched})
 
     @app.route('{0}/data/<file_id_hex>/<md5_hex>'.format(url_path), methods=['POST'])
     @meteor_app.requires_auth(roles=['import'])
@@ -316,10 +792,78 @@ def add_routes(meteor_app, url_path='/importv2'):
             The hex representation of the :class:`meteorpi_model.FileRecord` to which this data belongs.
         """
         db = meteor_app.get_db()
-        handler = MeteorDatabaseImportReceiver(db=db)
+        handler = MeteorDatabaseImportReceiver(db=db, metrics=meteor_app.metrics)
         file_id = file_id_hex
         file_data = request.files['file']
         if file_data:
             handler.receive_file_data(file_id=file_id, file_data=file_data, md5_hex=md5_hex)
         db.close_db()
         return ImportRequest.response_continue_after_file()
+
+    # Files may also be uploaded in chunks, so that an interrupted upload can be resumed. The exporter starts (or
+    # resumes) an upload, and is told the offset from which to send data; it then sends each chunk in turn, and is told
+    # the offset of the next one; finally it asks us to check the MD5 sum and move the file into the file store.
+
+    @app.route('{0}/upload/<file_id_hex>/<md5_hex>'.format(url_path), methods=['POST'])
+    @meteor_app.requires_auth(roles=['import'])
+    def start_file_upload(file_id_hex, md5_hex):
+        """
+        Start or resume a chunked upload
+
+        :return:
+            A response of the form {'state':'upload', 'offset':...} giving the offset of the next chunk to send, or
+            {'state':'continue'} if we already hold the file
+        """
+        db = meteor_app.get_db()
+        try:
+            if path.isfile(db.file_path_for_id(file_id_hex)):
+                return ImportRequest.response_continue_after_file()
+        finally:
+            db.close_db()
+        meteor_app.upload_spool.expire()
+        try:
+            offset = meteor_app.upload_spool.start(file_id=file_id_hex, md5=md5_hex)
+        except ValueError as e:
+            return ImportRequest.response_failed(str(e))
+        return json_response({'state': 'upload', 'offset': offset})
+
+    @app.route('{0}/upload/<file_id_hex>/<md5_hex>/<int:offset>'.format(url_path), methods=['POST'])
+    @meteor_app.requires_auth(roles=['import'])
+    def receive_file_chunk(file_id_hex, md5_hex, offset):
+        """
+        Receive a chunk of a file, sent as the raw body of the request
+
+        :return:
+            A response of the form {'state':'upload', 'offset':...} giving the offset of the next chunk to send
+        """
+        if request.content_length is None:
+            return ImportRequest.response_failed("Chunks must be sent with a Content-Length")
+        try:
+            offset = meteor_app.upload_spool.write_chunk(file_id=file_id_hex, md5=md5_hex, offset=offset,
+                                                         stream=request.stream, length=request.content_length)
+        except ValueError as e:
+            return ImportRequest.response_failed(str(e))
+        return json_response({'state': 'upload', 'offset': offset})
+
+    @app.route('{0}/upload/<file_id_hex>/<md5_hex>/finish'.format(url_path), methods=['POST'])
+    @meteor_app.requires_auth(roles=['import'])
+    def finish_file_upload(file_id_hex, md5_hex):
+        """
+        Check the MD5 sum of a file whose chunks have all been sent, and move it into the file store
+
+        :return:
+            {'state':'continue'} if the file was received intact, otherwise a failure response, in which case the
+            upload must be started again from the beginning
+        """
+        db = meteor_app.get_db()
+        file_path = db.file_path_for_id(file_id_hex)
+        db.close_db()
+        try:
+            size = meteor_app.upload_spool.finish(file_id=file_id_hex, md5=md5_hex, dest_path=file_path)
+        except ValueError as e:
+            return ImportRequest.response_failed(str(e))
+        if size is None:
+            meteor_app.metrics.import_md5_failures.inc()
+            return ImportRequest.response_failed("MD5 sum of uploaded file did not match")
+        meteor_app.metrics.import_bytes.inc(size)
+        return ImportRequest.response_continue_after_file()
@@ -0,0 +1,271 @@
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# Holds entities which have been received by the import API but not yet written to the database. When the import API
+# runs in ingest mode, each request is validated and appended to this spool, and the exporter is told at once that it
+# has been received; background workers then claim entities from the spool and write them to the database in batches.
+# This means that a burst of exports from many observatories doesn't have to wait for the database.
+#
+# Each request is held in its own file in the 'pending' directory, written to a temporary file and renamed into place so
+# that a file is either complete or absent. Workers claim a file by renaming it into the 'working' directory, which is
+# safe between processes as well as threads, and delete it once its entities are committed. A file whose worker died is
+# moved back to 'pending' once its lease expires. Entities which couldn't be written, for example files which arrived
+# before their observations, are spooled again to be retried later, and are moved to the 'failed' directory if they
+# still can't be written after several attempts.
+#
+# The exporter has already been told that entities in the 'failed' directory are complete, so it won't send them again,
+# and inventory reconciliation won't find them either, because it only checks entities still waiting to be exported.
+# Nothing reads the 'failed' directory by itself. Once the cause has been fixed, for example by importing a missing
+# observation, call IngestSpool.requeue_failed(), or run cmdLineAdmin/requeueIngestSpool.py, to return its entities to
+# the spool to be written again.
+
+import os
+import time
+import uuid
+import threading
+
+from meteorpi_model import serialisation
+
+# Seconds after which a claimed spool file whose worker hasn't finished with it is returned to the queue
+DEFAULT_LEASE_SECONDS = 600
+
+# Number of times we try to write an entity to the database before giving up on it
+DEFAULT_MAX_ATTEMPTS = 8
+
+# Seconds to wait before retrying an entity which couldn't be written, multiplied by the number of attempts so far
+RETRY_DELAY = 60
+
+
+def default_spool_path(file_store_path):
+    """
+    :param string file_store_path:
+        The path to the database file store
+    :return:
+        The path of the directory used by default to hold entities waiting to be written to the database
+    """
+    return os.path.join(file_store_path, "../ingest_spool")
+
+
+class IngestSpool(object):
+    """
+    A durable queue of entities waiting to be written to the database, held as files in a directory. May be shared
+    between threads, and between processes using the same directory.
+
+    :ivar string spool_path:
+        The directory holding the spool
+    :ivar int lease_seconds:
+        The number of seconds after which a claimed file is returned to the queue
+    :ivar int max_attempts:
+        The number of attempts to write an entity before it is moved to the 'failed' directory
+    """
+
+    def __init__(self, spool_path, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.spool_path = spool_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._created = False
+        # Set whenever something is added to the spool by this process, so that idle workers wake up
+        self.added = threading.Event()
+
+    def _dir(self, name):
+        return os.path.join(self.spool_path, name)
+
+    def _create_dirs(self):
+        if self._created:
+            return
+        for name in ['pending', 'working', 'failed']:
+            if not os.path.isdir(self._dir(name)):
+                try:
+                    os.makedirs(self._dir(name))
+                except OSError:
+                    # Created by another process
+                    pass
+        self._created = True
+
+    def append(self, user_id, entities, attempts=0):
+        """
+        Add entities to the spool. They are written to disk before this method returns, so will be imported even if
+        the server is restarted.
+
+        :param string user_id:
+            The ID of the user who sent the entities, recorded as their creator in the database
+        :param list entities:
+            A list of dicts, each of the form sent by the exporter to the import API
+        :param int attempts:
+            The number of times we have already tried to write these entities to the database
+        :return:
+            The name of the spool file
+        :raises:
+            IOError or OSError if the spool couldn't be written
+        """
+        self._create_dirs()
+        if attempts >= self.max_attempts:
+            directory = 'failed'
+            not_before = time.time()
+        else:
+            directory = 'pending'
+            not_before = time.time() + RETRY_DELAY * attempts
+        # Files are named by the time after which they may be claimed, so that claiming them in name order takes the
+        # oldest first and skips those waiting to be retried
+        file_name = "%017.6f-%s.json" % (not_before, uuid.uuid4().hex)
+        text = serialisation.dumps({'user_id': user_id, 'attempts': attempts, 'entities': entities})
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        temp_path = os.path.join(self._dir('working'), file_name + '.tmp')
+        with open(temp_path, 'wb') as spool_file:
+            spool_file.write(text)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        os.rename(temp_path, os.path.join(self._dir(directory), file_name))
+        self.added.set()
+        return file_name
+
+    def claim(self, max_entities):
+        """
+        Claim files from the spool, oldest first, until we have at least one file or max_entities entities
+
+        :param int max_entities:
+            The number of entities to aim for. A single file may hold more than this.
+        :return:
+            A list of (file name, user ID, attempts, entities) tuples. Each file must subsequently be passed to
+            complete() or release().
+        """
+        self._create_dirs()
+        now = time.time()
+        claimed = []
+        count = 0
+        for file_name in sorted(os.listdir(self._dir('pending'))):
+            if count >= max_entities:
+                break
+            try:
+                if float(file_name.split('-')[0]) > now:
+                    break
+            except ValueError:
+                continue
+            working_path = os.path.join(self._dir('working'), file_name)
+            try:
+                os.rename(os.path.join(self._dir('pending'), file_name), working_path)
+            except OSError:
+                # Claimed by another worker
+                continue
+            # The lease starts now, not when the file was written
+            os.utime(working_path, None)
+            try:
+                with open(working_path, 'rb') as spool_file:
+                    record = serialisation.loads(spool_file.read())
+                entities = record['entities']
+            except (IOError, ValueError, KeyError, TypeError):
+                os.rename(working_path, os.path.join(self._dir('failed'), file_name))
+                continue
+            claimed.append((file_name, record.get('user_id'), record.get('attempts', 0), entities))
+            count += len(entities)
+        return claimed
+
+    def complete(self, file_names):
+        """
+        Remove claimed files whose entities have all been dealt with
+
+        :param list file_names:
+            The names of the files, as returned by claim()
+        """
+        for file_name in file_names:
+            try:
+                os.remove(os.path.join(self._dir('working'), file_name))
+            except OSError:
+                pass
+
+    def release(self, file_names):
+        """
+        Return claimed files to the spool without processing them, for example because the database is unavailable
+
+        :param list file_names:
+            The names of the files, as returned by claim()
+        """
+        for file_name in file_names:
+            try:
+                os.rename(os.path.join(self._dir('working'), file_name), os.path.join(self._dir('pending'), file_name))
+            except OSError:
+                pass
+        if file_names:
+            self.added.set()
+
+    def recover(self):
+        """
+        Return files to the spool whose workers have held them for longer than lease_seconds, presumably because they
+        died while processing them, and remove temporary files left by writers which died.
+
+        :return:
+            The number of files returned to the spool
+        """
+        self._create_dirs()
+        cutoff = time.time() - self.lease_seconds
+        recovered = []
+        for file_name in os.listdir(self._dir('working')):
+            path = os.path.join(self._dir('working'), file_name)
+            try:
+                if os.stat(path).st_mtime >= cutoff:
+                    continue
+                if file_name.endswith('.tmp'):
+                    os.remove(path)
+                else:
+                    recovered.append(file_name)
+            except OSError:
+                pass
+        self.release(recovered)
+        return len(recovered)
+
+    def requeue_failed(self):
+        """
+        Return the entities in the 'failed' directory to the spool, with their count of attempts reset, so that they are
+        written to the database again. Files which can't be read are left where they are.
+
+        :return:
+            A tuple of the number of files returned to the spool, and the number left in the 'failed' directory
+        """
+        self._create_dirs()
+        requeued = 0
+        unreadable = 0
+        for file_name in sorted(os.listdir(self._dir('failed'))):
+            failed_path = os.path.join(self._dir('failed'), file_name)
+            try:
+                with open(failed_path, 'rb') as spool_file:
+                    record = serialisation.loads(spool_file.read())
+                entities = record['entities']
+            except (IOError, ValueError, KeyError, TypeError):
+                unreadable += 1
+                continue
+            # Write the new file before removing the old one, so the entities aren't lost if we are interrupted
+            self.append(user_id=record.get('user_id'), entities=entities)
+            try:
+                os.remove(failed_path)
+            except OSError:
+                pass
+            requeued += 1
+        return requeued, unreadable
+
+    def depth(self):
+        """
+        :return:
+            A tuple of the number of files waiting in the spool, the number being processed, and the number which
+            failed
+        """
+        self._create_dirs()
+        return tuple(len([x for x in os.listdir(self._dir(name)) if not x.endswith('.tmp')])
+                     for name in ['pending', 'working', 'failed'])
@@ -0,0 +1,290 @@
+# metrics.py
+# Meteor Pi, Cambridge Science Centre
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# Counters, gauges and histograms describing the activity of a MeteorApp, exposed in the Prometheus text format on a
+# /metrics route. Metrics are held in memory by each server process, so if the WSGI server runs several processes each
+# will report its own figures, and they are reset when the process restarts.
+#
+# The metrics reveal how the server is being used, so reading them requires a user with the obstory_admin role, unless
+# the request comes from one of a list of allowed addresses, such as that of a Prometheus server on the same host.
+
+import time
+import threading
+from bisect import bisect_left
+
+from flask import g, request, Response
+
+# Upper bounds, in seconds, of the buckets of the request latency histogram
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.]
+
+# Upper bounds of the buckets of the histogram of the number of database queries made by each request
+QUERY_COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = ['{0}="{1}"'.format(name, _escape(value)) for name, value in zip(label_names, label_values)]
+    if extra is not None:
+        pairs.append('{0}="{1}"'.format(extra[0], _escape(extra[1])))
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+class Metric(object):
+    """
+    Base class for metrics. Each metric has a name, a help string, and optionally a list of label names; a separate
+    value is held for each combination of label values seen.
+    """
+
+    metric_type = 'untyped'
+
+    def __init__(self, name, help_text, label_names=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names or []
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        """
+        :return:
+            A list of lines describing this metric in the Prometheus text exposition format
+        """
+        lines = ['# HELP {0} {1}'.format(self.name, self.help_text),
+                 '# TYPE {0} {1}'.format(self.name, self.metric_type)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _render_value(self, label_values, value):
+        return ['{0}{1} {2}'.format(self.name, _format_labels(self.label_names, label_values), _format_value(value))]
+
+
+class Counter(Metric):
+    """
+    A value which only ever increases, such as a number of requests
+    """
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def set(self, value, *label_values):
+        """
+        Set the value of this counter, for counters which mirror a count kept elsewhere
+        """
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Gauge(Metric):
+    """
+    A value which may go up and down, such as the number of requests in progress
+    """
+
+    metric_type = 'gauge'
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, amount=1, *label_values):
+        self.inc(-amount, *label_values)
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(Metric):
+    """
+    Counts observations, such as request latencies, in a fixed set of buckets, also recording their sum and count
+    """
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, buckets, label_names=None):
+        super(Histogram, self).__init__(name=name, help_text=help_text, label_names=label_names)
+        self.buckets = list(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _render_value(self, label_values, value):
+        bucket_counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + [float('inf')], bucket_counts):
+            cumulative += bucket_count
+            lines.append('{0}_bucket{1} {2}'.format(self.name,
+                                                    _format_labels(self.label_names, label_values,
+                                                                   ('le', _format_value(bound))),
+                                                    cumulative))
+        labels = _format_labels(self.label_names, label_values)
+        lines.append('{0}_sum{1} {2}'.format(self.name, labels, _format_value(total)))
+        lines.append('{0}_count{1} {2}'.format(self.name, labels, count))
+        return lines
+
+
+class ServerMetrics(object):
+    """
+    The metrics recorded by a :class:`meteorpi_server.MeteorApp`. One instance is created by each MeteorApp, and the
+    request metrics are recorded once :func:`meteorpi_server.metrics.add_routes` has been called.
+    """
+
+    def __init__(self):
+        self.requests = Counter('meteorpi_http_requests_total', 'HTTP requests handled, by route and status code',
+                                ['route', 'method', 'status'])
+        self.errors = Counter('meteorpi_http_errors_total', 'HTTP requests which raised an exception or returned 5xx',
+                              ['route'])
+        self.latency = Histogram('meteorpi_http_request_duration_seconds',
+                                 'Time taken to produce HTTP responses, excluding streamed bodies', LATENCY_BUCKETS,
+                                 ['route'])
+        self.in_flight = Gauge('meteorpi_http_requests_in_flight', 'HTTP requests currently being handled')
+        self.db_queries = Histogram('meteorpi_db_queries_per_request', 'Database queries made by each HTTP request',
+                                    QUERY_COUNT_BUCKETS, ['route'])
+        self.cache_hits = Counter('meteorpi_cache_hits_total', 'Lookups answered from a cache', ['cache'])
+        self.cache_misses = Counter('meteorpi_cache_misses_total', 'Lookups which missed a cache', ['cache'])
+        self.import_entities = Counter('meteorpi_import_entities_total', 'Entities received by the import API',
+                                       ['type'])
+        self.import_bytes = Counter('meteorpi_import_file_bytes_total', 'Bytes of file data received by the import API')
+        self.import_md5_failures = Counter('meteorpi_import_md5_failures_total',
+                                           'Files received by the import API whose MD5 sum did not match')
+        self.ingest_entities = Counter('meteorpi_ingest_entities_total',
+                                       'Spooled entities written to the database by the ingest workers', ['type'])
+        self.ingest_retries = Counter('meteorpi_ingest_retries_total',
+                                      'Spooled entities which could not be written to the database and will be retried')
+        self.ingest_spool_files = Gauge('meteorpi_ingest_spool_files',
+                                        'Files in the ingest spool, by state', ['state'])
+        self.all_metrics = [self.requests, self.errors, self.latency, self.in_flight, self.db_queries,
+                            self.cache_hits, self.cache_misses, self.import_entities, self.import_bytes,
+                            self.import_md5_failures, self.ingest_entities, self.ingest_retries,
+                            self.ingest_spool_files]
+        # Functions called when rendering, which may update metrics from counters held elsewhere
+        self.collectors = []
+
+    def render(self):
+        """
+        :return:
+            All metrics in the Prometheus text exposition format
+        """
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.all_metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def add_routes(meteor_app, url_path='', roles=None, allowed_addresses=None):
+    """
+    Start recording request metrics for a :class:`meteorpi_server.MeteorApp`, and add a route which exposes them
+
+    :param MeteorApp meteor_app:
+        The :class:`meteorpi_server.MeteorApp` to instrument
+    :param string url_path:
+        The base path used for the metrics route, defaults to ''
+    :param list roles:
+        The roles a user must have to read the metrics, authenticating with HTTP basic auth as for the admin API.
+        Defaults to ['obstory_admin'].
+    :param list allowed_addresses:
+        Remote addresses from which the metrics may be read without authenticating, for example ['127.0.0.1'] for a
+        Prometheus server on the same host. Defaults to none. Behind a reverse proxy every request appears to come
+        from the proxy's address, so only use this if the proxy doesn't forward requests for the metrics route.
+    """
+    if roles is None:
+        roles = ['obstory_admin']
+    allowed_addresses = set(allowed_addresses or [])
+    app = meteor_app.app
+    metrics = meteor_app.metrics
+
+    # The thumbnail and file validator caches keep their own hit counts, which we copy across when rendering
+    def collect_cache_counts():
+        for name, cache in [('thumbnail', meteor_app.derivative_cache), ('validator', meteor_app.validator_cache)]:
+            metrics.cache_hits.set(cache.hits, name)
+            metrics.cache_misses.set(cache.misses, name)
+
+    metrics.collectors.append(collect_cache_counts)
+
+    @app.before_request
+    def metrics_before_request():
+        g.metrics_start_time = time.time()
+        g.metrics_dbs = []
+        metrics.in_flight.inc()
+
+    @app.after_request
+    def metrics_after_request(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def metrics_teardown_request(exc):
+        start_time = getattr(g, 'metrics_start_time', None)
+        if start_time is None:
+            return
+        metrics.in_flight.dec()
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        status = getattr(g, 'metrics_status', 500) if exc is None else 500
+        metrics.latency.observe(time.time() - start_time, route)
+        metrics.requests.inc(1, route, request.method, status)
+        if status >= 500:
+            metrics.errors.inc(1, route)
+        dbs = getattr(g, 'metrics_dbs', [])
+        if dbs:
+            metrics.db_queries.observe(sum(db.query_count for db in dbs), route)
+            metrics.cache_hits.inc(sum(db.count_queries_avoided for db in dbs), 'count')
+            metrics.cache_misses.inc(sum(db.count_queries_run for db in dbs), 'count')
+
+    def render_metrics():
+        return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8',
+                        headers={'Cache-Control': 'no-cache'})
+
+    render_metrics_authenticated = meteor_app.requires_auth(roles=roles)(render_metrics)
+
+    @app.route('{0}/metrics'.format(url_path), methods=['GET'])
+    def get_metrics():
+        if request.remote_addr in allowed_addresses:
+            return render_metrics()
+        return render_metrics_authenticated()
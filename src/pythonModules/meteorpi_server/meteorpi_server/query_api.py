@@ -21,15 +21,111 @@
 # along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
 # -------------------------------------------------
 
-import os
 import sys
-import re
 import time
 from urllib import unquote
-from yaml import safe_load
 import meteorpi_model as mp
-from flask.ext.jsonpify import jsonify
-from flask import request, send_file, Response
+from meteorpi_model import serialisation
+from meteorpi_db import derivatives
+from meteorpi_server import json_response, caching
+from flask import request, Response
+
+# Size of the blocks of JSON text written to the client when streaming search results
+STREAM_CHUNK_SIZE = 65536
+
+# Types of search which can be run by the batch search API. For each, the name of the list of results in the structure
+# returned by the database, and the codec used to serialise its members.
+BATCH_SEARCH_TYPES = {
+    'observation_search': ('obs', serialisation.observation),
+    'file_search': ('files', serialisation.file_record),
+    'obsgroup_search': ('obsgroups', serialisation.obsgroup),
+    'metadata_search': ('items', serialisation.obstory_metadata)
+}
+
+# Maximum number of searches which may be submitted in one batch
+MAX_BATCH_SEARCHES = 100
+
+
+def _decode_continuation(text):
+    """
+    Decode the 'after' argument of a request for a page of search results
+
+    :param string text:
+        The argument, as sent by the client, or None for the first page
+    :return:
+        The value to pass as 'after' to :meth:`meteorpi_db.MeteorDatabase.page_observations` or page_files
+    :raises:
+        ValueError if the argument is malformed
+    """
+    if not text:
+        return None
+    after = serialisation.loads(text)
+    if not isinstance(after, list) or len(after) != 2:
+        raise ValueError("Malformed page continuation")
+    return after
+
+
+def _encode_continuation(after):
+    return serialisation.dumps(after) if after is not None else None
+
+
+def stream_search_results(db, results_key, items, search, count_results, ndjson=False):
+    """
+    Build a streamed response from an iterator over model objects, such as that returned by
+    :meth:`meteorpi_db.MeteorDatabase.iter_observations`. Objects are converted to JSON and written to the client as
+    they are pulled from the database, so the server never holds the whole result set in memory. The database is closed
+    once the response has been written.
+
+    :param MeteorDatabase db:
+        The database from which results are being read
+    :param string results_key:
+        The name of the array of results in the JSON object returned, e.g. 'obs' or 'files'
+    :param items:
+        An iterator over model objects, each of which must have an as_dict() method
+    :param search:
+        The search being run, used to work out the total number of results
+    :param count_results:
+        A function which takes the search, and returns the total number of results if there were no limit
+    :param Boolean ndjson:
+        If True, send newline-delimited JSON, with one object per line and no count. Otherwise send a JSON object of
+        the same form as the non-streamed search, i.e. {results_key: [...], 'count': n}
+    :return:
+        A flask Response object, can be used as a return type from service methods
+    """
+
+    def generate():
+        try:
+            rows_returned = 0
+            buffer = []
+            buffer_size = 0
+            if not ndjson:
+                buffer.append('{"%s":[' % results_key)
+            for item in items:
+                text = serialisation.dumps(item.as_dict())
+                if ndjson:
+                    text += '\n'
+                elif rows_returned > 0:
+                    text = ',' + text
+                rows_returned += 1
+                buffer.append(text)
+                buffer_size += len(text)
+                if buffer_size >= STREAM_CHUNK_SIZE:
+                    yield ''.join(buffer)
+                    buffer = []
+                    buffer_size = 0
+            if not ndjson:
+                # Only run a COUNT query if we can't work out the total from the number of results returned
+                total_rows = rows_returned + search.skip
+                if (search.limit and rows_returned == search.limit) or (rows_returned == 0 and search.skip > 0):
+                    total_rows = count_results(search)
+                buffer.append('],"count":%d}' % total_rows)
+            yield ''.join(buffer)
+        finally:
+            db.close_db()
+
+    if ndjson:
+        return Response(generate(), mimetype='application/x-ndjson')
+    return Response(generate(), mimetype='application/json')
 
 
 def add_routes(meteor_app, url_path=''):
@@ -47,9 +143,14 @@ def add_routes(meteor_app, url_path=''):
 
     @app.after_request
     def after_request(response):
-        response.headers.add('Accept-Ranges', 'bytes')
+        if 'Accept-Ranges' not in response.headers:
+            response.headers.add('Accept-Ranges', 'bytes')
         return response
 
+    # Search and status responses carry an ETag, so that clients polling for updates only receive them when they change
+    def cacheable(response):
+        return caching.conditional_json(response, meteor_app.query_max_age)
+
     # Return a list of all of the observatories which are registered in this repository
     # A dictionary of basic information is returned for each
     @app.route('{0}/obstories'.format(url_path), methods=['GET'])
@@ -80,7 +181,7 @@ def add_routes(meteor_app, url_path=''):
             output[o]['firstSeen'] = first_seen
             output[o]['lastSeen'] = last_seen
         db.close_db()
-        return jsonify(output)
+        return cacheable(json_response(output))
 
     # Return a list of all of the metadata tags which ever been set on a particular observatory, with time stamp
     @app.route('{0}/obstory/<obstory_id>/metadata'.format(url_path), methods=['GET'])
@@ -91,7 +192,7 @@ def add_routes(meteor_app, url_path=''):
         data.sort(key=lambda x: x.time)
         output = [[i.time, i.key, i.value] for i in data]
         db.close_db()
-        return jsonify({'status': output})
+        return cacheable(json_response({'status': output}))
 
     # Return a list of all of the metadata which was valid for a particular observatory at a particular time
     @app.route('{0}/obstory/<obstory_id>/statusdict'.format(url_path), methods=['GET'])
@@ -107,33 +208,136 @@ def add_routes(meteor_app, url_path=''):
                 obstory_name = obstory_info['name']
                 status = db.get_obstory_status(obstory_name=obstory_name, time=float(unix_time))
         except ValueError:
-            return jsonify({'error': 'No such observatory "%s".' % obstory_id})
+            return json_response({'error': 'No such observatory "%s".' % obstory_id})
         db.close_db()
-        return jsonify({'status': status})
+        return cacheable(json_response({'status': status}))
 
     # Search for observations using a YAML search string
     @app.route('{0}/obs/<search_string>'.format(url_path), methods=['GET'], strict_slashes=True)
     def search_events(search_string):
         db = meteor_app.get_db()
         try:
-            search = mp.ObservationSearch.from_dict(safe_load(unquote(search_string)))
+            search = serialisation.observation_search.decode_legacy(unquote(search_string))
         except ValueError:
-            return jsonify({'error': str(sys.exc_info()[1])})
+            return json_response({'error': str(sys.exc_info()[1])})
         observations = db.search_observations(search)
         db.close_db()
-        return jsonify({'obs': list(x.as_dict() for x in observations['obs']), 'count': observations['count']})
+        return cacheable(json_response({'obs': serialisation.observation.as_dicts(observations['obs']),
+                                        'count': observations['count']}))
+
+    # Search for observations, streaming the results as they are fetched from the database. The 'ndjson' format sends
+    # one observation per line, which clients can process as the results arrive
+    @app.route('{0}/obs/<search_string>/stream'.format(url_path), methods=['GET'])
+    @app.route('{0}/obs/<search_string>/ndjson'.format(url_path), methods=['GET'], endpoint='search_events_ndjson')
+    def search_events_stream(search_string):
+        try:
+            search = serialisation.observation_search.decode_legacy(unquote(search_string))
+        except ValueError:
+            return json_response({'error': str(sys.exc_info()[1])})
+        db = meteor_app.get_db()
+        rv = stream_search_results(db=db, results_key='obs', items=db.iter_observations(search),
+                                   search=search, count_results=db.count_observations,
+                                   ndjson=request.path.endswith('/ndjson'))
+        return caching.query_cache_control(rv, meteor_app.query_max_age)
+
+    # Return a page of the results of a search for observations, newest first. Rather than skipping over earlier
+    # results, which gets slower the further through the results we are, each page ends with a 'next' value which the
+    # client sends as the 'after' argument of its request for the following page. No COUNT query is run.
+    @app.route('{0}/obs/<search_string>/page'.format(url_path), methods=['GET'])
+    def search_events_page(search_string):
+        try:
+            search = serialisation.observation_search.decode_legacy(unquote(search_string))
+            after = _decode_continuation(request.args.get('after'))
+        except ValueError:
+            return json_response({'error': str(sys.exc_info()[1])})
+        db = meteor_app.get_db()
+        try:
+            page = db.page_observations(search, after=after)
+        except ValueError:
+            return json_response({'error': str(sys.exc_info()[1])})
+        finally:
+            db.close_db()
+        return cacheable(json_response({'obs': serialisation.observation.as_dicts(page['obs']),
+                                        'next': _encode_continuation(page['next'])}))
 
     # Search for files using a YAML search string
     @app.route('{0}/files/<search_string>'.format(url_path), methods=['GET'])
     def search_files(search_string):
         db = meteor_app.get_db()
         try:
-            search = mp.FileRecordSearch.from_dict(safe_load(unquote(search_string)))
+            search = serialisation.file_record_search.decode_legacy(unquote(search_string))
         except ValueError:
-            return jsonify({'error': str(sys.exc_info()[1])})
+            return json_response({'error': str(sys.exc_info()[1])})
         files = db.search_files(search)
         db.close_db()
-        return jsonify({'files': list(x.as_dict() for x in files['files']), 'count': files['count']})
+        return cacheable(json_response({'files': serialisation.file_record.as_dicts(files['files']),
+                                        'count': files['count']}))
+
+    # Search for files, streaming the results as they are fetched from the database
+    @app.route('{0}/files/<search_string>/stream'.format(url_path), methods=['GET'])
+    @app.route('{0}/files/<search_string>/ndjson'.format(url_path), methods=['GET'], endpoint='search_files_ndjson')
+    def search_files_stream(search_string):
+        try:
+            search = serialisation.file_record_search.decode_legacy(unquote(search_string))
+        except ValueError:
+            return json_response({'error': str(sys.exc_info()[1])})
+        db = meteor_app.get_db()
+        rv = stream_search_results(db=db, results_key='files', items=db.iter_files(search),
+                                   search=search, count_results=db.count_files,
+                                   ndjson=request.path.endswith('/ndjson'))
+        return caching.query_cache_control(rv, meteor_app.query_max_age)
+
+    # Return a page of the results of a search for files, newest first, as for observations above
+    @app.route('{0}/files/<search_string>/page'.format(url_path), methods=['GET'])
+    def search_files_page(search_string):
+        try:
+            search = serialisation.file_record_search.decode_legacy(unquote(search_string))
+            after = _decode_continuation(request.args.get('after'))
+        except ValueError:
+            return json_response({'error': str(sys.exc_info()[1])})
+        db = meteor_app.get_db()
+        try:
+            page = db.page_files(search, after=after)
+        except ValueError:
+            return json_response({'error': str(sys.exc_info()[1])})
+        finally:
+            db.close_db()
+        return cacheable(json_response({'files': serialisation.file_record.as_dicts(page['files']),
+                                        'next': _encode_continuation(page['next'])}))
+
+    # Run several searches in one request. The body is a JSON array of objects of the form {type:..., search:{...}},
+    # where type is one of the keys of BATCH_SEARCH_TYPES. Returns {results:[...]} with one entry per search, each
+    # containing the type, the list of results and the total count, as returned by the individual search routes.
+    @app.route('{0}/search/batch'.format(url_path), methods=['POST'])
+    def search_batch():
+        try:
+            items = serialisation.loads(request.get_data())
+            if not isinstance(items, list):
+                raise ValueError("Batch search must be a list")
+            if len(items) > MAX_BATCH_SEARCHES:
+                raise ValueError("Batch search may contain at most {0} searches".format(MAX_BATCH_SEARCHES))
+            search_types = []
+            searches = []
+            for item in items:
+                search_type = item.get('type') if isinstance(item, dict) else None
+                if search_type not in BATCH_SEARCH_TYPES:
+                    raise ValueError("Unknown search type: {0}".format(search_type))
+                search_types.append(search_type)
+                searches.append(serialisation.codec_for_name(search_type).from_dict(item.get('search', {})))
+        except ValueError:
+            return json_response({'error': str(sys.exc_info()[1])}, status_code=400)
+        db = meteor_app.get_db()
+        try:
+            results = db.search_batch(searches)
+        finally:
+            db.close_db()
+        output = []
+        for search_type, result in zip(search_types, results):
+            results_key, codec = BATCH_SEARCH_TYPES[search_type]
+            output.append({'type': search_type,
+                           results_key: codec.as_dicts(result[results_key]),
+                           'count': result['count']})
+        return json_response({'results': output})
 
     # Return a list of sky clarity measurements for a particular observatory (scale 0-100)
     @app.route('{0}/skyclarity/<obstory_id>/<utc_min>/<utc_max>/<period>'.format(url_path), methods=['GET'])
@@ -168,7 +372,7 @@ def add_routes(meteor_app, url_path=''):
             if b >= utc_max:
                 break
         db.close_db()
-        return jsonify(output)
+        return cacheable(json_response(output))
 
     # Return a list of the number of observations of a particular type in a sequence
     # of time intervals between utc_min and utc_max, with step size period
@@ -194,65 +398,49 @@ def add_routes(meteor_app, url_path=''):
             if b >= utc_max:
                 break
         db.close_db()
-        return jsonify({"activity": output})
+        return cacheable(json_response({"activity": output}))
 
     # Return a thumbnail version of an image
     @app.route('{0}/thumbnail/<file_id>/<file_name>'.format(url_path), methods=['GET'])
     def get_thumbnail(file_id, file_name):
+        return get_derivative(size_name='thumbnail', image_format='png', file_id=file_id, file_name=file_name)
+
+    # Return a resized version of an image, in one of the sizes and formats listed in meteorpi_db.derivatives
+    @app.route('{0}/derivative/<size_name>/<image_format>/<file_id>/<file_name>'.format(url_path), methods=['GET'])
+    def get_derivative(size_name, image_format, file_id, file_name):
+        # Derivatives never change, so if we know the file's MD5 sum we may not need to look at the database at all
+        if size_name not in derivatives.DERIVATIVE_SIZES or image_format not in derivatives.DERIVATIVE_FORMATS:
+            return MeteorApp.not_found(entity_id=file_id,
+                                       message="Unknown derivative size or format: %s/%s" % (size_name, image_format))
+        etag_suffix = '-{0}-{1}'.format(size_name, image_format)
+        rv = meteor_app.validator_cache.check_not_modified(file_id=file_id, etag_suffix=etag_suffix,
+                                                           mime_types=derivatives.SOURCE_MIME_TYPES)
+        if rv is not None:
+            return rv
         db = meteor_app.get_db()
         record = db.get_file(repository_fname=file_id)
         if record is None:
             db.close_db()
             return MeteorApp.not_found(entity_id=file_id)
-        if record.mime_type != "image/png":
-            db.close_db()
-            return MeteorApp.not_found(entity_id=file_id)
         file_path = db.file_path_for_id(record.id)
-        thumb_path = os.path.join(db.file_store_path, "../thumbnails", record.id)
-        if not os.path.exists(thumb_path):
-            resize_tool = os.path.join(meteor_app.binary_path, "resize")
-            os.system("%s %s 220 %s" % (resize_tool, file_path, thumb_path))
         db.close_db()
-        return send_file(filename_or_fp=thumb_path, mimetype=record.mime_type)
+        meteor_app.validator_cache.put(record.id, record.file_md5, record.mime_type)
+        try:
+            derivative_path, mime_type = meteor_app.derivative_cache.get_derivative(
+                file_record=record, source_path=file_path, size_name=size_name, image_format=image_format)
+        except ValueError:
+            return MeteorApp.not_found(entity_id=file_id, message=str(sys.exc_info()[1]))
+        etag = None if record.file_md5 is None else record.file_md5 + etag_suffix
+        return meteor_app.serve_file(file_path=derivative_path, mime_type=mime_type, etag=etag,
+                                     cache_control=caching.IMMUTABLE_CACHE_CONTROL)
 
     # Return a file from the repository
     @app.route('{0}/files/content/<file_id>/<file_name>'.format(url_path), methods=['GET'])
     @app.route('{0}/files/content/<file_id>'.format(url_path), methods=['GET'])
     def get_file_content(file_id, file_name=None):
-
-        # http://blog.asgaard.co.uk/2012/08/03/http-206-partial-content-for-flask-python
-        def send_file_partial(filename_or_fp, mimetype):
-            range_header = request.headers.get('Range', None)
-            if not range_header:
-                return send_file(filename_or_fp, mimetype=record.mime_type)
-
-            size = os.path.getsize(filename_or_fp)
-            byte1, byte2 = 0, None
-
-            m = re.search('(\d+)-(\d*)', range_header)
-            g = m.groups()
-
-            if g[0]:
-                byte1 = int(g[0])
-            if g[1]:
-                byte2 = int(g[1])
-
-            length = size - byte1
-            if byte2 is not None:
-                length = byte2 - byte1 + 1
-
-            with open(filename_or_fp, 'rb') as f:
-                f.seek(byte1)
-                data = f.read(length)
-
-            rv = Response(data,
-                          206,
-                          mimetype=mimetype,
-                          direct_passthrough=True)
-            rv.headers.add('Content-Range', 'bytes {0}-{1}/{2}'.format(byte1, byte1 + length - 1, size))
-
+        rv = meteor_app.validator_cache.check_not_modified(file_id=file_id)
+        if rv is not None:
             return rv
-
         db = meteor_app.get_db()
         record = db.get_file(repository_fname=file_id)
         if record is None:
@@ -260,4 +448,6 @@ def add_routes(meteor_app, url_path=''):
             return MeteorApp.not_found(entity_id=file_id)
         file_path = db.file_path_for_id(record.id)
         db.close_db()
-        return send_file_partial(filename_or_fp=file_path, mimetype=record.mime_type)
+        meteor_app.validator_cache.put(record.id, record.file_md5, record.mime_type)
+        return meteor_app.serve_file(file_path=file_path, mime_type=record.mime_type, etag=record.file_md5,
+                                     cache_control=caching.IMMUTABLE_CACHE_CONTROL)
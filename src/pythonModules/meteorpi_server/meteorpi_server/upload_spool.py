@@ -0,0 +1,204 @@
+# upload_spool.py
+# Meteor Pi, Cambridge Science Centre
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+# Holds partially-received files which are being uploaded to the import API in chunks, so that an upload which is
+# interrupted, for example by an observatory's network link dropping, can resume from the last chunk we received rather
+# than starting again. Once every chunk has arrived and the MD5 sum of the file has been checked, the file is moved into
+# the file store.
+
+import os
+import re
+import time
+import shutil
+import hashlib
+import threading
+
+# Spooled files which haven't been added to for this many seconds are assumed to have been abandoned
+DEFAULT_SPOOL_MAX_AGE = 7 * 24 * 3600
+
+# Largest chunk we accept in a single request, in bytes
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Repository IDs are made by meteorpi_model.get_hash, as a timestamp followed by hex digits, such as
+# 20161019_192047_21064822730a1ef3. These patterns also keep the names of spooled files safe to use as paths.
+_file_id = re.compile(r'^[0-9A-Za-z_]{1,32}$')
+_hex_md5 = re.compile(r'^[0-9a-fA-F]{32}$')
+
+
+def default_spool_path(file_store_path):
+    """
+    :param string file_store_path:
+        The path to the database file store
+    :return:
+        The path of the directory used by default to hold partial uploads. This is alongside the file store, so that
+        finished files can be renamed into it rather than copied.
+    """
+    return os.path.join(file_store_path, "../upload_spool")
+
+
+class UploadSpool(object):
+    """
+    A directory of partially-uploaded files, each identified by the repository ID of the file and its MD5 sum. Chunks
+    must be sent in order; a client which doesn't know how much of a file we hold, for example after a dropped
+    connection, should start the upload again and will be told the offset to resume from. A single instance should be
+    shared between the threads of a process.
+    """
+
+    def __init__(self, spool_path, max_age=DEFAULT_SPOOL_MAX_AGE):
+        """
+        :param string spool_path:
+            The directory in which partial uploads are held
+        :param int max_age:
+            The number of seconds after which an upload which has received no new chunks is deleted
+        """
+        self.spool_path = spool_path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+    def _path(self, file_id, md5):
+        if not _file_id.match(file_id):
+            raise ValueError("File IDs must be at most 32 letters, digits or underscores")
+        if not _hex_md5.match(md5):
+            raise ValueError("MD5 sums must be 32 hex digits")
+        return os.path.join(self.spool_path, "%s.%s.part" % (file_id, md5.lower()))
+
+    def start(self, file_id, md5):
+        """
+        Start, or resume, an upload
+
+        :param string file_id:
+            The repository ID of the file being uploaded
+        :param string md5:
+            The MD5 sum of the complete file
+        :return:
+            The number of bytes of the file we already hold, which is the offset of the next chunk to send
+        :raises:
+            ValueError if the file ID or MD5 sum is malformed
+        """
+        path = self._path(file_id, md5)
+        with self._lock:
+            if not os.path.isdir(self.spool_path):
+                try:
+                    os.makedirs(self.spool_path)
+                except OSError:
+                    # Created by another process
+                    pass
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            return os.path.getsize(path)
+
+    def write_chunk(self, file_id, md5, offset, stream, length):
+        """
+        Append a chunk of data to an upload
+
+        :param string file_id:
+            The repository ID of the file being uploaded
+        :param string md5:
+            The MD5 sum of the complete file
+        :param int offset:
+            The position in the file of the first byte of the chunk
+        :param stream:
+            A file-like object from which the chunk is read
+        :param int length:
+            The length of the chunk in bytes
+        :return:
+            The number of bytes of the file we now hold. If the chunk didn't start where the previous one finished, it
+            is ignored, and the client should resume from the offset returned.
+        :raises:
+            ValueError if the upload hasn't been started, or the chunk is too large
+        """
+        path = self._path(file_id, md5)
+        if length > MAX_CHUNK_SIZE:
+            raise ValueError("Chunks may be at most %d bytes" % MAX_CHUNK_SIZE)
+        # Read the whole chunk before touching the spooled file, so that if the connection drops part way through the
+        # chunk we don't keep a partial one
+        blocks = []
+        remaining = length
+        while remaining > 0:
+            block = stream.read(min(remaining, 65536))
+            if not block:
+                break
+            blocks.append(block)
+            remaining -= len(block)
+        with self._lock:
+            if not os.path.exists(path):
+                raise ValueError("No upload in progress for file %s" % file_id)
+            size = os.path.getsize(path)
+            if offset != size or remaining > 0:
+                return size
+            with open(path, 'ab') as spool_file:
+                for block in blocks:
+                    spool_file.write(block)
+            return size + length
+
+    def finish(self, file_id, md5, dest_path):
+        """
+        Check the MD5 sum of a completed upload and, if it is correct, move the file to its place in the file store
+
+        :param string file_id:
+            The repository ID of the file being uploaded
+        :param string md5:
+            The MD5 sum of the complete file
+        :param string dest_path:
+            The path in the file store to move the file to
+        :return:
+            The size of the file if it was moved into the file store, or None if its MD5 sum was wrong, in which case
+            the partial upload is deleted and the client must start again
+        :raises:
+            ValueError if the upload hasn't been started
+        """
+        path = self._path(file_id, md5)
+        with self._lock:
+            if not os.path.exists(path):
+                raise ValueError("No upload in progress for file %s" % file_id)
+            digest = hashlib.md5()
+            with open(path, 'rb') as spool_file:
+                for block in iter(lambda: spool_file.read(65536), b''):
+                    digest.update(block)
+            if digest.hexdigest() != md5.lower():
+                os.remove(path)
+                return None
+            size = os.path.getsize(path)
+            shutil.move(path, dest_path)
+            return size
+
+    def expire(self):
+        """
+        Delete partial uploads which haven't received any new data for longer than max_age
+
+        :return:
+            The number of uploads deleted
+        """
+        if not os.path.isdir(self.spool_path):
+            return 0
+        cutoff = time.time() - self.max_age
+        removed = 0
+        with self._lock:
+            for file_name in os.listdir(self.spool_path):
+                path = os.path.join(self.spool_path, file_name)
+                try:
+                    if file_name.endswith('.part') and os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
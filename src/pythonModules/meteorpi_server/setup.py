@@ -16,7 +16,11 @@ setup(
         'flask-cors',
         'tornado',
         'flask-jsonpify',
-        'pyyaml'],
+        'pyyaml',
+        'Pillow',
+        'numpy'],
+    extras_require={
+        'compression': ['brotli', 'zstandard']},
     include_package_data=True,
     test_suite='nose.collector',
     tests_require=['nose',
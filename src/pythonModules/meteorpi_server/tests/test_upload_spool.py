@@ -0,0 +1,81 @@
+# test_upload_spool.py
+# Meteor Pi, Cambridge Science Centre
+
+# -------------------------------------------------
+# Copyright 2016 Cambridge Science Centre.
+
+# This file is part of Meteor Pi.
+
+# Meteor Pi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Meteor Pi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Meteor Pi.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+import os
+import io
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import meteorpi_model as model
+from meteorpi_server.upload_spool import UploadSpool
+
+
+class TestUploadSpool(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.spool = UploadSpool(spool_path=os.path.join(self.dir, 'spool'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_upload_in_chunks(self):
+        # Use an ID of the form given to files by the database
+        file_id = model.get_hash(time.time(), 'obstory', 'file')
+        data = os.urandom(1000)
+        md5 = hashlib.md5(data).hexdigest()
+
+        self.assertEqual(self.spool.start(file_id=file_id, md5=md5), 0)
+        offset = self.spool.write_chunk(file_id=file_id, md5=md5, offset=0, stream=io.BytesIO(data[:600]), length=600)
+        self.assertEqual(offset, 600)
+        # Resuming tells us where to carry on from, and a chunk sent from the wrong place is ignored
+        self.assertEqual(self.spool.start(file_id=file_id, md5=md5), 600)
+        self.assertEqual(self.spool.write_chunk(file_id=file_id, md5=md5, offset=0, stream=io.BytesIO(data[:400]),
+                                                length=400), 600)
+        offset = self.spool.write_chunk(file_id=file_id, md5=md5, offset=offset, stream=io.BytesIO(data[600:]),
+                                        length=400)
+        self.assertEqual(offset, 1000)
+
+        dest_path = os.path.join(self.dir, file_id)
+        self.assertEqual(self.spool.finish(file_id=file_id, md5=md5, dest_path=dest_path), 1000)
+        with open(dest_path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_wrong_md5(self):
+        file_id = model.get_hash(time.time(), 'obstory', 'file')
+        md5 = hashlib.md5(b'something else').hexdigest()
+        self.spool.start(file_id=file_id, md5=md5)
+        self.spool.write_chunk(file_id=file_id, md5=md5, offset=0, stream=io.BytesIO(b'data'), length=4)
+        self.assertIsNone(self.spool.finish(file_id=file_id, md5=md5, dest_path=os.path.join(self.dir, file_id)))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, file_id)))
+
+    def test_malformed_ids(self):
+        md5 = hashlib.md5(b'').hexdigest()
+        for file_id in ['', '../file', 'a' * 33, 'file.part']:
+            self.assertRaises(ValueError, self.spool.start, file_id=file_id, md5=md5)
+        self.assertRaises(ValueError, self.spool.start, file_id='file', md5='not_an_md5')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -204,11 +204,15 @@ CREATE TABLE archive_observationExport (
   obsTime       REAL NOT NULL,
   exportConfig  INTEGER NOT NULL,
   exportState   INTEGER NOT NULL, /* 0 for complete, non-zero for active */
+  leaseOwner    VARCHAR(64), /* ID of the exporter which has claimed this row, if any */
+  leaseExpiry   REAL NOT NULL DEFAULT 0, /* time at which the claim lapses, 0 if unclaimed */
   FOREIGN KEY (observationId) REFERENCES archive_observations (uid)
     ON DELETE CASCADE,
   FOREIGN KEY (exportConfig) REFERENCES archive_exportConfig (uid)
     ON DELETE CASCADE,
-  INDEX (exportConfig, exportState, obsTime)
+  INDEX (exportConfig, exportState, obsTime),
+  INDEX (exportState, leaseExpiry),
+  INDEX (leaseOwner, leaseExpiry)
 );
 
 CREATE TABLE archive_observationImport (
@@ -228,11 +232,15 @@ CREATE TABLE archive_fileExport (
   fileTime     REAL NOT NULL,
   exportConfig INTEGER NOT NULL,
   exportState  INTEGER NOT NULL, /* 0 for complete, non-zero for active */
+  leaseOwner   VARCHAR(64), /* ID of the exporter which has claimed this row, if any */
+  leaseExpiry  REAL NOT NULL DEFAULT 0, /* time at which the claim lapses, 0 if unclaimed */
   FOREIGN KEY (fileId) REFERENCES archive_files (uid)
     ON DELETE CASCADE,
   FOREIGN KEY (exportConfig) REFERENCES archive_exportConfig (uid)
     ON DELETE CASCADE,
-  INDEX (exportConfig, exportState, fileTime)
+  INDEX (exportConfig, exportState, fileTime),
+  INDEX (exportState, leaseExpiry),
+  INDEX (leaseOwner, leaseExpiry)
 );
 
 
@@ -253,11 +261,15 @@ CREATE TABLE archive_metadataExport (
   setAtTime REAL NOT NULL,
   exportConfig INTEGER NOT NULL, /* URL of the target import API */
   exportState  INTEGER NOT NULL, /* 0 for complete, non-zero for active */
+  leaseOwner   VARCHAR(64), /* ID of the exporter which has claimed this row, if any */
+  leaseExpiry  REAL NOT NULL DEFAULT 0, /* time at which the claim lapses, 0 if unclaimed */
   FOREIGN KEY (metadataId) REFERENCES archive_metadata (uid)
     ON DELETE CASCADE,
   FOREIGN KEY (exportConfig) REFERENCES archive_exportConfig (uid)
     ON DELETE CASCADE,
-  INDEX (exportConfig, exportState, setAtTime)
+  INDEX (exportConfig, exportState, setAtTime),
+  INDEX (exportState, leaseExpiry),
+  INDEX (leaseOwner, leaseExpiry)
 );
 
 CREATE TABLE archive_metadataImport (
@@ -0,0 +1,23 @@
+/* Adds the columns used by the export queue (meteorpi_db.export_queue) to claim export tasks to an existing database.
+   New databases built with archive-schema.sql already have them. Run this once, before starting an exporter which uses
+   the export queue:
+
+   mysql -u meteorpi --password=meteorpi meteorpi < upgrade-export-leases.sql */
+
+ALTER TABLE archive_observationExport
+  ADD COLUMN leaseOwner  VARCHAR(64), /* ID of the exporter which has claimed this row, if any */
+  ADD COLUMN leaseExpiry REAL NOT NULL DEFAULT 0, /* time at which the claim lapses, 0 if unclaimed */
+  ADD INDEX (exportState, leaseExpiry),
+  ADD INDEX (leaseOwner, leaseExpiry);
+
+ALTER TABLE archive_fileExport
+  ADD COLUMN leaseOwner  VARCHAR(64), /* ID of the exporter which has claimed this row, if any */
+  ADD COLUMN leaseExpiry REAL NOT NULL DEFAULT 0, /* time at which the claim lapses, 0 if unclaimed */
+  ADD INDEX (exportState, leaseExpiry),
+  ADD INDEX (leaseOwner, leaseExpiry);
+
+ALTER TABLE archive_metadataExport
+  ADD COLUMN leaseOwner  VARCHAR(64), /* ID of the exporter which has claimed this row, if any */
+  ADD COLUMN leaseExpiry REAL NOT NULL DEFAULT 0, /* time at which the claim lapses, 0 if unclaimed */
+  ADD INDEX (exportState, leaseExpiry),
+  ADD INDEX (leaseOwner, leaseExpiry);